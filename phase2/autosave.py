@@ -0,0 +1,89 @@
+"""Background snapshot saves, by time and by amount of change.
+
+``Autosaver`` calls ``save()`` every ``interval`` seconds or as soon as
+``threshold`` mutations were reported through ``mutated()``, whichever
+comes first, and only if something changed since the last save.  Either
+trigger may be ``None`` (off).  ``save()`` itself is responsible for
+writing atomically and for not overlapping with other saves
+(``server.save_state`` does both).  It reports a failure by raising or by
+returning ``False``: the mutations then count as unsaved again and the
+save is retried on the next tick, or after ``RETRY_DELAY`` seconds if
+there is no interval.
+"""
+
+from __future__ import annotations
+
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, Optional
+
+# seconds before a failed save is retried when there is no interval
+RETRY_DELAY = 5.0
+
+
+class Autosaver(Thread):
+    """Saves the model in the background; see the module docstring."""
+
+    def __init__(self, save: Callable[[], Any], interval: Optional[float] = 30.0,
+                 threshold: Optional[int] = 10000) -> None:
+        if interval is not None and interval <= 0:
+            raise ValueError("interval must be positive")
+        if threshold is not None and threshold < 1:
+            raise ValueError("threshold must be positive")
+        super().__init__(daemon=True)
+        self.save = save
+        self.interval = interval
+        self.threshold = threshold
+        self.saves = 0
+        self._lock = Lock()
+        self._pending = 0
+        self._wake = Event()
+        self._stop_event = Event()
+
+    @property
+    def pending(self) -> int:
+        """Mutations reported since the last save started."""
+        return self._pending
+
+    def mutated(self, count: int = 1) -> None:
+        # called by every mutation, under its stripes: keep it short
+        with self._lock:
+            self._pending += count
+            if self.threshold is not None and self._pending >= self.threshold:
+                self._wake.set()
+
+    def run(self) -> None:
+        failed = False
+        while True:
+            timeout = self.interval
+            if failed and (timeout is None or timeout > RETRY_DELAY):
+                timeout = RETRY_DELAY
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                return
+            with self._lock:
+                if not self._pending:
+                    continue
+                taken, self._pending = self._pending, 0
+            try:
+                failed = self.save() is False
+            except Exception as exc:
+                print(f"WARN: autosave failed: {exc}")
+                failed = True
+            if failed:
+                with self._lock:
+                    self._pending += taken
+            else:
+                self.saves += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "pending": self._pending,
+            "saves": self.saves,
+        }
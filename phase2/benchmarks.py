@@ -0,0 +1,607 @@
+"""Micro-benchmarks for the cargo tracking server.
+
+Usage: python benchmarks.py <benchmark> [options]
+
+Each benchmark prints one summary line; run with --help for the list.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_legacy_snapshot(path, n_items, n_containers=1000):
+    """Write a snapshot the way the original save_state did (indent=2,
+    items before containers), with half the items loaded into containers."""
+    containers = [
+        {
+            'cid': f'C{c:06d}',
+            'description': 'bench container',
+            'type': 'Truck' if c % 2 else 'Hub',
+            'loc': [float(c % 360) - 180.0, float(c % 180) - 90.0],
+            'items': [],
+            'deleted': False,
+        }
+        for c in range(n_containers)
+    ]
+    items = []
+    for i in range(1, n_items + 1):
+        cid = f'C{i % n_containers:06d}' if i % 2 else None
+        items.append({
+            'id': f'CI{i:08d}',
+            'sendernam': f'sender{i % 5000}',
+            'recipnam': f'recipient{i % 7000}',
+            'recipaddr': f'address{i % 9000}',
+            'owner': f'owner{i % 100}',
+            'state': 'in transit' if cid else 'accepted',
+            'container': cid,
+            'deleted': False,
+        })
+        if cid:
+            containers[i % n_containers]['items'].append(f'CI{i:08d}')
+    with open(path, 'w', encoding='utf-8') as handle:
+        json.dump({'items': items, 'containers': containers}, handle, indent=2)
+
+
+def _generate_worker(path, n_items):
+    # run in its own process: Linux carries the RSS high-water mark of the
+    # spawning process into the child, so a parent that built the snapshot
+    # would inflate every peak RSS measured after it
+    write_legacy_snapshot(path, int(n_items))
+
+
+def _peak_rss_mb():
+    import resource
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _load_worker(path):
+    sys.path.insert(0, HERE)
+    import server
+    start = time.perf_counter()
+    server.load_state(path)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'items': len(server._directory._items),
+        'containers': len(server._containers),
+        'seconds': round(elapsed, 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }))
+
+
+def bench_load(args):
+    """Startup cost of load_state(): wall time and peak RSS of a fresh process."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.snapshot or os.path.join(tmp, 'bench_state.json')
+        if not args.snapshot:
+            _run_worker('_generate_worker', path, str(args.items))
+        size_mb = os.path.getsize(path) / (1024.0 * 1024.0)
+        result = _run_worker('_load_worker', path)
+    print(f"load_state: {result['items']} items, {result['containers']} containers, "
+          f"{size_mb:.0f} MB file -> {result['seconds']} s, peak RSS {result['peak_rss_mb']} MB")
+
+
+def _convert_worker(src, dst):
+    sys.path.insert(0, HERE)
+    import server
+    server.load_state(src)
+    server.save_state(dst)
+
+
+def _run_worker(*args):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__)] + list(args),
+        check=True, capture_output=True, text=True,
+    ).stdout
+    lines = out.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def bench_formats(args):
+    """Snapshot size and load time of the JSON vs the binary format."""
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, 'legacy.json')
+        _run_worker('_generate_worker', legacy, str(args.items))
+        for name in ('state.json', 'state.bin'):
+            path = os.path.join(tmp, name)
+            _run_worker('_convert_worker', legacy, path)
+            size_mb = os.path.getsize(path) / (1024.0 * 1024.0)
+            result = _run_worker('_load_worker', path)
+            print(f"{name}: {size_mb:.1f} MB, load {result['seconds']} s, "
+                  f"peak RSS {result['peak_rss_mb']} MB ({result['items']} items)")
+
+
+def _rss_mb(pid):
+    with open(f'/proc/{pid}/status') as handle:
+        for line in handle:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def bench_restart(args):
+    """Restart of a server on a binary snapshot: time to listen and to answer, eager vs --lazy-load."""
+    import socket
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, 'legacy.json')
+        state = os.path.join(tmp, 'state.bin')
+        _run_worker('_generate_worker', legacy, str(args.items))
+        _run_worker('_convert_worker', legacy, state)
+        print(f'restart on {args.items} items ({os.path.getsize(state) / (1024.0 * 1024.0):.0f} MB .bin):')
+        for lazy in (False, True):
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            start = time.perf_counter()
+            proc = subprocess.Popen(
+                [sys.executable, os.path.join(HERE, 'server.py'), str(port), '--state-file', state,
+                 '--no-journal', '--autosave-interval', '0', '--autosave-every', '0']
+                + (['--lazy-load'] if lazy else []),
+                stdout=subprocess.DEVNULL)
+            try:
+                _wait_listening(port, timeout=600.0, delay=0.001)
+                listening = time.perf_counter() - start
+                sock = socket.create_connection(('127.0.0.1', port))
+                reader = sock.makefile('rb')
+
+                def ask(line):
+                    sock.sendall(line.encode() + b'\n')
+                    return reader.readline()
+
+                # an item loaded in a container: the lazy server builds both
+                ask(f'STATUS CI{args.items // 2 | 1:08d}')
+                answered = time.perf_counter() - start
+                rss = _rss_mb(proc.pid)
+                begin = time.perf_counter()
+                ask('FIND_ITEMS owner owner7')
+                find = time.perf_counter() - begin
+                sock.close()
+            finally:
+                proc.kill()
+                proc.wait()
+            print(f"  {'lazy' if lazy else 'eager'}: listening after {listening * 1000:.0f} ms, "
+                  f"first STATUS after {answered * 1000:.0f} ms (RSS {rss:.0f} MB), "
+                  f"first FIND_ITEMS {find:.2f} s")
+
+
+def _memory_worker(n_items, store='objects'):
+    sys.path.insert(0, HERE)
+    import tracemalloc
+    from cargo_item import CargoDirectory, CargoItem
+    from cargo_store import CargoStore
+    from container import Container
+
+    n_items = int(n_items)
+    containers = [Container(f'C{c:06d}', 'bench container', 'Truck', (0.0, 0.0)) for c in range(1000)]
+    # the ids are built before tracing starts; every loaded item keeps its own
+    ids = [f'CI{i:08d}' for i in range(1, n_items + 1)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    directory = CargoStore() if store == 'columnar' else CargoDirectory()
+    for i, item_id in enumerate(ids):
+        item = directory.add(CargoItem.restore(item_id, 'sender', 'recipient', 'address', 'owner'))
+        if i % 2:
+            containers[i % 1000].load([item])
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(json.dumps({'items': n_items, 'bytes_per_item': round(used / n_items, 1)}))
+
+
+def bench_memory(args):
+    """Bytes of model memory per CargoItem (directory entry and container slot included)."""
+    result = _run_worker('_memory_worker', str(args.items), args.store)
+    print(f"memory ({args.store}): {result['bytes_per_item']} bytes per item "
+          f"({result['items']} items, half of them loaded into containers)")
+
+
+def _list_worker(n_items, store='objects'):
+    sys.path.insert(0, HERE)
+    from cargo_item import CargoDirectory, CargoItem
+    from cargo_store import CargoStore
+    from container import Container
+
+    containers = [Container(f'C{c:06d}', 'bench container', 'Truck', (0.0, 0.0)) for c in range(1000)]
+    directory = CargoStore() if store == 'columnar' else CargoDirectory()
+    for i in range(1, int(n_items) + 1):
+        item = directory.add(CargoItem.restore(f'CI{i:08d}', 'sender', 'recipient', 'address', 'owner'))
+        if i % 2:
+            containers[i % 1000].load([item])
+    rounds = []
+    for _ in range(2):
+        start = time.perf_counter()
+        directory.list()
+        [cont.get() for cont in containers]
+        rounds.append(round(time.perf_counter() - start, 3))
+    # one mutation between listings only re-serializes what it touched
+    containers[1].setlocation(1.0, 1.0)
+    directory.get('CI00000002').complete()
+    start = time.perf_counter()
+    directory.list()
+    [cont.get() for cont in containers]
+    rounds.append(round(time.perf_counter() - start, 3))
+    print(json.dumps({'items': int(n_items), 'seconds': rounds}))
+
+
+def bench_list(args):
+    """Cost of listing every item and container: cold, repeated, after one change."""
+    result = _run_worker('_list_worker', str(args.items), args.store)
+    cold, warm, touched = result['seconds']
+    print(f"list ({args.store}, {result['items']} items): first {cold} s, "
+          f"repeated {warm} s, after one change {touched} s")
+
+
+def _save_worker(n_items, path):
+    sys.path.insert(0, HERE)
+    import threading
+    import server
+    from cargo_item import CargoItem
+    from container import Container
+
+    n_items = int(n_items)
+    for c in range(1000):
+        server._containers[f'C{c:06d}'] = Container(f'C{c:06d}', 'bench container', 'Truck', (0.0, 0.0))
+    for i in range(1, n_items + 1):
+        item = server._directory.add(CargoItem.restore(f'CI{i:08d}', 'sender', 'recipient', 'address', 'owner'))
+        if i % 2:
+            server._containers[f'C{i % 1000:06d}'].load([item])
+    session = server.CommandSession()
+    stalls = []
+    done = threading.Event()
+
+    def writer():
+        # SETLOC of one container, timing how long each command takes
+        n = 0
+        while not done.is_set():
+            n += 1
+            start = time.perf_counter()
+            session.handle(f'SETLOC C000001 {n % 90} 0')
+            stalls.append(time.perf_counter() - start)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    start = time.perf_counter()
+    server.save_state(path)
+    seconds = time.perf_counter() - start
+    done.set()
+    thread.join()
+    print(json.dumps({'items': n_items, 'seconds': round(seconds, 3), 'writes': len(stalls),
+                      'max_write_ms': round(max(stalls) * 1000, 1)}))
+
+
+def bench_save(args):
+    """SAVE duration, and how long a concurrent writer is held up by it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('state.json', 'state.bin'):
+            result = _run_worker('_save_worker', str(args.items), os.path.join(tmp, name))
+            print(f"save {name} ({result['items']} items): {result['seconds']} s, "
+                  f"{result['writes']} SETLOCs meanwhile, slowest {result['max_write_ms']} ms")
+
+
+def _bulk_worker(n_items, watchers, chunk):
+    sys.path.insert(0, HERE)
+    import io
+    from contextlib import redirect_stdout
+    import server
+
+    n_items, chunk = int(n_items), int(chunk)
+    session = server.CommandSession()
+    for cid in ('BULK-A', 'BULK-B'):
+        session.handle(f'CREATE_CONTAINER {cid} bench Truck 0 0')
+    ids = [session.handle('CREATE_ITEM S R A O')[0][3:] for _ in range(n_items)]
+    items = [server._directory.get(item_id) for item_id in ids]
+    sessions = [server.CommandSession() for _ in range(int(watchers))]
+    for watcher in sessions:
+        watcher.tracker.addItem(items)
+    chunks = [' '.join(ids[i:i + chunk]) for i in range(0, n_items, chunk)]
+
+    def timed(lines):
+        for watcher in sessions:
+            watcher.events.clear()
+        start = time.perf_counter()
+        for line in lines:
+            session.handle(line)
+        rate = n_items / (time.perf_counter() - start)
+        return {'items_per_s': round(rate), 'events': len(sessions[0].events) if sessions else 0}
+
+    # Tracker.updated() prints one line per notification
+    with redirect_stdout(io.StringIO()):
+        result = {
+            'LOAD': timed([f'LOAD {item_id} BULK-A' for item_id in ids]),
+            'UNLOAD': timed([f'UNLOAD {item_id}' for item_id in ids]),
+            'LOAD_MANY': timed([f'LOAD_MANY BULK-A {line}' for line in chunks]),
+            'MOVE': timed([f'MOVE BULK-A BULK-B {line}' for line in chunks]),
+            'UNLOAD_MANY': timed([f'UNLOAD_MANY {line}' for line in chunks]),
+        }
+    print(json.dumps(result))
+
+
+def bench_bulk(args):
+    """Items/second of single LOAD/UNLOAD commands vs LOAD_MANY/MOVE/UNLOAD_MANY."""
+    result = _run_worker('_bulk_worker', str(args.items), str(args.watchers), str(args.chunk))
+    print(f"bulk ({args.items} items, {args.watchers} watching sessions, {args.chunk} ids per command):")
+    for command, stats in result.items():
+        print(f"  {command:<12} {stats['items_per_s']:>9} items/s, {stats['events']} events per session")
+
+
+def _events_worker(n_events, delay):
+    sys.path.insert(0, HERE)
+    import socket
+    import threading
+    import server
+    from cargo_item import CargoItem
+
+    n_events = int(n_events)
+    server.EVENT_QUEUE_LIMIT = n_events
+    server.EVENT_QUEUE_POLICY = 'drop_oldest'
+    server.EVENT_FLUSH_DELAY = float(delay)
+    items = [CargoItem.restore(f'CI{i:08d}', 'sender', 'recipient', 'address', 'owner') for i in range(n_events)]
+    ours, theirs = socket.socketpair()
+    session = server.Session(ours)
+    session.start()
+    received = threading.Event()
+
+    def client():
+        seen = 0
+        reader = theirs.makefile('rb')
+        for line in reader:
+            if line.startswith(b'EVENT '):
+                seen += 1
+                if seen == n_events:
+                    received.set()
+                    return
+
+    reader = threading.Thread(target=client, daemon=True)
+    reader.start()
+    # queue the whole burst first (cond is re-entrant and keeps the agent
+    # waiting) so only the delivery is timed
+    with session.cond:
+        for item in items:
+            session._on_tracker_update(session.tracker, item, item._tracking_id)
+        start = time.perf_counter()
+    received.wait()
+    elapsed = time.perf_counter() - start
+    session._disconnect()
+    print(json.dumps({'events': n_events, 'events_per_s': round(n_events / elapsed)}))
+
+
+def bench_events(args):
+    """Events/second delivered to one watcher over a local socket, from a queued burst."""
+    result = _run_worker('_events_worker', str(args.events), str(args.delay))
+    print(f"events (flush delay {args.delay} s): {result['events']} events, "
+          f"{result['events_per_s']} events/s")
+
+
+def _pipeline_worker(n_commands, recv_size, depth, proto='text'):
+    sys.path.insert(0, HERE)
+    import socket
+    import threading
+    import server
+    import wire
+
+    n_commands, depth = int(n_commands), int(depth)
+    server.RECV_SIZE = int(recv_size)
+    session = server.CommandSession()
+    item_id = session.handle('CREATE_ITEM S R A O')[0][3:]
+    ours, theirs = socket.socketpair()
+    worker = server.Session(ours)
+    worker.start()
+    reader = theirs.makefile('rb')
+    if proto == 'bin':
+        theirs.sendall(b'PROTO BIN\n')
+        reader.readline()
+        batches = [wire.encode_frames(f'[{n}, 18, "{item_id}"]' for n in range(i, min(i + depth, n_commands)))
+                   for i in range(0, n_commands, depth)]
+    else:
+        batches = [''.join(f'#{n} STATUS {item_id}\n' for n in range(i, min(i + depth, n_commands))).encode()
+                   for i in range(0, n_commands, depth)]
+    done = threading.Event()
+
+    def client():
+        seen = 0
+        if proto == 'bin':
+            data = b''
+            while seen < n_commands:
+                data += reader.read1(65536)
+                pos = 0
+                while len(data) - pos >= wire.HEADER.size:
+                    end = pos + wire.HEADER.size + wire.HEADER.unpack_from(data, pos)[0]
+                    if end > len(data):
+                        break
+                    pos = end
+                    seen += 1
+                data = data[pos:]
+        else:
+            while seen < n_commands:
+                reader.readline()
+                seen += 1
+        done.set()
+
+    threading.Thread(target=client, daemon=True).start()
+    start = time.perf_counter()
+    for batch in batches:
+        theirs.sendall(batch)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    worker._disconnect()
+    print(json.dumps({'commands': n_commands, 'commands_per_s': round(n_commands / elapsed)}))
+
+
+def bench_pipeline(args):
+    """Commands/second of a client pipelining tagged STATUS requests over a local socket."""
+    result = _run_worker('_pipeline_worker', str(args.commands), str(args.recv_size), str(args.depth), args.proto)
+    print(f"pipeline ({args.proto}, recv size {args.recv_size}, {args.depth} commands per write): "
+          f"{result['commands']} commands, {result['commands_per_s']} commands/s")
+
+
+def _shard_client_worker(host, port, seconds, depth):
+    import socket
+
+    depth = int(depth)
+    sock = socket.create_connection((host, int(port)))
+    reader = sock.makefile('rb')
+    sock.sendall(b'CREATE_ITEM S R A O\n')
+    item_id = reader.readline().decode().split()[1]
+    batch = ''.join(f'#{n} STATUS {item_id}\n' for n in range(depth)).encode()
+    done = 0
+    end = time.perf_counter() + float(seconds)
+    while time.perf_counter() < end:
+        sock.sendall(batch)
+        for _ in range(depth):
+            reader.readline()
+        done += depth
+    sock.close()
+    print(json.dumps({'commands': done}))
+
+
+def _wait_listening(port, timeout=10.0, delay=0.05):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(delay)
+
+
+def bench_shards(args):
+    """Aggregate commands/second of N shard processes, each with its own pipelining clients."""
+    import socket
+
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    print(f'shards ({os.cpu_count()} CPUs, {args.clients} clients per shard, '
+          f'{"through the router" if args.router else "direct to the shards"}):')
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            ports = [free_port() for _ in range(shards)]
+            procs = [subprocess.Popen(
+                [sys.executable, os.path.join(HERE, 'server.py'), str(port), '--shard', f'{index}/{shards}',
+                 '--no-journal', '--state-file', os.path.join(tmp, f'shard{index}.json')],
+                stdout=subprocess.DEVNULL)
+                for index, port in enumerate(ports)]
+            try:
+                for port in ports:
+                    _wait_listening(port)
+                targets = [port for port in ports for _ in range(args.clients)]
+                if args.router:
+                    router_port = free_port()
+                    connect = ','.join(f'127.0.0.1:{port}' for port in ports)
+                    procs.append(subprocess.Popen(
+                        [sys.executable, os.path.join(HERE, 'shard.py'), str(router_port), '--connect', connect],
+                        stdout=subprocess.DEVNULL))
+                    _wait_listening(router_port)
+                    targets = [router_port] * len(targets)
+                clients = [subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '_shard_client_worker',
+                     '127.0.0.1', str(port), str(args.seconds), str(args.depth)],
+                    stdout=subprocess.PIPE)
+                    for port in targets]
+                total = sum(json.loads(client.communicate()[0])['commands'] for client in clients)
+            finally:
+                for proc in procs:
+                    proc.terminate()
+                    proc.wait()
+        print(f'  {shards} shard(s): {round(total / args.seconds)} commands/s')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['_load_worker']:
+        return _load_worker(argv[1])
+    if argv[:1] == ['_generate_worker']:
+        return _generate_worker(argv[1], argv[2])
+    if argv[:1] == ['_list_worker']:
+        return _list_worker(*argv[1:])
+    if argv[:1] == ['_memory_worker']:
+        return _memory_worker(*argv[1:])
+    if argv[:1] == ['_save_worker']:
+        return _save_worker(argv[1], argv[2])
+    if argv[:1] == ['_bulk_worker']:
+        return _bulk_worker(*argv[1:])
+    if argv[:1] == ['_events_worker']:
+        return _events_worker(*argv[1:])
+    if argv[:1] == ['_pipeline_worker']:
+        return _pipeline_worker(*argv[1:])
+    if argv[:1] == ['_shard_client_worker']:
+        return _shard_client_worker(*argv[1:])
+    if argv[:1] == ['_convert_worker']:
+        return _convert_worker(argv[1], argv[2])
+
+    parser = argparse.ArgumentParser(description='Cargo server micro-benchmarks')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    load = sub.add_parser('load', help=bench_load.__doc__)
+    load.add_argument('--items', type=int, default=1_000_000)
+    load.add_argument('--snapshot', help='existing snapshot to load instead of a generated one')
+    load.set_defaults(func=bench_load)
+
+    formats = sub.add_parser('formats', help=bench_formats.__doc__)
+    formats.add_argument('--items', type=int, default=1_000_000)
+    formats.set_defaults(func=bench_formats)
+
+    memory = sub.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--items', type=int, default=1_000_000)
+    memory.add_argument('--store', choices=('objects', 'columnar'), default='objects')
+    memory.set_defaults(func=bench_memory)
+
+    listing = sub.add_parser('list', help=bench_list.__doc__)
+    listing.add_argument('--items', type=int, default=1_000_000)
+    listing.add_argument('--store', choices=('objects', 'columnar'), default='objects')
+    listing.set_defaults(func=bench_list)
+
+    save = sub.add_parser('save', help=bench_save.__doc__)
+    save.add_argument('--items', type=int, default=1_000_000)
+    save.set_defaults(func=bench_save)
+
+    restart = sub.add_parser('restart', help=bench_restart.__doc__)
+    restart.add_argument('--items', type=int, default=1_000_000)
+    restart.set_defaults(func=bench_restart)
+
+    bulk = sub.add_parser('bulk', help=bench_bulk.__doc__)
+    bulk.add_argument('--items', type=int, default=100_000)
+    bulk.add_argument('--watchers', type=int, default=4)
+    bulk.add_argument('--chunk', type=int, default=1000)
+    bulk.set_defaults(func=bench_bulk)
+
+    events = sub.add_parser('events', help=bench_events.__doc__)
+    events.add_argument('--events', type=int, default=200_000)
+    events.add_argument('--delay', type=float, default=0.0, help='EVENT_FLUSH_DELAY in seconds')
+    events.set_defaults(func=bench_events)
+
+    pipeline = sub.add_parser('pipeline', help=bench_pipeline.__doc__)
+    pipeline.add_argument('--commands', type=int, default=200_000)
+    pipeline.add_argument('--recv-size', type=int, default=65536, help='server RECV_SIZE in bytes')
+    pipeline.add_argument('--depth', type=int, default=1000, help='commands sent per write')
+    pipeline.add_argument('--proto', choices=('text', 'bin'), default='text', help='PROTO framing')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    shards = sub.add_parser('shards', help=bench_shards.__doc__)
+    shards.add_argument('--shards', type=lambda text: [int(n) for n in text.split(',')], default=[1, 2, 4],
+                        help='comma-separated shard counts')
+    shards.add_argument('--clients', type=int, default=2, help='client processes per shard')
+    shards.add_argument('--seconds', type=float, default=3.0)
+    shards.add_argument('--depth', type=int, default=100, help='pipelined commands per write')
+    shards.add_argument('--router', action='store_true', help='send every client through shard.py')
+    shards.set_defaults(func=bench_shards)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
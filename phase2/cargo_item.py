@@ -3,12 +3,56 @@
 from __future__ import annotations
 
 import json
+from bisect import bisect_right, insort
 from itertools import count
-from typing import Any, Dict, List, Optional, Tuple
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from versions import preserve_item
+
+
+def container_id(container: Any) -> Optional[Any]:
+    """Return the id under which an item reports the container it sits in."""
+    if container is None:
+        return None
+    cid = getattr(container, "cid", None)
+    if cid is not None:
+        return cid
+    if hasattr(container, "trackingId") and callable(container.trackingId):
+        return container.trackingId()
+    return container
 
 
 class CargoItem:
-    """Represents a single cargo item and its tracking state."""
+    """Represents a single cargo item and its tracking state.
+
+    Items are kept in the millions, so the layout is slotted: there is no
+    per-instance ``__dict__``, the tracker set is only allocated once a
+    tracker subscribes, and the container id is read off ``_container``
+    instead of being stored a second time.
+
+    ``_index`` is the directory that indexes the item by owner, state and
+    container; mutations that change one of those keys report the old keys
+    to it through ``_reindex()``.
+
+    ``get()`` caches its JSON in ``_json``; every mutator resets it to
+    ``None`` so the next ``get()`` serializes again.  Mutators first call
+    ``versions.preserve_item`` so open snapshots keep the old state.
+    """
+
+    __slots__ = (
+        "sender_name",
+        "recipient_name",
+        "recipient_address",
+        "owner",
+        "_tracking_id",
+        "state",
+        "_container",
+        "_trackers",
+        "_deleted",
+        "_index",
+        "_json",
+    )
 
     _id_sequence = count(1)
     _allowed_update_fields = {
@@ -46,12 +90,72 @@ class CargoItem:
         self._tracking_id = f"CI{next(self._id_sequence):08d}"
         self.state = "accepted"
         self._container: Any = None
-        self._container_id: Optional[Any] = None
-        self._trackers: set[Any] = set()
+        self._trackers: Optional[set[Any]] = None
         self._deleted = False
+        self._index: Optional[CargoDirectory] = None
+        self._json: Optional[str] = None
+
+    @classmethod
+    def restore(
+        cls,
+        tracking_id: str,
+        sendernam: str,
+        recipnam: str,
+        recipaddr: str,
+        owner: str,
+        state: str = "accepted",
+        deleted: bool = False,
+    ) -> "CargoItem":
+        """Rebuild a persisted item under its saved id.
+
+        Unlike the constructor this does not draw a new id from
+        ``_id_sequence``; the caller is expected to advance the sequence past
+        the restored ids.
+        """
+        if not tracking_id:
+            raise ValueError("tracking_id not provided")
+        if not sendernam:
+            raise ValueError("sendernam not provided")
+        if not recipnam:
+            raise ValueError("recipnam not provided")
+        if not recipaddr:
+            raise ValueError("recipaddr not provided")
+        if not owner:
+            raise ValueError("owner not provided")
+        item = cls.__new__(cls)
+        item.sender_name = sendernam
+        item.recipient_name = recipnam
+        item.recipient_address = recipaddr
+        item.owner = owner
+        item._tracking_id = tracking_id
+        item.state = state
+        item._container = None
+        item._trackers = None
+        item._deleted = deleted
+        item._index = None
+        item._json = None
+        return item
+
+    def _freeze(self) -> "CargoItem":
+        """A detached copy of the current state, for ``versions.Snapshot``."""
+        item = CargoItem.restore(
+            self.trackingId(),
+            sendernam=self.sender_name,
+            recipnam=self.recipient_name,
+            recipaddr=self.recipient_address,
+            owner=self.owner,
+            state=self.state,
+            deleted=self._deleted,
+        )
+        # containers never change their id, which is all get() reads of them
+        item._container = self._container
+        item._json = self._json
+        return item
 
     def get(self) -> str:
         """Return a JSON representation of the cargo item."""
+        if self._json is not None:
+            return self._json
         payload = {
             "id": self._tracking_id,
             "sendernam": self.sender_name,
@@ -59,10 +163,11 @@ class CargoItem:
             "recipaddr": self.recipient_address,
             "owner": self.owner,
             "state": self.state,
-            "container": self._container_id,
+            "container": self.getContainer(),
             "deleted": self._deleted,
         }
-        return json.dumps(payload, sort_keys=True)
+        self._json = json.dumps(payload, sort_keys=True)
+        return self._json
     
     def update(self, **updates: Any) -> None:
         if not updates:
@@ -71,18 +176,25 @@ class CargoItem:
         if self._deleted:
             raise RuntimeError("Cargo item has been deleted")
 
+        preserve_item(self)
         changed = False
-        for key, value in updates.items():
-            attr = self._allowed_update_fields.get(key)
-            if attr is None:
-                raise AttributeError(f"Unknown field '{key}'")
-            if value is None or (isinstance(value, str) and not value.strip()):
-                raise ValueError(f"Invalid value for '{key}'")
-
-            current = getattr(self, attr)
-            if current != value:
-                setattr(self, attr, value)
-                changed = True
+        keys = self._index_keys()
+        try:
+            for key, value in updates.items():
+                attr = self._allowed_update_fields.get(key)
+                if attr is None:
+                    raise AttributeError(f"Unknown field '{key}'")
+                if value is None or (isinstance(value, str) and not value.strip()):
+                    raise ValueError(f"Invalid value for '{key}'")
+
+                current = getattr(self, attr)
+                if current != value:
+                    setattr(self, attr, value)
+                    self._json = None
+                    changed = True
+        finally:
+            # fields set before a rejected one stay set, so index them too
+            self._reindex(keys)
 
         if changed:
             self.updated()
@@ -92,32 +204,39 @@ class CargoItem:
     def delete(self) -> None:
         if self._deleted:
             return
+        preserve_item(self)
+        if self._index is not None:
+            self._index._unindex(self)
         self._deleted = True
         self.state = "deleted"
         self._container = None
-        self._container_id = None
+        self._json = None
         self.updated()
-        self._trackers.clear()
+        self._trackers = None
 
     def trackingId(self) -> str:
         return self._tracking_id
 
+    def getid(self) -> str:
+        # Container.get() lists its items through getid()
+        return self._tracking_id
+
     def getContainer(self) -> Optional[Any]:
-        return self._container_id
+        return container_id(self._container)
+
+    def setContainer(self, container: Any, batch: Any = None) -> None:
+        """Place the item in ``container`` (``None`` to unload it).
 
-    def setContainer(self, container: Any) -> None:
+        With ``batch`` (a ``notify.UpdateBatch``) the tracker notification
+        is recorded there, under the container acted on, instead of sent."""
         if self._deleted:
             raise RuntimeError("Cargo item has been deleted")
 
+        preserve_item(self)
+        keys = self._index_keys()
+        previous = self._container
         self._container = container
-        if container is None:
-            self._container_id = None
-        elif hasattr(container, "cid"):
-            self._container_id = getattr(container, "cid")
-        elif hasattr(container, "trackingId") and callable(container.trackingId):
-            self._container_id = container.trackingId()
-        else:
-            self._container_id = container
+        self._json = None
 
         # attempt to align the item state with the container's declared state
         if container is None:
@@ -133,10 +252,25 @@ class CargoItem:
             if isinstance(state, str) and state:
                 self.state = state
 
-        self.updated()
+        self._reindex(keys)
+        if batch is None:
+            self.updated()
+        else:
+            batch.add_item(self, container if container is not None else previous)
+
+    def _index_keys(self) -> Tuple[str, str, Optional[Any]]:
+        return (self.owner, self.state, self.getContainer())
+
+    def _reindex(self, keys: Tuple[str, str, Optional[Any]]) -> None:
+        if self._index is not None and not self._deleted:
+            self._index._reindex(self, keys)
 
-    def updated(self) -> None:
+    def updated(self, interested: Optional[Callable[[Any], bool]] = None) -> None:
+        if not self._trackers:
+            return
         for tracker in list(self._trackers):
+            if interested is not None and not interested(tracker):
+                continue
             try:
                 tracker.updated(self)
             except TypeError:
@@ -146,7 +280,11 @@ class CargoItem:
         if self._deleted:
             raise RuntimeError("Cargo item has been deleted")
 
+        preserve_item(self)
+        keys = self._index_keys()
         self.state = "complete"
+        self._json = None
+        self._reindex(keys)
         self.updated()
 
     def track(self, tracker: Any) -> None:
@@ -156,44 +294,133 @@ class CargoItem:
         if tracker is None:
             raise ValueError("tracker must not be None")
         try:
-            self._trackers.add(tracker)
+            hash(tracker)
         except TypeError as exc:
             raise TypeError("tracker objects not hashable") from exc
+        if self._trackers is None:
+            self._trackers = set()
+        self._trackers.add(tracker)
 
     def untrack(self, tracker: Any) -> None:
         if self._deleted:
             raise RuntimeError("Cargo item has been deleted")
 
-        self._trackers.discard(tracker)
+        if self._trackers:
+            self._trackers.discard(tracker)
+            if not self._trackers:
+                self._trackers = None
 
 class CargoDirectory:
-    """In-memory catalog for cargo items supporting CRUD operations."""
+    """In-memory catalog for cargo items supporting CRUD operations.
+
+    Besides the id map the directory maintains secondary indexes (owner,
+    state, container and attached user to item ids) so that ``find()`` and
+    ``listattached()`` cost O(result) instead of a scan over every item.
+    Buckets are insertion-ordered dicts used as sets, so results come back
+    in the order the items entered the bucket.
+
+    The indexes are built by the first query and maintained from then on,
+    so loading or serving a directory that is never queried pays nothing
+    for them.
+
+    ``_order`` keeps every id sorted so ``page()`` can resume after a
+    cursor without walking the items before it.
+    """
 
     def __init__(self) -> None:
         self._items: Dict[str, CargoItem] = {}
         self._attachments: Dict[str, set[str]] = {}
+        self._order: List[str] = []
+        self._by_owner: Dict[str, Dict[str, None]] = {}
+        self._by_state: Dict[str, Dict[str, None]] = {}
+        self._by_container: Dict[Any, Dict[str, None]] = {}
+        self._by_user: Dict[str, Dict[str, None]] = {}
+        # items are mutated under per-item locks, so the shared buckets and
+        # _order need their own (leaf) lock
+        self._index_lock = Lock()
+        self._indexed = False
 
     def create(self, **kwargs: Any) -> str:
         item = CargoItem(**kwargs)
         item_id = item.trackingId()
         if item_id in self._items:
             raise RuntimeError("Duplicate cargo item identifier generated")
-        self._items[item_id] = item
+        self.add(item)
         return item_id
 
+    def add(self, item: CargoItem) -> CargoItem:
+        """Register an existing item (e.g. one rebuilt by ``CargoItem.restore``).
+
+        Returns the registered item, which is what later links must use.
+        """
+        item_id = item.trackingId()
+        if item_id not in self._items:
+            self._order_add(item_id)
+        self._items[item_id] = item
+        item._index = self
+        if not item._deleted:
+            self._reindex(item, None)
+        return item
+
     def list(self) -> List[Tuple[str, str]]:
-        return [(item_id, item.get()) for item_id, item in self._items.items()]
+        # iterate over a copy so concurrent create() calls cannot resize the
+        # dict underneath us; cached payloads skip the get() call
+        return [(item_id, item._json or item.get()) for item_id, item in list(self._items.items())]
+
+    def page(self, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
+        """Return up to ``limit`` ids that sort after ``after``, plus the
+        cursor for the next page (``None`` on the last page)."""
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        order = self._order
+        with self._index_lock:
+            start = 0 if after is None else bisect_right(order, after)
+            ids = order[start:start + limit]
+            more = start + limit < len(order)
+        return ids, (ids[-1] if more and ids else None)
 
     def listattached(self, user: str) -> List[Tuple[str, str]]:
         if not isinstance(user, str) or not user.strip():
             raise ValueError("user must be a non-empty string")
 
         result: List[Tuple[str, str]] = []
-        for item_id, users in self._attachments.items():
-            if user in users and item_id in self._items:
-                result.append((item_id, self._items[item_id].get()))
+        for item_id in self.find(user=user):
+            item = self._items.get(item_id)
+            if item is not None:
+                result.append((item_id, item.get()))
         return result
 
+    def find(
+        self,
+        owner: Optional[str] = None,
+        state: Optional[str] = None,
+        container: Optional[Any] = None,
+        user: Optional[str] = None,
+    ) -> List[str]:
+        """Return the ids of the items matching every given criterion.
+
+        The smallest matching bucket is walked and checked against the
+        others, so the cost follows the result, not the directory size.
+        """
+        criteria = [
+            (index, key)
+            for index, key in (
+                (self._by_owner, owner),
+                (self._by_state, state),
+                (self._by_container, container),
+                (self._by_user, user),
+            )
+            if key is not None
+        ]
+        if not criteria:
+            raise ValueError("find() needs at least one criterion")
+        if not self._indexed:
+            self._build_indexes()
+        with self._index_lock:
+            buckets = sorted((index.get(key, {}) for index, key in criteria), key=len)
+            first, rest = buckets[0], buckets[1:]
+            return [item_id for item_id in first if all(item_id in bucket for bucket in rest)]
+
     def get(self, item_id: str) -> CargoItem:
         if item_id not in self._items:
             raise KeyError(item_id)
@@ -205,6 +432,9 @@ class CargoDirectory:
 
         item = self._items[item_id]
         self._attachments.setdefault(item_id, set()).add(user)
+        if self._indexed:
+            with self._index_lock:
+                self._move(self._by_user, None, user, item_id)
         return item
 
     def detach(self, item_id: str, user: str) -> None:
@@ -219,6 +449,9 @@ class CargoDirectory:
         users.remove(user)
         if not users:
             self._attachments.pop(item_id, None)
+        if self._indexed:
+            with self._index_lock:
+                self._drop(self._by_user, user, item_id)
 
     def delete(self, item_id: str) -> None:
         item = self._items[item_id]
@@ -226,5 +459,102 @@ class CargoDirectory:
         if attached:
             raise RuntimeError("Cannot delete an item while it is attached")
         item.delete()
-        self._items.pop(item_id, None)
+        self._discard(item_id)
+
+    def remove(self, item_id: str) -> CargoItem:
+        """Unregister an item without deleting it (it moved to another
+        shard); returns the item."""
+        item = self._items[item_id]
+        preserve_item(item)
+        self._unindex(item)
+        self._discard(item_id)
+        self._attachments.pop(item_id, None)
+        return item
 
+    def _discard(self, item_id: str) -> None:
+        if self._items.pop(item_id, None) is not None:
+            self._order_remove(item_id)
+
+    def _order_add(self, item_id: str) -> None:
+        order = self._order
+        with self._index_lock:
+            if not order or item_id > order[-1]:
+                # ids are handed out in increasing order, so this is the norm
+                order.append(item_id)
+            else:
+                insort(order, item_id)
+
+    def _order_remove(self, item_id: str) -> None:
+        order = self._order
+        with self._index_lock:
+            position = bisect_right(order, item_id) - 1
+            if position >= 0 and order[position] == item_id:
+                del order[position]
+
+    ######### Index maintenance #############
+    def _build_indexes(self) -> None:
+        with self._index_lock:
+            if self._indexed:
+                return
+            # mutations from here on wait for the lock and then move their
+            # item, so an item read before or after its change ends up right
+            self._indexed = True
+            for item_id, item in list(self._items.items()):
+                if item._deleted:
+                    continue
+                owner, state, container = item._index_keys()
+                self._move(self._by_owner, None, owner, item_id)
+                self._move(self._by_state, None, state, item_id)
+                self._move(self._by_container, None, container, item_id)
+            for item_id, users in list(self._attachments.items()):
+                for user in list(users):
+                    self._move(self._by_user, None, user, item_id)
+
+    def _reindex(self, item: CargoItem, old_keys: Optional[Tuple[str, str, Optional[Any]]]) -> None:
+        """Move ``item`` from the buckets of ``old_keys`` to its current ones."""
+        if not self._indexed:
+            return
+        owner, state, container = new_keys = item._index_keys()
+        if new_keys == old_keys:
+            return
+        old_owner, old_state, old_container = old_keys or (None, None, None)
+        item_id = item.trackingId()
+        with self._index_lock:
+            if owner != old_owner:
+                self._move(self._by_owner, old_owner, owner, item_id)
+            if state != old_state:
+                self._move(self._by_state, old_state, state, item_id)
+            if container != old_container:
+                self._move(self._by_container, old_container, container, item_id)
+
+    def _unindex(self, item: CargoItem) -> None:
+        if not self._indexed:
+            return
+        item_id = item.trackingId()
+        owner, state, container = item._index_keys()
+        with self._index_lock:
+            self._drop(self._by_owner, owner, item_id)
+            self._drop(self._by_state, state, item_id)
+            if container is not None:
+                self._drop(self._by_container, container, item_id)
+            for user in self._attachments.get(item_id, ()):
+                self._drop(self._by_user, user, item_id)
+
+    @classmethod
+    def _move(cls, index: Dict[Any, Dict[str, None]], old: Any, new: Any, item_id: str) -> None:
+        if old is not None:
+            cls._drop(index, old, item_id)
+        if new is not None:
+            bucket = index.get(new)
+            if bucket is None:
+                bucket = index[new] = {}
+            bucket[item_id] = None
+
+    @staticmethod
+    def _drop(index: Dict[Any, Dict[str, None]], key: Any, item_id: str) -> None:
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket.pop(item_id, None)
+        if not bucket:
+            del index[key]
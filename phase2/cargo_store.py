@@ -0,0 +1,321 @@
+"""Columnar storage engine for cargo items.
+
+``CargoStore`` is a drop-in replacement for ``CargoDirectory``: it has the
+same ``create/add/get/list/listattached/attach/detach/delete`` API, but it
+keeps items in parallel arrays, one entry per row, instead of one
+``CargoItem`` object per item:
+
+* sender, recipient, address and owner are indexes into a shared string
+  table, so a text used by many items is stored once;
+* the state is a small integer code;
+* the container is an index into a table of container objects;
+* deleted/live flags are one byte each.
+
+``get()`` hands out a ``CargoItemView``, a lightweight ``CargoItem`` whose
+fields read and write the row, so the item business rules (validation,
+``setContainer`` state rules, tracker notification) are shared with the
+object engine.  Views are created on demand; two views of the same row
+compare and hash equal, so they can sit in container and tracker sets.
+
+Bulk scans such as ``state_counts()``, ``owned_by()`` and ``in_state()``
+run over the columns with C-level iterators instead of visiting every
+item object.  Rows are never reused: deleting an item only clears its
+live flag.
+"""
+
+from __future__ import annotations
+
+import json
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from itertools import compress
+from threading import RLock
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cargo_item import CargoDirectory, CargoItem, container_id
+
+
+def _string_field(column: str) -> property:
+    def fget(self: "CargoItemView") -> str:
+        store = self._store
+        return store._strings[getattr(store, column)[self._row]]
+
+    def fset(self: "CargoItemView", value: str) -> None:
+        store = self._store
+        getattr(store, column)[self._row] = store._intern(value)
+
+    return property(fget, fset)
+
+
+class CargoItemView(CargoItem):
+    """A ``CargoItem`` whose fields live in a row of a ``CargoStore``."""
+
+    __slots__ = ("_store", "_row")
+
+    sender_name = _string_field("_sender")
+    recipient_name = _string_field("_recipient")
+    recipient_address = _string_field("_address")
+    owner = _string_field("_owner")
+
+    @property
+    def _tracking_id(self) -> str:
+        return self._store._ids[self._row]
+
+    @property
+    def state(self) -> str:
+        store = self._store
+        return store._state_names[store._state[self._row]]
+
+    @state.setter
+    def state(self, value: str) -> None:
+        store = self._store
+        store._state[self._row] = store._state_code(value)
+
+    @property
+    def _container(self) -> Any:
+        code = self._store._container[self._row]
+        return None if code < 0 else self._store._container_objects[code]
+
+    @_container.setter
+    def _container(self, container: Any) -> None:
+        store = self._store
+        store._container[self._row] = store._container_code(container)
+
+    @property
+    def _trackers(self) -> Optional[set]:
+        return self._store._trackers.get(self._row)
+
+    @_trackers.setter
+    def _trackers(self, trackers: Optional[set]) -> None:
+        if trackers is None:
+            self._store._trackers.pop(self._row, None)
+        else:
+            self._store._trackers[self._row] = trackers
+
+    @property
+    def _json(self) -> Optional[str]:
+        return self._store._json.get(self._row)
+
+    @_json.setter
+    def _json(self, payload: Optional[str]) -> None:
+        if payload is None:
+            self._store._json.pop(self._row, None)
+        else:
+            self._store._json[self._row] = payload
+
+    @property
+    def _index(self) -> "CargoStore":
+        return self._store
+
+    @property
+    def _deleted(self) -> bool:
+        return bool(self._store._deleted[self._row])
+
+    @_deleted.setter
+    def _deleted(self, deleted: bool) -> None:
+        self._store._deleted[self._row] = 1 if deleted else 0
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CargoItemView):
+            return NotImplemented
+        return self._store is other._store and self._row == other._row
+
+    def __hash__(self) -> int:
+        return hash((id(self._store), self._row))
+
+
+class _Rows(Mapping):
+    """Read-only ``id -> CargoItemView`` mapping over the live rows."""
+
+    def __init__(self, store: "CargoStore") -> None:
+        self._store = store
+
+    def __getitem__(self, item_id: str) -> CargoItemView:
+        return self._store._view(self._store._rows[item_id])
+
+    def __contains__(self, item_id: object) -> bool:
+        return item_id in self._store._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._store._rows)
+
+    def __len__(self) -> int:
+        return len(self._store._rows)
+
+
+class CargoStore(CargoDirectory):
+    """Columnar catalog for cargo items with the ``CargoDirectory`` API."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._items = _Rows(self)
+        self._rows: Dict[str, int] = {}
+        self._ids: List[str] = []
+
+        self._strings: List[str] = []
+        self._string_codes: Dict[str, int] = {}
+        self._sender = array("I")
+        self._recipient = array("I")
+        self._address = array("I")
+        self._owner = array("I")
+
+        self._state_names: List[str] = []
+        self._state_codes: Dict[str, int] = {}
+        self._state = array("H")
+
+        # containers are keyed by identity; the table keeps them alive so
+        # an id() is never reused while its code is in use
+        self._container_objects: List[Any] = []
+        self._container_codes: Dict[int, int] = {}
+        self._container = array("i")
+
+        self._deleted = bytearray()
+        self._live = bytearray()
+        self._trackers: Dict[int, set] = {}
+        # serialized rows, filled by get()/list() and cleared by mutations
+        self._json: Dict[int, str] = {}
+        # guards claiming rows and the code tables: items are created and
+        # changed under different stripes; a leaf, see locks.py
+        self._tables_lock = RLock()
+
+    def add(self, item: CargoItem) -> CargoItemView:
+        item_id = item.trackingId()
+        with self._tables_lock:
+            # every column gets its entry for the row before another add
+            # can claim the next one
+            row = len(self._ids)
+            old_row = self._rows.get(item_id)
+            self._ids.append(item_id)
+            self._sender.append(self._intern(item.sender_name))
+            self._recipient.append(self._intern(item.recipient_name))
+            self._address.append(self._intern(item.recipient_address))
+            self._owner.append(self._intern(item.owner))
+            self._state.append(self._state_code(item.state))
+            self._container.append(self._container_code(item._container))
+            self._deleted.append(1 if item._deleted else 0)
+            self._live.append(1)
+            if item._trackers:
+                self._trackers[row] = set(item._trackers)
+            if old_row is not None:
+                self._live[old_row] = 0
+                self._json.pop(old_row, None)
+            self._rows[item_id] = row
+        if old_row is None:
+            self._order_add(item_id)
+        else:
+            self._unindex(self._view(old_row))
+        view = self._view(row)
+        if not item._deleted:
+            self._reindex(view, None)
+        return view
+
+    def _discard(self, item_id: str) -> None:
+        with self._tables_lock:
+            row = self._rows.pop(item_id, None)
+            if row is not None:
+                self._live[row] = 0
+                self._json.pop(row, None)
+        if row is not None:
+            self._order_remove(item_id)
+
+    def list(self) -> List[Tuple[str, str]]:
+        # same payload as CargoItem.get(), read straight from the columns
+        strings = self._strings
+        states = self._state_names
+        containers = self._container_objects
+        sender, recipient, address, owner = self._sender, self._recipient, self._address, self._owner
+        state, container, deleted = self._state, self._container, self._deleted
+        cache = self._json
+        result = []
+        for item_id, row in list(self._rows.items()):
+            cached = cache.get(row)
+            if cached is not None:
+                result.append((item_id, cached))
+                continue
+            code = container[row]
+            payload = {
+                "id": item_id,
+                "sendernam": strings[sender[row]],
+                "recipnam": strings[recipient[row]],
+                "recipaddr": strings[address[row]],
+                "owner": strings[owner[row]],
+                "state": states[state[row]],
+                "container": None if code < 0 else container_id(containers[code]),
+                "deleted": bool(deleted[row]),
+            }
+            cached = cache[row] = json.dumps(payload, sort_keys=True)
+            result.append((item_id, cached))
+        return result
+
+    ######### Column scans #############
+    def state_counts(self) -> Dict[str, int]:
+        """Return how many live items are in each state."""
+        names = self._state_names
+        counts = Counter(compress(self._state, self._live))
+        return {names[code]: n for code, n in counts.items()}
+
+    def owned_by(self, owner: str) -> List[str]:
+        """Return the ids of the live items with the given owner."""
+        code = self._string_codes.get(owner)
+        return [] if code is None else self._select(self._owner, code)
+
+    def in_state(self, state: str) -> List[str]:
+        """Return the ids of the live items in the given state."""
+        code = self._state_codes.get(state)
+        return [] if code is None else self._select(self._state, code)
+
+    def _select(self, column: array, code: int) -> List[str]:
+        ids = self._ids
+        live = self._live
+        find = column.index
+        result = []
+        row = 0
+        try:
+            while True:
+                # array.index scans in C; Python runs once per match
+                row = find(code, row)
+                if live[row]:
+                    result.append(ids[row])
+                row += 1
+        except ValueError:
+            return result
+
+    ######### Internals #############
+    def _view(self, row: int) -> CargoItemView:
+        view = CargoItemView.__new__(CargoItemView)
+        view._store = self
+        view._row = row
+        return view
+
+    def _intern(self, text: str) -> int:
+        code = self._string_codes.get(text)
+        if code is None:
+            with self._tables_lock:
+                code = self._string_codes.get(text)
+                if code is None:
+                    self._strings.append(text)
+                    code = self._string_codes[text] = len(self._strings) - 1
+        return code
+
+    def _state_code(self, state: str) -> int:
+        code = self._state_codes.get(state)
+        if code is None:
+            with self._tables_lock:
+                code = self._state_codes.get(state)
+                if code is None:
+                    self._state_names.append(state)
+                    code = self._state_codes[state] = len(self._state_names) - 1
+        return code
+
+    def _container_code(self, container: Any) -> int:
+        if container is None:
+            return -1
+        code = self._container_codes.get(id(container))
+        if code is None:
+            with self._tables_lock:
+                code = self._container_codes.get(id(container))
+                if code is None:
+                    self._container_objects.append(container)
+                    code = self._container_codes[id(container)] = len(self._container_objects) - 1
+        return code
@@ -3,16 +3,41 @@
 from __future__ import annotations
 
 import json
-from typing import Any, List, Optional, Set, Tuple
+import math
+from typing import Any, Callable, List, Optional, Set, Tuple
 
 from cargo_item import CargoItem
+from versions import preserve_container
 
 # Define container types that are stationary
 STATIONARY_TYPES = {"FrontOffice", "Hub"}
 
 
+def _place(item: CargoItem, container: Optional[Container], batch: Any) -> None:
+    # only pass batch along when there is one: items are duck-typed
+    if batch is None:
+        item.setContainer(container)
+    else:
+        item.setContainer(container, batch=batch)
+
+
 class Container:
-    """Represents a container (stationary or mobile) for cargo items."""
+    """Represents a container (stationary or mobile) for cargo items.
+
+    ``get()`` caches its JSON in ``_json``; the mutators below reset it.
+    Code that changes ``_items`` directly must reset it as well.  Like the
+    item mutators, they first call ``versions.preserve_container``.
+
+    ``_space`` is the ``spatial.LocationIndex`` the container is filed in,
+    if any; ``setlocation`` moves it there and only notifies the trackers
+    whose view may contain the old or the new location.
+
+    Given a ``notify.UpdateBatch``, ``setlocation`` and ``updated`` only
+    record the update; the caller delivers the batch once it has released
+    the container's lock stripe.
+    """
+
+    __slots__ = ("cid", "description", "type", "loc", "_items", "_trackers", "_deleted", "_json", "_space")
 
     _allowed_update_fields = {
         "description": "description",
@@ -34,6 +59,12 @@ class Container:
             raise ValueError("type not provided")
         if not loc or not isinstance(loc, tuple) or len(loc) != 2:
             raise ValueError("loc must be a (long, latt) tuple")
+        try:
+            finite = math.isfinite(loc[0]) and math.isfinite(loc[1])
+        except TypeError:
+            finite = False
+        if not finite:
+            raise ValueError("loc coordinates must be finite numbers")
 
         self.cid = cid
         self.description = description
@@ -41,11 +72,16 @@ class Container:
         self.loc = loc
 
         self._items: Set[CargoItem] = set()
-        self._trackers: Set[Any] = set()
+        # allocated by the first track() call
+        self._trackers: Optional[Set[Any]] = None
         self._deleted = False
+        self._json: Optional[str] = None
+        self._space: Any = None
 
     def get(self) -> str:
         """Return a JSON representation of the container."""
+        if self._json is not None:
+            return self._json
         payload = {
             "cid": self.cid,
             "description": self.description,
@@ -54,7 +90,22 @@ class Container:
             "items": [item.getid() for item in self._items],
             "deleted": self._deleted,
         }
-        return json.dumps(payload, sort_keys=True)
+        self._json = json.dumps(payload, sort_keys=True)
+        return self._json
+
+    def _freeze(self) -> Container:
+        """A detached copy of the current state, for ``versions.Snapshot``."""
+        container = Container.__new__(Container)
+        container.cid = self.cid
+        container.description = self.description
+        container.type = self.type
+        container.loc = self.loc
+        container._items = set(self._items)
+        container._trackers = None
+        container._deleted = self._deleted
+        container._json = self._json
+        container._space = None
+        return container
 
     def update(self, **updates: Any) -> None:
         """Update mutable fields of the container."""
@@ -63,6 +114,7 @@ class Container:
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
 
+        preserve_container(self)
         changed = False
         for key, value in updates.items():
             attr = self._allowed_update_fields.get(key)
@@ -74,6 +126,7 @@ class Container:
             current = getattr(self, attr)
             if current != value:
                 setattr(self, attr, value)
+                self._json = None
                 changed = True
 
         if changed:
@@ -83,17 +136,23 @@ class Container:
         """Mark the container as deleted, unload items, and notify trackers."""
         if self._deleted:
             return
+        preserve_container(self)
         self._deleted = True
+        self._json = None
 
         # Unload all items
         self.unload(list(self._items))
 
         # Notify trackers of the deletion
         self.updated()
-        self._trackers.clear()
+        self._trackers = None
+        if self._space is not None:
+            self._space.remove(self.cid)
+
+    def setlocation(self, long: float, latt: float, batch: Any = None) -> None:
+        """Sets the new location of the container and notifies trackers/items.
 
-    def setlocation(self, long: float, latt: float) -> None:
-        """Sets the new location of the container and notifies trackers/items."""
+        With ``batch``, the notifications are recorded there instead."""
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
 
@@ -102,10 +161,20 @@ class Container:
             new_loc = (float(long), float(latt))
         except (ValueError, TypeError) as exc:
             raise ValueError("Invalid location coordinates") from exc
+        if not (math.isfinite(new_loc[0]) and math.isfinite(new_loc[1])):
+            raise ValueError("Invalid location coordinates")
 
         if self.loc != new_loc:
+            preserve_container(self)
+            old_loc = self.loc
             self.loc = new_loc
-            self.updated()
+            self._json = None
+            if self._space is None:
+                self.updated(batch=batch)
+                return
+            # re-filing moves the container to its new cell
+            self._space.add(self)
+            self.updated(self._space.interested_in(old_loc, new_loc), batch=batch)
 
     def getState(self) -> str:
         """
@@ -119,9 +188,13 @@ class Container:
             return "waiting"
         return "in transit"
 
-    def move(self, itemlist: List[CargoItem], newcontainer: Container) -> None:
+    def move(self, itemlist: List[CargoItem], newcontainer: Container, batch: Any = None) -> None:
         """
         Moves items from this container to a new container.
+
+        Concurrent callers must hold the lock stripes of both containers and
+        of every item, acquired together (see ``locks.py``).  ``batch``, as
+        for ``load``, defers and coalesces the item notifications.
         """
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
@@ -129,37 +202,54 @@ class Container:
         if newcontainer._deleted:
             raise RuntimeError(f"Container '{newcontainer.cid}' has been deleted")
 
+        preserve_container(self)
+        preserve_container(newcontainer)
         for item in itemlist:
             if item in self._items:
                 self._items.remove(item)
                 newcontainer._items.add(item)
+                self._json = newcontainer._json = None
                 # This call triggers item.updated()
-                item.setContainer(newcontainer)
+                _place(item, newcontainer, batch)
 
-    def load(self, itemlist: List[CargoItem]) -> None:
-        """Loads a list of items into this container."""
+    def load(self, itemlist: List[CargoItem], batch: Any = None) -> None:
+        """Loads a list of items into this container.
+
+        Concurrent callers must hold the lock stripes of this container, of
+        every item and of any container the items currently sit in.  With
+        ``batch`` (a ``notify.UpdateBatch``) the items' trackers are notified
+        once per tracker when the batch is delivered.
+        """
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
 
+        preserve_container(self)
         for item in itemlist:
             if item not in self._items:
                 # Add to this container
                 self._items.add(item)
+                self._json = None
                 # Set item's container, which updates item state
                 # and triggers item.updated()
-                item.setContainer(self)
+                _place(item, self, batch)
 
-    def unload(self, itemlist: List[CargoItem]) -> None:
-        """Unloads a list of items from this container."""
+    def unload(self, itemlist: List[CargoItem], batch: Any = None) -> None:
+        """Unloads a list of items from this container.
+
+        Concurrent callers must hold the lock stripes of this container and
+        of every item.  ``batch`` works as for ``load``.
+        """
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
 
+        preserve_container(self)
         for item in itemlist:
             if item in self._items:
                 self._items.remove(item)
+                self._json = None
                 # Set item's container to None, which updates item state
                 # and triggers item.updated()
-                item.setContainer(None)
+                _place(item, None, batch)
 
     def track(self, tracker: Any) -> None:
         """Adds a tracker object to be notified of updates."""
@@ -169,22 +259,38 @@ class Container:
         if tracker is None:
             raise ValueError("tracker must not be None")
         try:
-            self._trackers.add(tracker)
+            hash(tracker)
         except TypeError as exc:
             raise TypeError("tracker objects not hashable") from exc
+        if self._trackers is None:
+            self._trackers = set()
+        self._trackers.add(tracker)
 
     def untrack(self, tracker: Any) -> None:
         """Removes a tracker object from the notification list."""
         if self._deleted:
             raise RuntimeError(f"Container '{self.cid}' has been deleted")
 
-        self._trackers.discard(tracker)
+        if self._trackers:
+            self._trackers.discard(tracker)
+            if not self._trackers:
+                self._trackers = None
 
-    def updated(self) -> None:
+    def updated(self, interested: Optional[Callable[[Any], bool]] = None, batch: Any = None) -> None:
         """
-Notify all trackers and contained items of an update."""
+Notify all trackers and contained items of an update.
+
+        ``interested``, if given, limits the notification to the trackers
+        it accepts (see ``spatial.LocationIndex.interested_in``).  With
+        ``batch`` (a ``notify.UpdateBatch``) nothing is called yet: the
+        batch later sends one aggregated notification per tracker."""
+        if batch is not None:
+            batch.add(self, interested)
+            return
         # Notify trackers attached to this container
-        for tracker in list(self._trackers):
+        for tracker in list(self._trackers or ()):
+            if interested is not None and not interested(tracker):
+                continue
             try:
                 # Try calling with self as argument
                 tracker.updated(self)
@@ -200,5 +306,8 @@ Notify all trackers and contained items of an update."""
         # This will in turn notify trackers of those items.
         if not self._deleted:
             for item in list(self._items):
-                item.updated()
+                if interested is None:
+                    item.updated()
+                else:
+                    item.updated(interested)
 
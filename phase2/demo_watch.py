@@ -1,3 +1,4 @@
+import itertools
 import socket
 import threading
 import time
@@ -10,6 +11,7 @@ import json
 HOST = 'localhost'
 PORT = 5000
 STATE_FILE = 'server_state.json'
+JOURNAL_FILE = 'server_state.journal'
 
 # ANSI Colors for nicer output
 COLORS = {
@@ -36,6 +38,8 @@ class DemoClient(threading.Thread):
         self.actions = actions
         self.sock = None
         self.running = True
+        # request ids, so answers can be told apart from EVENT lines
+        self.requests = itertools.count(1)
 
     def connect(self):
         for i in range(5): # Retry up to 5 times
@@ -54,8 +58,9 @@ class DemoClient(threading.Thread):
     def send(self, cmd):
         if not self.running or not self.sock:
             return
+        request_id = f"#{next(self.requests)}"
         try:
-            self.sock.sendall((cmd + "\n").encode('utf-8'))
+            self.sock.sendall(f"{request_id} {cmd}\n".encode('utf-8'))
         except Exception as e:
             log(self.tag, f"Send failed: {e}")
 
@@ -106,6 +111,9 @@ class DemoClient(threading.Thread):
                     line, buffer = buffer.split('\n', 1)
                     line = line.strip()
                     if not line: continue
+                    if line.startswith("#"):
+                        # answer to one of our requests: drop the request id
+                        line = line.partition(" ")[2]
                     
                     if line.startswith("EVENT"):
                         try:
@@ -126,9 +134,7 @@ class DemoClient(threading.Thread):
 
 def start_server():
     # Cleanup state for clean start
-    if os.path.exists(STATE_FILE):
-        try: os.remove(STATE_FILE)
-        except OSError: pass
+    remove_state_files()
 
     print("--- Starting Server ---")
     proc = subprocess.Popen(
@@ -143,9 +149,14 @@ def stop_server(proc):
     print("--- Stopping Server ---")
     proc.kill()
     proc.wait()
-    if os.path.exists(STATE_FILE):
-        try: os.remove(STATE_FILE)
-        except OSError: pass
+    remove_state_files()
+
+def remove_state_files():
+    # the snapshot plus the write-ahead journal (and a half-compacted segment)
+    for path in (STATE_FILE, JOURNAL_FILE, JOURNAL_FILE + '.old'):
+        if os.path.exists(path):
+            try: os.remove(path)
+            except OSError: pass
 
 def run_scenario_1_concurrency():
     # 1. Two updaters updating at the same time
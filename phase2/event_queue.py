@@ -0,0 +1,177 @@
+"""Bounded per-session queue of pending tracker events.
+
+A slow client must not make the server buffer events without limit, so
+the queue holds at most ``limit`` events and applies one of three
+policies when more arrive:
+
+* ``coalesce``: an event for an object that already has one pending
+  updates that pending event in place (latest state/location, item ids
+  merged, position and ``seq`` kept) instead of queueing a second one;
+  if the queue is still full, the oldest event is dropped;
+* ``drop_oldest``: every event is queued and the oldest one is dropped on
+  overflow;
+* ``disconnect``: every event is queued; on overflow the event is refused
+  and ``overflowed`` is set so the session can drop the connection.
+
+Pushing and popping are O(1).  The queue is not thread-safe: callers hold
+the session's ``cond``.
+
+``EventRing`` keeps the most recent events of every session, tagged with
+the session's token, once they leave its queue.  ``SINCE`` and ``RESUME``
+replay from it.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from threading import Lock
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Event = Dict[str, Any]
+
+POLICIES = ("coalesce", "drop_oldest", "disconnect")
+
+
+class EventQueue:
+    """FIFO of event dicts with a size bound and an overflow policy."""
+
+    def __init__(self, limit: int = 10000, policy: str = "coalesce") -> None:
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown event queue policy '{policy}'")
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflowed = False
+        self._events: Deque[Event] = deque()
+        # coalesce: object key -> its pending event (also in _events)
+        self._pending: Dict[Any, Event] = {}
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __iter__(self) -> Iterator[Event]:
+        return iter(self._events)
+
+    def __getitem__(self, index: int) -> Event:
+        return self._events[index]
+
+    def push(self, event: Event) -> bool:
+        """Queue ``event``; returns False if it was refused (``disconnect``)."""
+        if self.policy == "coalesce":
+            key = event["obj"][:2]
+            pending = self._pending.get(key)
+            if pending is not None:
+                _merge(pending, event)
+                self.coalesced += 1
+                return True
+        if len(self._events) >= self.limit:
+            if self.policy == "disconnect":
+                self.overflowed = True
+                self.dropped += 1
+                return False
+            self._forget(self._events.popleft())
+            self.dropped += 1
+        self._events.append(event)
+        if self.policy == "coalesce":
+            self._pending[key] = event
+        return True
+
+    def popleft(self) -> Event:
+        event = self._events.popleft()
+        self._forget(event)
+        return event
+
+    def drain(self) -> List[Event]:
+        """Remove and return every pending event, oldest first."""
+        events = list(self._events)
+        self.clear()
+        return events
+
+    def clear(self) -> None:
+        self._events.clear()
+        self._pending.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "limit": self.limit,
+            "queued": len(self._events),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def _forget(self, event: Event) -> None:
+        if self._pending:
+            key = event["obj"][:2]
+            if self._pending.get(key) is event:
+                del self._pending[key]
+
+
+class EventRing:
+    """Bounded, thread-safe log of recent ``(token, event)`` pairs.
+
+    Events are appended in ``seq`` order per token.  For every registered
+    token the ring remembers the highest ``seq`` it has evicted, so
+    ``since()`` can tell a complete answer from one with a gap.
+    """
+
+    def __init__(self, size: int = 50000) -> None:
+        if size < 1:
+            raise ValueError("size must be positive")
+        self.size = size
+        self._lock = Lock()
+        self._events: Deque[Tuple[str, Event]] = deque()
+        self._evicted: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def register(self, token: str) -> None:
+        with self._lock:
+            self._evicted.setdefault(token, 0)
+
+    def forget(self, token: str) -> None:
+        """Stop tracking ``token``; its events age out with the others."""
+        with self._lock:
+            self._evicted.pop(token, None)
+
+    def extend(self, token: str, events: Iterable[Event]) -> None:
+        with self._lock:
+            ring = self._events
+            evicted = self._evicted
+            for event in events:
+                if len(ring) >= self.size:
+                    old_token, old = ring.popleft()
+                    if old_token in evicted:
+                        evicted[old_token] = old["seq"]
+                ring.append((token, event))
+
+    def since(self, token: str, seq: int, limit: Optional[int] = None) -> Optional[List[Event]]:
+        """Return up to ``limit`` events of ``token`` after ``seq``, or
+        ``None`` if some of them were already evicted (or the token is
+        unknown)."""
+        with self._lock:
+            evicted = self._evicted.get(token)
+            if evicted is None or evicted > seq:
+                return None
+            found = []
+            for owner, event in self._events:
+                if owner == token and event["seq"] > seq:
+                    found.append(event)
+                    if len(found) == limit:
+                        break
+            return found
+
+
+def _merge(pending: Event, event: Event) -> None:
+    # keep the queue position (and sequence number), take the newest values
+    items = pending.get("items")
+    seq = pending.get("seq")
+    pending.update(event)
+    if seq is not None:
+        pending["seq"] = seq
+    if items is not None and "items" in event:
+        pending["items"] = list(dict.fromkeys(items + event["items"]))
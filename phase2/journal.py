@@ -0,0 +1,312 @@
+"""Append-only mutation journal (write-ahead log) for the cargo server.
+
+Every model mutation is appended as one JSON line.  Lines are buffered and
+flushed to disk in batches by a flusher thread, either when ``batch_size``
+records are pending or every ``flush_interval`` seconds, so a crash loses
+at most the last unflushed batch.  ``append()`` runs under the model's lock
+stripes, so it only adds to the buffer: the flusher takes the buffer under
+``_lock`` and writes and fsyncs it holding only ``_write_lock``.
+
+Compaction rotates the live journal to ``<journal>.old`` while the model is
+locked, writes a fresh snapshot, and then removes the rotated segment.  On
+startup the state is the snapshot plus a replay of ``.old`` (if a crash
+interrupted a compaction) and the live journal.  Every record carries
+absolute values, so replaying a segment that the snapshot already contains
+is harmless.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterator, List, Optional
+
+from cargo_item import CargoDirectory, CargoItem
+from container import Container
+
+
+def journal_path(state_path: str) -> str:
+    """Return the journal file that belongs to a snapshot file."""
+    return os.path.splitext(state_path)[0] + ".journal"
+
+
+def journal_segments(state_path: str) -> List[str]:
+    """Return the existing journal segments for a snapshot, oldest first."""
+    live = journal_path(state_path)
+    return [path for path in (live + ".old", live) if os.path.exists(path)]
+
+
+class Journal:
+    """Buffered, batch-flushed append-only log of model mutations."""
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 0.05,
+        batch_size: int = 256,
+        fsync: bool = True,
+    ) -> None:
+        if flush_interval <= 0:
+            raise ValueError("flush_interval must be positive")
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+
+        # _lock guards the buffer and the counters; _write_lock the file,
+        # and is taken before _lock
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._handle = open(path, "a", encoding="utf-8")
+        self._buffer: List[str] = []
+        self.records_since_compaction = 0
+        self._closed = Event()
+        self._wake = Event()
+        self._flusher = Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def append(self, op: str, **fields: Any) -> None:
+        """Queue one mutation record; cost is independent of model size."""
+        record = {"op": op}
+        record.update(fields)
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._handle is None:
+                return
+            self._buffer.append(line)
+            self.records_since_compaction += 1
+            if len(self._buffer) >= self.batch_size:
+                self._wake.set()
+
+    def flush(self) -> None:
+        """Write and sync every record appended so far."""
+        with self._write_lock:
+            self._write_buffer()
+
+    def rotate(self) -> str:
+        """Move the live journal aside and start a new one.
+
+        Returns the rotated segment, which the caller removes with
+        ``discard_rotated()`` once a snapshot covering it is on disk.  A
+        closed journal is left as it is.
+        """
+        old_path = self.path + ".old"
+        with self._write_lock:
+            if self._handle is None:
+                return old_path
+            self._write_buffer()
+            self._handle.close()
+            if os.path.exists(old_path):
+                # a previous compaction never finished; keep both segments
+                with open(self.path, "rb") as src, open(old_path, "ab") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, old_path)
+            handle = open(self.path, "a", encoding="utf-8")
+            with self._lock:
+                self._handle = handle
+                self.records_since_compaction = 0
+        return old_path
+
+    def discard_rotated(self) -> None:
+        try:
+            os.remove(self.path + ".old")
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        self._closed.set()
+        self._wake.set()
+        with self._write_lock:
+            if self._handle is None:
+                return
+            self._write_buffer()
+            with self._lock:
+                handle, self._handle = self._handle, None
+            handle.close()
+
+    def _write_buffer(self) -> None:
+        # called with _write_lock held; appends go on meanwhile
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if self._handle is None or not lines:
+            return
+        try:
+            self._handle.write("".join(lines))
+            self._handle.flush()
+            if self.fsync:
+                os.fsync(self._handle.fileno())
+        except (OSError, ValueError):
+            # kept for the next try; replaying a record twice is harmless
+            with self._lock:
+                self._buffer[:0] = lines
+            raise
+
+    def _flush_loop(self) -> None:
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError) as exc:
+                print(f"WARN: journal flush failed: {exc}")
+
+
+class Compactor(Thread):
+    """Background thread that folds the journal into a snapshot.
+
+    ``compact`` is called every ``interval`` seconds, but only when the
+    journal holds at least ``min_records`` records.
+    """
+
+    def __init__(self, journal: Journal, compact: Any, interval: float = 60.0, min_records: int = 1) -> None:
+        super().__init__(daemon=True)
+        self.journal = journal
+        self.compact = compact
+        self.interval = interval
+        self.min_records = min_records
+        self._stop_event = Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            if self.journal.records_since_compaction < self.min_records:
+                continue
+            try:
+                self.compact()
+            except Exception as exc:
+                print(f"WARN: journal compaction failed: {exc}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the records of a journal segment, skipping a torn last line."""
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # a crash can leave one partially written line at the end
+                continue
+
+
+def replay(path: str, directory: CargoDirectory, containers: Dict[str, Container]) -> int:
+    """Apply every record of a journal segment; returns how many applied."""
+    applied = 0
+    for record in read_records(path):
+        try:
+            apply_record(record, directory, containers)
+        except (KeyError, ValueError, RuntimeError, TypeError):
+            continue
+        applied += 1
+    return applied
+
+
+def apply_record(
+    record: Dict[str, Any],
+    directory: CargoDirectory,
+    containers: Dict[str, Container],
+) -> None:
+    """Apply one mutation record through the model methods."""
+    op = record["op"]
+    if op == "create":
+        if record["id"] in directory._items:
+            return
+        directory.add(CargoItem.restore(
+            record["id"],
+            sendernam=record["sendernam"],
+            recipnam=record["recipnam"],
+            recipaddr=record["recipaddr"],
+            owner=record["owner"],
+        ))
+    elif op == "handoff_in":
+        if record["id"] in directory._items:
+            return
+        directory.add(CargoItem.restore(
+            record["id"],
+            sendernam=record["sendernam"],
+            recipnam=record["recipnam"],
+            recipaddr=record["recipaddr"],
+            owner=record["owner"],
+            state=record["state"],
+        ))
+    elif op == "handoff_out":
+        item = directory._items.get(record["id"])
+        if item is None:
+            return
+        current = _container_of(item, containers)
+        if current is not None:
+            current.unload([item])
+        directory.remove(record["id"])
+    elif op == "container":
+        if record["cid"] in containers:
+            return
+        containers[record["cid"]] = Container(
+            cid=record["cid"],
+            description=record["description"],
+            type=record["type"],
+            loc=tuple(record["loc"]),
+        )
+    elif op == "load":
+        item = directory.get(record["id"])
+        target = containers[record["cid"]]
+        current = _container_of(item, containers)
+        if current is target:
+            return
+        if current is not None:
+            current.unload([item])
+        target.load([item])
+    elif op == "unload":
+        item = directory.get(record["id"])
+        current = _container_of(item, containers)
+        if current is not None:
+            current.unload([item])
+    elif op == "load_many":
+        target = containers[record["cid"]]
+        items = [directory.get(item_id) for item_id in record["ids"]]
+        for item in items:
+            current = _container_of(item, containers)
+            if current is not None and current is not target:
+                current.unload([item])
+        target.load(items)
+    elif op == "unload_many":
+        for item_id in record["ids"]:
+            item = directory.get(item_id)
+            current = _container_of(item, containers)
+            if current is not None:
+                current.unload([item])
+    elif op == "move":
+        source = containers[record["source"]]
+        target = containers[record["cid"]]
+        source.move([directory.get(item_id) for item_id in record["ids"]], target)
+    elif op == "setloc":
+        containers[record["cid"]].setlocation(*record["loc"])
+    elif op == "complete":
+        directory.get(record["id"]).complete()
+    elif op == "delete":
+        item = directory._items.get(record["id"])
+        if item is None:
+            return
+        current = _container_of(item, containers)
+        if current is not None:
+            current.unload([item])
+        for user in list(directory._attachments.get(record["id"], ())):
+            directory.detach(record["id"], user)
+        directory.delete(record["id"])
+    else:
+        raise ValueError(f"Unknown journal op '{op}'")
+
+
+def _container_of(item: CargoItem, containers: Dict[str, Container]) -> Optional[Container]:
+    cid = item.getContainer()
+    return containers.get(cid) if cid is not None else None
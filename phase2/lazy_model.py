@@ -0,0 +1,366 @@
+"""A model that is read from a mapped binary snapshot as it is used.
+
+``LazyModel(path, locations)`` maps a version 2 ``.bin`` snapshot (see
+``snapshot.MappedSnapshot``) and returns at once: only the container
+locations are read up front, to fill ``locations``.  ``directory`` and
+``containers`` stand in for the ``CargoDirectory`` and the container dict
+of an eagerly loaded model.  A ``CargoItem`` or ``Container`` is built
+from its record the first time it is looked up, and from then on lives in
+memory like any other:
+
+* a container is built together with the items saved in it, so the
+  ``Container._items`` sets and the items' ``_container`` links are
+  complete from the start; looking up such an item builds its container;
+* an item saved outside any container is built on its own;
+* whatever needs every object (``find()``, a full listing, a save)
+  calls ``materialize_all()`` first.
+
+Objects are built under ``lock``, a leaf: it may be taken under the lock
+stripes and under ``CargoDirectory._index_lock``, and nothing is locked
+while holding it.  Objects created or removed after the snapshot are
+tracked in memory; the mapped records are never changed.
+"""
+
+from __future__ import annotations
+
+import gc
+import struct
+from collections.abc import MutableMapping
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from cargo_item import CargoDirectory, CargoItem
+from container import Container
+from snapshot import MappedSnapshot
+from spatial import LocationIndex, point_box
+
+# items built per lock hold by materialize_all(), so lookups are not
+# kept waiting for the whole model
+_BATCH = 4096
+
+
+class _LazyItems(MutableMapping):
+    """``id -> CargoItem`` over the built items and the mapped records."""
+
+    def __init__(self, model: "LazyModel") -> None:
+        self._model = model
+        self._live: Dict[str, CargoItem] = {}
+        # mapped ids removed since the snapshot, and ids it does not have
+        self._gone: Set[str] = set()
+        self._added: Dict[str, None] = {}
+
+    def __getitem__(self, item_id: str) -> CargoItem:
+        item = self._live.get(item_id)
+        if item is None:
+            item = self._model.item(item_id)
+        return item
+
+    def get(self, item_id: str, default: Any = None) -> Any:
+        item = self._live.get(item_id)
+        if item is None:
+            try:
+                item = self._model.item(item_id)
+            except KeyError:
+                return default
+        return item
+
+    def __contains__(self, item_id: object) -> bool:
+        if item_id in self._live:
+            return True
+        model = self._model
+        return (
+            isinstance(item_id, str)
+            and not model.complete
+            and item_id not in self._gone
+            and model.snapshot.find(item_id) is not None
+        )
+
+    def __setitem__(self, item_id: str, item: CargoItem) -> None:
+        with self._model.lock:
+            self._live[item_id] = item
+            if item_id in self._gone:
+                self._gone.discard(item_id)
+            elif item_id not in self._added and self._model.snapshot.find(item_id) is None:
+                self._added[item_id] = None
+
+    def __delitem__(self, item_id: str) -> None:
+        with self._model.lock:
+            if self._live.pop(item_id, None) is None:
+                raise KeyError(item_id)
+            if item_id in self._added:
+                del self._added[item_id]
+            else:
+                self._gone.add(item_id)
+
+    def __iter__(self) -> Iterator[str]:
+        if self._model.complete:
+            return iter(self._live)
+        return self._mapped_ids()
+
+    # once every object is built, _live is the whole directory, in the
+    # order of an eagerly loaded one
+    def items(self) -> Any:
+        return self._live.items() if self._model.complete else super().items()
+
+    def values(self) -> Any:
+        return self._live.values() if self._model.complete else super().values()
+
+    def _mapped_ids(self) -> Iterator[str]:
+        snapshot = self._model.snapshot
+        gone = self._gone
+        for position in range(snapshot.n_items):
+            item_id = snapshot.item_id(position)
+            if item_id not in gone:
+                yield item_id
+        yield from list(self._added)
+
+    def __len__(self) -> int:
+        return self._model.snapshot.n_items - len(self._gone) + len(self._added)
+
+
+class LazyDirectory(CargoDirectory):
+    """A ``CargoDirectory`` whose items are built on first use.
+
+    The sorted id list behind ``page()`` is built the first time it is
+    needed; until then ``_late`` collects the ids added since the snapshot.
+    """
+
+    def __init__(self, model: "LazyModel") -> None:
+        super().__init__()
+        self._model = model
+        self._items = _LazyItems(model)
+        self._sorted: Optional[List[str]] = None
+        self._late: Set[str] = set()
+
+    @property
+    def _order(self) -> List[str]:
+        order = self._sorted
+        if order is None:
+            order = self._model.sorted_ids()
+        return order
+
+    @_order.setter
+    def _order(self, order: List[str]) -> None:
+        self._sorted = order
+
+    def _order_add(self, item_id: str) -> None:
+        with self._model.lock:
+            if self._sorted is None:
+                self._late.add(item_id)
+                return
+        super()._order_add(item_id)
+
+    def _order_remove(self, item_id: str) -> None:
+        with self._model.lock:
+            if self._sorted is None:
+                self._late.discard(item_id)
+                return
+        super()._order_remove(item_id)
+
+    def list(self) -> List[Any]:
+        self._model.materialize_all()
+        return super().list()
+
+    def _build_indexes(self) -> None:
+        # outside the index lock, which mutations wait for
+        self._model.materialize_all()
+        super()._build_indexes()
+
+
+class LazyContainers(MutableMapping):
+    """``cid -> Container`` over the built containers and the mapped ones."""
+
+    def __init__(self, model: "LazyModel") -> None:
+        self._model = model
+        self._live: Dict[str, Container] = {}
+        self._slots: Dict[str, int] = {}
+
+    def __getitem__(self, cid: str) -> Container:
+        container = self._live.get(cid)
+        if container is None:
+            container = self._model.container(cid)
+        return container
+
+    def get(self, cid: str, default: Any = None) -> Any:
+        container = self._live.get(cid)
+        if container is None:
+            if cid not in self._slots:
+                return default
+            container = self._model.container(cid)
+        return container
+
+    def __contains__(self, cid: object) -> bool:
+        return cid in self._live or cid in self._slots
+
+    def __setitem__(self, cid: str, container: Container) -> None:
+        with self._model.lock:
+            self._live[cid] = container
+
+    def __delitem__(self, cid: str) -> None:
+        with self._model.lock:
+            if self._live.pop(cid, None) is None and self._slots.pop(cid, None) is None:
+                raise KeyError(cid)
+            self._slots.pop(cid, None)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self._slots)
+        yield from [cid for cid in list(self._live) if cid not in self._slots]
+
+    def __len__(self) -> int:
+        return len(self._slots) + sum(1 for cid in list(self._live) if cid not in self._slots)
+
+    def added(self) -> List[Container]:
+        """The containers created since the snapshot."""
+        return [container for cid, container in list(self._live.items()) if cid not in self._slots]
+
+
+class LazyModel:
+    """A mapped snapshot plus the objects built from it so far."""
+
+    def __init__(self, path: str, locations: LocationIndex) -> None:
+        self.snapshot = MappedSnapshot(path)
+        self.locations = locations
+        self.lock = Lock()
+        # set once every mapped record has been built
+        self.complete = False
+        self.directory = LazyDirectory(self)
+        self.containers = LazyContainers(self)
+        slots = self.containers._slots
+        try:
+            for slot in range(self.snapshot.n_containers):
+                cid, _description, _type, loc = self.snapshot.container(slot)
+                slots[cid] = slot
+                locations.insert(cid, point_box(loc))
+        except (ValueError, struct.error) as exc:
+            self.snapshot.close()
+            if isinstance(exc, ValueError) and not isinstance(exc, UnicodeDecodeError):
+                raise
+            raise ValueError("corrupt binary snapshot") from None
+
+    def newest_ids(self) -> List[str]:
+        """Candidates for the highest item id: the snapshot's and the new ones."""
+        top = self.snapshot.top_id()
+        return ([top] if top is not None else []) + list(self.directory._items._added)
+
+    def item(self, item_id: str) -> CargoItem:
+        if not isinstance(item_id, str) or self.complete:
+            raise KeyError(item_id)
+        items = self.directory._items
+        with self.lock:
+            item = items._live.get(item_id)
+            if item is not None:
+                return item
+            position = None if item_id in items._gone else self.snapshot.find(item_id)
+            if position is None:
+                raise KeyError(item_id)
+            record = self.snapshot.item(position)
+            cid = record[6]
+            if cid is not None and cid in self.containers._slots and cid not in self.containers._live:
+                self._build_container(self.containers._slots[cid])
+                item = items._live.get(item_id)
+            else:
+                item = self._build_item(record)
+            if item is None:
+                raise KeyError(item_id)
+            return item
+
+    def container(self, cid: str) -> Container:
+        with self.lock:
+            container = self.containers._live.get(cid)
+            if container is None:
+                slot = self.containers._slots.get(cid)
+                if slot is None:
+                    raise KeyError(cid)
+                container = self._build_container(slot)
+            return container
+
+    def _build_container(self, slot: int) -> Container:
+        cid, description, type_, loc = self.snapshot.container(slot)
+        container = Container(cid=cid, description=description, type=type_, loc=loc)
+        # filed in ``locations`` when the model was opened
+        container._space = self.locations
+        self.containers._live[cid] = container
+        items = self.directory._items
+        for record in self.snapshot.items(self.snapshot.members(slot)):
+            if record[0] not in items._live and record[0] not in items._gone:
+                self._build_item(record)
+        return container
+
+    def _build_item(self, record: tuple) -> Optional[CargoItem]:
+        item_id, sendernam, recipnam, recipaddr, owner, state, cid, deleted = record
+        try:
+            item = CargoItem.restore(
+                item_id,
+                sendernam=sendernam,
+                recipnam=recipnam,
+                recipaddr=recipaddr,
+                owner=owner,
+                state=state,
+                deleted=deleted,
+            )
+        except Exception:
+            return None
+        container = self.containers._live.get(cid) if cid is not None else None
+        if container is not None:
+            item._container = container
+            container._items.add(item)
+            container._json = None
+        item._index = self.directory
+        self.directory._items._live[item_id] = item
+        return item
+
+    def materialize_all(self) -> None:
+        """Build every object not built yet, and the sorted id list."""
+        if self.complete:
+            return
+        # as in server.load_state: nothing built here is garbage, and the
+        # cyclic GC would rescan the growing model over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for cid in list(self.containers._slots):
+                self.containers.get(cid)
+            snapshot = self.snapshot
+            live = self.directory._items._live
+            gone = self.directory._items._gone
+            ids = []
+            for start in range(0, snapshot.n_items, _BATCH):
+                with self.lock:
+                    for record in snapshot.items(range(start, min(start + _BATCH, snapshot.n_items))):
+                        ids.append(record[0])
+                        if record[0] not in live and record[0] not in gone:
+                            self._build_item(record)
+            order = self.sorted_ids(ids)
+            with self.lock:
+                # in id order, like the dict of an eagerly loaded directory;
+                # ids being added or removed right now may be missing from
+                # one of the two
+                self.directory._items._live = {
+                    item_id: live[item_id] for item_id in list(order) if item_id in live
+                }
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.complete = True
+
+    def sorted_ids(self, mapped: Optional[List[str]] = None) -> List[str]:
+        """Build the directory's sorted id list, once; ``mapped`` saves
+        decoding the snapshot's ids if the caller already has them."""
+        directory = self.directory
+        items = directory._items
+        with self.lock:
+            if directory._sorted is None:
+                snapshot = self.snapshot
+                gone = items._gone
+                if mapped is None:
+                    mapped = [snapshot.item_id(position) for position in range(snapshot.n_items)]
+                order = mapped
+                if gone:
+                    order = [item_id for item_id in order if item_id not in gone]
+                late = [item_id for item_id in directory._late if snapshot.find(item_id) is None]
+                if late:
+                    order.extend(late)
+                    order.sort()
+                directory._sorted = order
+                directory._late.clear()
+            return directory._sorted
@@ -0,0 +1,90 @@
+"""Lock striping for the shared cargo model.
+
+Lock ordering
+-------------
+Every lock on the model is one of the stripes owned by a ``LockStripes``
+pool.  A model id (container ``cid`` or item tracking id) always maps to the
+same stripe, and several ids may share one.  To avoid deadlocks:
+
+* Take all the stripes an operation needs **at once** through ``hold()``,
+  which acquires them in ascending stripe index.  Never call ``hold()`` for
+  new ids while already holding stripes (re-entering stripes that are
+  already held is fine, they are re-entrant).
+* ``Container.load`` / ``unload`` need the container and every item in the
+  list; ``Container.move`` additionally needs the destination container.
+  When loading or unloading, the item's *current* container must be held as
+  well, since its ``_items`` set changes too.
+* ``Session.cond`` (and any other per-session lock) is a leaf: tracker
+  callbacks take it while stripes are held, so code holding it must never
+  ask for a stripe.
+* ``CargoDirectory._index_lock`` guards the secondary indexes and the
+  sorted id list; it is a leaf as well, since item mutations take it while
+  their stripes are held.
+* The ``spatial.GridIndex`` locks (container locations, tracker views) are
+  leaves too: ``setlocation`` takes them under the container's stripe.
+* ``server._parking_lock`` (trackers of closed sessions) is taken by
+  tracker callbacks under stripes; only the ``EventRing`` lock may be taken
+  under it.  The ring lock is a leaf; sessions take it under ``cond``.
+* ``versions._open_lock`` (the list of open snapshots) is a leaf, taken
+  under every stripe by ``open_snapshot``.
+* ``server._save_lock`` serializes saves and is taken before any stripe;
+  never ask for it while holding one.
+* ``cargo_store.CargoStore._tables_lock`` (new rows, string and container
+  codes) is a leaf, taken by ``add()`` and by item mutations under their
+  stripes.
+* ``journal.Journal._lock`` (the buffer of unwritten records) is a leaf,
+  taken by ``append()`` under the stripes of every mutation.  The journal
+  file is written and synced under ``Journal._write_lock`` alone, which is
+  taken before ``_lock`` and never waits for a stripe.
+* ``lazy_model.LazyModel.lock`` guards building objects from a mapped
+  snapshot.  It is a leaf, taken by lookups under stripes and under
+  ``CargoDirectory._index_lock``.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from threading import RLock
+from typing import Any, Iterator, List
+
+
+class LockStripes:
+    """A fixed pool of re-entrant locks indexed by model id."""
+
+    def __init__(self, size: int = 64) -> None:
+        if size < 1:
+            raise ValueError("size must be positive")
+        self._locks: List[RLock] = [RLock() for _ in range(size)]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def index(self, key: Any) -> int:
+        """Return the stripe index guarding ``key``."""
+        return hash(key) % len(self._locks)
+
+    @contextmanager
+    def hold(self, *keys: Any) -> Iterator[None]:
+        """Hold the stripes for ``keys`` (``None`` entries are ignored)."""
+        indices = sorted({self.index(key) for key in keys if key is not None})
+        with self._acquire(indices):
+            yield
+
+    @contextmanager
+    def hold_all(self) -> Iterator[None]:
+        """Hold every stripe, for operations that need the whole model."""
+        with self._acquire(range(len(self._locks))):
+            yield
+
+    @contextmanager
+    def _acquire(self, indices: Any) -> Iterator[None]:
+        acquired: List[RLock] = []
+        try:
+            for idx in indices:
+                lock = self._locks[idx]
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
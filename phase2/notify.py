@@ -0,0 +1,101 @@
+"""Deferred, aggregated notification of container updates.
+
+``Container.updated(batch=...)`` calls no tracker: it records the container,
+its location, the tracker filter and a copy of its tracker and item sets
+in an ``UpdateBatch``.  The copies are single C-level passes, so the time spent
+under the container's lock stripe no longer pays for a Python callback,
+an event record and a condition wakeup per contained item.
+
+Bulk ``load``/``unload``/``move`` record their items through
+``CargoItem.setContainer(batch=...)``: consecutive items placed under the
+same container share one entry, so loading thousands of items notifies
+each of their trackers once.
+
+``deliver()`` runs once the caller has released its stripes.  It groups the
+affected items by tracker and makes one call per tracker,
+``tracker.batch_updated(container, items, loc)``, where ``items`` are the
+contained items that tracker watches and ``loc`` is where the container was
+when the update was recorded: it may have moved again since.  Watchers without ``batch_updated``
+get the usual one ``updated()`` call per object.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# (container, tracker filter, container trackers or None, items, location)
+Update = Tuple[Any, Optional[Callable[[Any], bool]], Optional[Tuple[Any, ...]], Sequence[Any], Any]
+
+
+class UpdateBatch:
+    """Container updates recorded under the model locks, delivered after."""
+
+    def __init__(self) -> None:
+        self._updates: List[Update] = []
+
+    def __len__(self) -> int:
+        return len(self._updates)
+
+    def add(self, container: Any, interested: Optional[Callable[[Any], bool]] = None) -> None:
+        """Record an update of ``container``; the caller holds its stripe."""
+        trackers = tuple(container._trackers or ())
+        items = () if container._deleted else tuple(container._items)
+        self._updates.append((container, interested, trackers, items, container.loc))
+
+    def add_item(self, item: Any, container: Any) -> None:
+        """Record that ``item`` was placed in or taken out of ``container``.
+
+        Only the item's trackers are told, as ``setContainer`` would."""
+        updates = self._updates
+        if updates and updates[-1][0] is container and updates[-1][2] is None:
+            updates[-1][3].append(item)
+        else:
+            updates.append((container, None, None, [item], container.loc))
+
+    def deliver(self) -> None:
+        """Notify every interested tracker once per recorded update.
+
+        Must be called without holding any lock stripe.  A tracker that
+        fails (or was deleted meanwhile) does not stop the others.
+        """
+        updates, self._updates = self._updates, []
+        for container, interested, trackers, items, loc in updates:
+            watchers = trackers or ()
+            for tracker, affected in _group(watchers, items).items():
+                if interested is not None and not interested(tracker):
+                    continue
+                try:
+                    _notify(tracker, container, tracker in watchers, affected, loc)
+                except Exception:
+                    pass
+
+
+def _group(trackers: Tuple[Any, ...], items: Sequence[Any]) -> Dict[Any, List[Any]]:
+    groups: Dict[Any, List[Any]] = {tracker: [] for tracker in trackers}
+    for item in items:
+        watchers = getattr(item, "_trackers", None)
+        if not watchers:
+            continue
+        for tracker in tuple(watchers):
+            group = groups.get(tracker)
+            if group is None:
+                group = groups[tracker] = []
+            group.append(item)
+    return groups
+
+
+def _notify(tracker: Any, container: Any, watches_container: bool, items: List[Any], loc: Any) -> None:
+    batch_updated = getattr(tracker, "batch_updated", None)
+    if batch_updated is not None:
+        batch_updated(container, items, loc)
+        return
+    if watches_container:
+        try:
+            tracker.updated(container)
+        except TypeError:
+            tracker.updated()
+    for item in items:
+        try:
+            tracker.updated(item)
+        except TypeError:
+            tracker.updated()
@@ -0,0 +1,57 @@
+"""Pieces of the text protocol shared by the server and the shard router.
+
+A request line may start with an id, ``#<id> STATUS CI00000001``; every
+line of its answer then starts with the same id.  ``HANDOFF_OUT`` and
+``HANDOFF_IN`` pass an item between shards as one whitespace-free
+argument, its record as base64 JSON.  The router imports these from here
+rather than from ``server``, whose import builds a whole model.
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+# the page size of a listing, and the chunk size of a stream, without a limit
+DEFAULT_PAGE = 100
+
+
+def split_tag(line: str) -> Tuple[Optional[str], str]:
+    """Split an optional ``#<id>`` request id off a request line."""
+    if not line.startswith('#'):
+        return None, line
+    tag, _, rest = line.partition(' ')
+    return tag, rest.strip()
+
+
+def response_lines(resp: Union[str, Iterable[str]]) -> Iterator[str]:
+    """Responses are a line, or an iterator of lines for streamed listings."""
+    if isinstance(resp, str):
+        yield resp
+    else:
+        try:
+            yield from resp
+        except Exception as e:
+            yield 'ERR ' + str(e)
+
+
+def tagged(tag: Optional[str], resp: Union[str, Iterable[str]]) -> Union[str, Iterable[str]]:
+    """Prefix every line of a response with the request id, if any."""
+    if tag is None:
+        return resp
+    if isinstance(resp, str):
+        return f'{tag} {resp}'
+    return (f'{tag} {line}' for line in response_lines(resp))
+
+
+def encode_record(record: Dict[str, Any]) -> str:
+    # one whitespace-free argument for the text protocol
+    return base64.urlsafe_b64encode(json.dumps(record).encode('utf-8')).decode('ascii')
+
+
+def decode_record(text: str) -> Dict[str, Any]:
+    try:
+        return json.loads(base64.urlsafe_b64decode(text.encode('ascii')))
+    except ValueError:
+        raise ValueError('Malformed item record') from None
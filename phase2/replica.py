@@ -0,0 +1,207 @@
+"""Primary/replica replication of the model's mutation stream.
+
+A primary started with ``--replication-port`` publishes every mutation
+record (the records ``server._record`` journals, see ``journal.py``) to the
+replicas connected to that port.  A replica (``--replica-of host:port``)
+keeps its own copy of the model, applies the records with
+``journal.apply_record`` and serves the read-only commands and watches;
+its trackers fire as the records are applied, so watchers get the usual
+events.
+
+The stream is newline-delimited JSON, primary to replica::
+
+    ["container", [cid, description, type, [lon, lat]]]    snapshot records,
+    ["item", [id, sender, recipient, ..., deleted]]         as in snapshot.py
+    {"op": "synced"}                                        end of the snapshot
+    {"op": "load", "id": ..., "cid": ...}                   mutation records
+
+The snapshot is opened (copy-on-write, see ``versions.py``) and the
+replica subscribed with every stripe held for that instant, so no mutation
+falls between the two; the snapshot records are read afterwards, while
+writers carry on.  A replica that falls more than
+``backlog`` records behind is dropped; it reconnects and starts over from
+a fresh snapshot, as it does after any lost connection.
+"""
+
+from __future__ import annotations
+
+import json
+from collections import deque
+from socket import AF_INET, SOCK_STREAM, create_connection, socket
+from threading import Condition, Event, Lock, Thread
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+Record = Dict[str, Any]
+
+REPLICA_BACKLOG = 100000
+# snapshot records per write while a replica syncs
+SNAPSHOT_CHUNK = 1024
+
+
+class Feed:
+    """The records published for one replica and not yet sent to it."""
+
+    def __init__(self, backlog: int = REPLICA_BACKLOG) -> None:
+        self.backlog = backlog
+        self.overflowed = False
+        self._cond = Condition()
+        self._records: Deque[Record] = deque()
+        self._closed = False
+
+    def push(self, record: Record) -> None:
+        with self._cond:
+            if self.overflowed or self._closed:
+                return
+            if len(self._records) >= self.backlog:
+                # the replica resyncs rather than miss a record
+                self.overflowed = True
+                self._records.clear()
+            else:
+                self._records.append(record)
+            self._cond.notify()
+
+    def take(self, timeout: Optional[float] = None) -> Optional[List[Record]]:
+        """Wait for records and return all of them; ``None`` once the feed
+        overflowed or was closed."""
+        with self._cond:
+            while not self._records and not (self.overflowed or self._closed):
+                if not self._cond.wait(timeout):
+                    return []
+            if self.overflowed or self._closed:
+                return None
+            records = list(self._records)
+            self._records.clear()
+            return records
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+
+class ReplicationHub:
+    """Fans the primary's mutation records out to the connected replicas."""
+
+    def __init__(self, backlog: int = REPLICA_BACKLOG) -> None:
+        self.backlog = backlog
+        self._lock = Lock()
+        self._feeds: List[Feed] = []
+
+    def __len__(self) -> int:
+        return len(self._feeds)
+
+    def publish(self, record: Record) -> None:
+        # called under the stripes of the mutated objects, like the journal;
+        # records are encoded by the sending threads, not here
+        if not self._feeds:
+            return
+        with self._lock:
+            for feed in self._feeds:
+                feed.push(record)
+
+    def subscribe(self) -> Feed:
+        feed = Feed(self.backlog)
+        with self._lock:
+            self._feeds.append(feed)
+        return feed
+
+    def unsubscribe(self, feed: Feed) -> None:
+        with self._lock:
+            if feed in self._feeds:
+                self._feeds.remove(feed)
+        feed.close()
+
+
+def serve_replication(port: int, snapshot: Callable[[], Tuple[Feed, List[Tuple[str, tuple]]]],
+                      hub: ReplicationHub) -> Thread:
+    """Accept replicas on ``port`` in a daemon thread.
+
+    ``snapshot()`` returns a new feed and the snapshot records it follows.
+    """
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('', port))
+    listener.listen(16)
+
+    def accept_loop() -> None:
+        while True:
+            conn, _ = listener.accept()
+            Thread(target=_send_stream, args=(conn, snapshot, hub), daemon=True).start()
+
+    thread = Thread(target=accept_loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def _send_stream(conn: socket, snapshot: Callable[[], Tuple[Feed, List[Tuple[str, tuple]]]],
+                 hub: ReplicationHub) -> None:
+    feed, records = snapshot()
+    try:
+        for start in range(0, len(records), SNAPSHOT_CHUNK):
+            chunk = records[start:start + SNAPSHOT_CHUNK]
+            conn.sendall(''.join(json.dumps(record) + '\n' for record in chunk).encode('utf-8'))
+        conn.sendall(b'{"op": "synced"}\n')
+        while True:
+            batch = feed.take()
+            if batch is None:
+                break
+            if batch:
+                conn.sendall(''.join(json.dumps(record) + '\n' for record in batch).encode('utf-8'))
+    except OSError:
+        pass
+    finally:
+        hub.unsubscribe(feed)
+        conn.close()
+
+
+def follow(address: Tuple[str, int], install: Callable[[List[Tuple[str, tuple]]], None],
+           apply: Callable[[List[Record]], None], stop: Optional[Event] = None,
+           retry_delay: float = 1.0, recv_size: int = 65536) -> None:
+    """Mirror the primary at ``address`` until ``stop`` is set.
+
+    ``install`` receives the snapshot records of every (re)connection and
+    replaces the model; ``apply`` receives the mutation records of one read.
+    A stream that cannot be decoded or applied is dropped like a lost
+    connection: the next one installs a fresh snapshot.
+    """
+    stop = stop or Event()
+    while not stop.is_set():
+        try:
+            with create_connection(address) as conn:
+                _follow(conn, install, apply, recv_size)
+        except OSError as exc:
+            print(f'WARN: replication from {address[0]}:{address[1]} failed: {exc}')
+        except (ValueError, KeyError, TypeError, IndexError) as exc:
+            print(f'WARN: bad replication stream from {address[0]}:{address[1]} ({exc!r}); resyncing')
+        stop.wait(retry_delay)
+
+
+def _follow(conn: socket, install: Callable[[List[Tuple[str, tuple]]], None],
+            apply: Callable[[List[Record]], None], recv_size: int) -> None:
+    buffer = b''
+    snapshot: Optional[List[Tuple[str, tuple]]] = []
+    while True:
+        data = conn.recv(recv_size)
+        if not data:
+            return
+        buffer += data
+        end = buffer.rfind(b'\n') + 1
+        if not end:
+            continue
+        lines, buffer = buffer[:end].decode('utf-8').split('\n'), buffer[end:]
+        records = []
+        for line in lines:
+            if not line:
+                continue
+            entry = json.loads(line)
+            if snapshot is None:
+                records.append(entry)
+            elif isinstance(entry, dict):
+                install(snapshot)
+                snapshot = None
+            else:
+                kind, fields = entry
+                if kind == 'container':
+                    fields[3] = tuple(fields[3])
+                snapshot.append((kind, tuple(fields)))
+        if records:
+            apply(records)
@@ -1,182 +1,672 @@
-from threading import Thread, RLock, Condition
-from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread, Condition, Event, Lock
+from contextlib import contextmanager
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR, IPPROTO_TCP, TCP_NODELAY
 from itertools import count
+from bisect import bisect_right
+from weakref import WeakSet
+import argparse
+import asyncio
+import gc
 import sys
 import json
 import time
 import os
+import re
+import secrets
 
 # import library classes
 from cargo_item import CargoDirectory, CargoItem
+from cargo_store import CargoStore
 from container import Container
 from tracker import Tracker
+from locks import LockStripes
+from notify import UpdateBatch
+from event_queue import POLICIES, EventQueue, EventRing
+from spatial import GridIndex, LocationIndex, view_box
+import wire
+from protocol import DEFAULT_PAGE, decode_record, encode_record, response_lines, split_tag, tagged
+from journal import Compactor, Journal, apply_record, journal_path, journal_segments, replay
+from replica import ReplicationHub, follow, serve_replication
+from autosave import Autosaver
+from lazy_model import LazyDirectory, LazyModel
+from versions import open_snapshot
+from snapshot import (
+    container_record, is_binary_snapshot, item_record, iter_binary_records,
+    iter_json_records, write_binary_snapshot, write_json_snapshot,
+)
 
-# Shared model
-_model_lock = RLock()
-_directory = CargoDirectory()
+# Shared model; see locks.py for the lock ordering rules
+_locks = LockStripes()
+# item storage engine: CargoDirectory (objects) or CargoStore (columnar)
+_directory_class = CargoDirectory
+_directory = _directory_class()
 _containers = {}
+# tracker views outlive reloads; container locations are rebuilt with them
+_views = GridIndex()
+_locations = LocationIndex(_views)
 tracker_sequence = count(1)
+# every session's tracker, parked ones included, for _install to re-attach
+_session_trackers = WeakSet()
 STATE_FILE = 'server_state.json'
+# listings serialize LIST_CHUNK objects per lock acquisition; pages and
+# stream chunks default to DEFAULT_PAGE (protocol.py) objects
+LIST_CHUNK = 256
+MAX_PAGE = 10000
+# pending events per session and what to do when a slow client fills them
+EVENT_QUEUE_LIMIT = 10000
+EVENT_QUEUE_POLICY = 'coalesce'
+# bytes per socket read and longest request line (or binary frame) accepted; a pipelined
+# batch of responses is written out whenever it reaches PIPELINE_FLUSH bytes
+RECV_SIZE = 65536
+MAX_LINE = 65536
+PIPELINE_FLUSH = 65536
+# WAIT_EVENTS <timeout> waits at most MAX_WAIT seconds
+MAX_WAIT = 60.0
+# every event gets the next global seq; once out of its session's queue it
+# is kept in _ring (EVENT_RING_SIZE events of all sessions) for SINCE/RESUME
+EVENT_RING_SIZE = 50000
+_event_seq = count(1)
+_ring = EventRing(EVENT_RING_SIZE)
+# trackers of closed sessions stay registered RESUME_GRACE seconds, their
+# events going to the ring, so a client can RESUME (0: delete on close)
+RESUME_GRACE = 60.0
+_parked = {}
+_parking_lock = Lock()
+# the thread that releases parked trackers when their grace period ends
+_reaper = None
+_reaper_wake = Event()
+# seconds the notification agents wait after the first event of a burst,
+# so that one write carries the whole burst (0: write right away)
+EVENT_FLUSH_DELAY = 0.0
+# snapshot used by SAVE; '.bin' paths select the binary format
+_state_path = STATE_FILE
+# map a binary snapshot at startup and build objects as they are used
+# (lazy_model.py) instead of reading it through
+_lazy_load = False
+# (index, count) when running as one shard of a sharded deployment
+# (shard.py); item ids are then interleaved so each shard's are unique
+_shard = None
 
+# Write-ahead journal; None until enable_journal() is called
+_journal = None
+_compactor = None
+# replication (replica.py): the hub publishing our mutations on a primary,
+# and whether this server is a read-only replica of one
+_replication = None
+_read_only = False
+# one save at a time (SAVE, autosave, compaction, shutdown); taken before
+# any stripe.  _save_stats describes the last one that completed
+_save_lock = Lock()
+_save_stats = {'saves': 0, 'last_seconds': None, 'last_bytes': None, 'last_at': None, 'last_error': None}
+# background saves by time and by number of mutations; None when off
+_autosaver = None
 
-def save_state(path=STATE_FILE):
-    with _model_lock:
-        items = [json.loads(payload) for _, payload in _directory.list()]
-        containers = [json.loads(cont.get()) for cont in _containers.values()]
-    data = {
-        'items': items,
-        'containers': containers,
-    }
-    try:
-        with open(path, 'w', encoding='utf-8') as handle:
-            json.dump(data, handle, indent=2)
-    except OSError as exc:
-        print(f'WARN: failed to save state: {exc}')
 
+def enable_journal(path=None, compact_interval=60.0):
+    global _journal, _compactor
+    path = path or _state_path
+    _journal = Journal(journal_path(path))
+    _compactor = Compactor(_journal, lambda: save_state(path), interval=compact_interval)
+    _compactor.start()
 
-def load_state(path=STATE_FILE):
-    if not os.path.exists(path):
-        return
-    try:
-        with open(path, 'r', encoding='utf-8') as handle:
-            data = json.load(handle)
-    except (OSError, json.JSONDecodeError) as exc:
-        print(f'WARN: failed to load state: {exc}')
+
+def close_journal():
+    global _journal, _compactor
+    if _compactor is not None:
+        # a compaction under way finishes before the journal closes
+        _compactor.stop()
+        _compactor.join()
+    if _journal is not None:
+        _journal.close()
+    _journal = None
+    _compactor = None
+
+
+def _record(op, **fields):
+    # callers hold the stripes of the mutated objects, so per-object
+    # records reach the journal in the order they were applied
+    if _journal is not None:
+        _journal.append(op, **fields)
+    if _replication is not None:
+        _replication.publish(dict(fields, op=op))
+    if _autosaver is not None:
+        _autosaver.mutated()
+
+
+def save_state(path=None):
+    """Write a snapshot of the model to ``path`` through a temp file.
+
+    Returns False if it could not be written; the error is printed and
+    kept in ``_save_stats``.
+    """
+    path = path or _state_path
+    with _save_lock:
+        start = time.perf_counter()
+        try:
+            written = _write_state(path)
+        except OSError as exc:
+            print(f'WARN: failed to save state: {exc}')
+            _save_stats['last_error'] = str(exc)
+            return False
+        _save_stats['saves'] += 1
+        _save_stats['last_seconds'] = round(time.perf_counter() - start, 3)
+        _save_stats['last_bytes'] = written
+        _save_stats['last_at'] = time.time()
+        _save_stats['last_error'] = None
+    return True
+
+
+def _write_state(path):
+    """Returns the size of the snapshot written."""
+    binary = is_binary_snapshot(path)
+    journal = _journal if _journal is not None and _journal.path == journal_path(path) else None
+    _materialize()
+    with _locks.hold_all():
+        snapshot = open_snapshot(_directory, _containers)
+        if journal is not None:
+            # everything journaled so far is covered by this snapshot
+            journal.rotate()
+    # serialized outside the global hold: writers carry on, and the
+    # snapshot keeps a copy of what they change
+    with snapshot:
+        if binary:
+            items = _read_items(snapshot.item_ids, snapshot, item_record)
+            containers = _read_containers(snapshot.cids, snapshot, container_record)
+        else:
+            items = _read_items(snapshot.item_ids, snapshot)
+            containers = _read_containers(snapshot.cids, snapshot)
+    tmp_path = path + '.tmp'
+    handle = open(tmp_path, 'wb') if binary else open(tmp_path, 'w', encoding='utf-8')
+    with handle:
+        if binary:
+            write_binary_snapshot(handle, containers, items)
+        else:
+            write_json_snapshot(handle, containers, items)
+        handle.flush()
+        # on disk before the rename makes it the snapshot
+        os.fsync(handle.fileno())
+        written = os.fstat(handle.fileno()).st_size
+    os.replace(tmp_path, path)
+    if journal is not None:
+        journal.discard_rotated()
+    return written
+
+
+def load_state(path=None):
+    path = path or _state_path
+    segments = journal_segments(path)
+    if not os.path.exists(path) and not segments:
         return
 
-    items_data = data.get('items', [])
-    containers_data = data.get('containers', [])
+    if _lazy_load and is_binary_snapshot(path) and os.path.exists(path):
+        try:
+            model = LazyModel(path, LocationIndex(_views))
+        except (OSError, ValueError) as exc:
+            print(f'WARN: cannot map {path} ({exc}); reading it in full')
+        else:
+            for segment in segments:
+                replay(segment, model.directory, model.containers)
+            for cont in model.containers.added():
+                model.locations.add(cont)
+            _install(model.directory, model.containers, model.locations, model.newest_ids())
+            return
 
-    new_directory = CargoDirectory()
-    new_directory._items.clear()
-    new_directory._attachments.clear()
+    new_directory = _directory_class()
     new_containers = {}
+    # the cyclic GC would rescan the growing model over and over while
+    # millions of objects are allocated; nothing built here is garbage
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if os.path.exists(path):
+            try:
+                if is_binary_snapshot(path):
+                    with open(path, 'rb') as handle:
+                        _load_records(iter_binary_records(handle), new_directory, new_containers)
+                else:
+                    with open(path, 'r', encoding='utf-8') as handle:
+                        _load_records(iter_json_records(handle), new_directory, new_containers)
+            except (OSError, ValueError) as exc:
+                print(f'WARN: failed to load state: {exc}')
+                return
+
+        # replay the journal tail on top of the snapshot
+        for segment in segments:
+            replay(segment, new_directory, new_containers)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    _install(new_directory, new_containers)
+
+
+def _install(new_directory, new_containers, new_locations=None, item_ids=None, rewatch=False):
+    """Swap in a model built off to the side.
+
+    ``item_ids`` (default: every id) must include the highest one.  With
+    ``rewatch``, the sessions' trackers move to the new objects, by id.
+    """
+    max_id = 0
+    for saved_id in new_directory._items if item_ids is None else item_ids:
+        try:
+            idx = int(saved_id[2:]) if saved_id.startswith('CI') else 0
+        except ValueError:
+            idx = 0
+        max_id = max(max_id, idx)
+
+    if new_locations is None:
+        new_locations = LocationIndex(_views)
+        for cont in new_containers.values():
+            new_locations.add(cont)
+
+    # the new model is private until here, so only the swap needs the locks
+    with _locks.hold_all():
+        CargoItem._id_sequence = _id_sequence_after(max_id)
+        global _directory, _containers, _locations
+        _directory = new_directory
+        _containers = new_containers
+        _locations = new_locations
+        if rewatch:
+            for tracker in list(_session_trackers):
+                tracker.rebind(new_directory._items.get, new_containers.get)
+
+
+def _materialize():
+    """Build a lazily loaded model in full before something reads all of it."""
+    # outside every stripe: building takes a while, and only lookups of
+    # objects not built yet wait for it
+    if isinstance(_directory, LazyDirectory):
+        _directory._model.materialize_all()
+
+
+def _id_sequence_after(last_id):
+    """Item id numbers after ``last_id``; a shard only draws its own."""
+    start = last_id + 1
+    if _shard is None:
+        return count(start)
+    index, shards = _shard
+    start += (index + 1 - start) % shards
+    return count(start, shards)
+
 
-    with _model_lock:
-        # build containers first
-        for cont_payload in containers_data:
+def _load_records(records, directory, containers):
+    """Rebuild the model from normalized snapshot records in a single pass.
+
+    Snapshots written by save_state() list containers first, so every item
+    is linked as soon as it is read; items that name a container not seen
+    yet (older JSON snapshots) are linked once all records are in.
+    """
+    unlinked = []
+    for kind, fields in records:
+        if kind == 'container':
+            cid, description, type_, loc = fields
             try:
-                cont = Container(
-                    cid=cont_payload['cid'],
-                    description=cont_payload['description'],
-                    type=cont_payload['type'],
-                    loc=tuple(cont_payload['loc']),
-                )
+                cont = Container(cid=cid, description=description, type=type_, loc=loc)
             except Exception:
                 continue
-            cont._items.clear()
-            new_containers[cont.cid] = cont
-
-        max_id = 0
-        for item_payload in items_data:
+            containers[cid] = cont
+        else:
+            item_id, sendernam, recipnam, recipaddr, owner, state, container_id, deleted = fields
             try:
-                item = CargoItem(
-                    sendernam=item_payload['sendernam'],
-                    recipnam=item_payload['recipnam'],
-                    recipaddr=item_payload['recipaddr'],
-                    owner=item_payload['owner'],
+                item = CargoItem.restore(
+                    item_id,
+                    sendernam=sendernam,
+                    recipnam=recipnam,
+                    recipaddr=recipaddr,
+                    owner=owner,
+                    state=state,
+                    deleted=deleted,
                 )
             except Exception:
                 continue
-            # overwrite auto id with saved id
-            auto_id = item.trackingId()
-            new_directory._items.pop(auto_id, None)
-            saved_id = item_payload.get('id', auto_id)
-            item._tracking_id = saved_id
-            item.state = item_payload.get('state', item.state)
-            item._deleted = item_payload.get('deleted', False)
-            item._container = None
-            item._container_id = None
-            item._trackers = set()
-            new_directory._items[saved_id] = item
+            container = containers.get(container_id) if container_id else None
+            if container is not None:
+                # set before add() so the item is indexed under its container once
+                item._container = container
+            item = directory.add(item)
+            if container is not None:
+                container._items.add(item)
+                container._json = None
+            elif container_id:
+                unlinked.append((item, container_id))
+
+    for item, container_id in unlinked:
+        container = containers.get(container_id)
+        if container is not None:
+            _link(directory, item, container)
+
+
+def _link(directory, item, container):
+    keys = item._index_keys()
+    container._items.add(item)
+    container._json = None
+    item._container = container
+    directory._reindex(item, keys)
+
+
+def _replication_snapshot():
+    """Subscribe a new replica; returns its feed and the records it follows."""
+    _materialize()
+    # no mutation can be recorded while every stripe is held, so the feed
+    # starts exactly where the snapshot ends; the records are read after,
+    # from the copy-on-write snapshot, while writers carry on
+    with _locks.hold_all():
+        snapshot = open_snapshot(_directory, _containers)
+        feed = _replication.subscribe()
+    with snapshot:
+        records = [('container', record) for record in _read_containers(snapshot.cids, snapshot, container_record)]
+        records.extend(('item', record) for record in _read_items(snapshot.item_ids, snapshot, item_record))
+    return feed, records
+
 
+def _install_replica(records):
+    new_directory = _directory_class()
+    new_containers = {}
+    _load_records(records, new_directory, new_containers)
+    # a replica resyncs while serving, and its watches must keep firing
+    _install(new_directory, new_containers, rewatch=True)
+
+
+def _apply_replicated(records):
+    """Apply the primary's mutation records of one read, in order."""
+    # one hold_all per read: records are small, and readers only wait
+    # between batches
+    with _locks.hold_all():
+        for record in records:
+            new = record['op'] == 'container' and record['cid'] not in _containers
             try:
-                idx = int(saved_id[2:]) if saved_id.startswith('CI') else 0
-            except ValueError:
-                idx = 0
-            max_id = max(max_id, idx)
-
-        # restore container assignments
-        for item_payload in items_data:
-            item_id = item_payload.get('id')
-            container_id = item_payload.get('container')
-            if not item_id or not container_id:
-                continue
-            item = new_directory._items.get(item_id)
-            container = new_containers.get(container_id)
-            if item is None or container is None:
+                apply_record(record, _directory, _containers)
+            except (KeyError, ValueError, RuntimeError, TypeError):
                 continue
-            container._items.add(item)
-            item._container = container
-            item._container_id = container_id
+            if new:
+                _locations.add(_containers[record['cid']])
 
-        CargoItem._id_sequence = count(max_id + 1)
 
-        global _directory, _containers
-        _directory = new_directory
-        _containers = new_containers
+@contextmanager
+def _hold_item(item_id, *cids):
+    """Hold the stripes of an item, its current container and ``cids``.
 
+    Yields the item (or ``None`` if unknown).  The item's container is read
+    before locking, so the lookup is retried if it changed in between.
+    """
+    while True:
+        item = _directory._items.get(item_id)
+        current = item.getContainer() if item is not None else None
+        with _locks.hold(item_id, current, *cids):
+            if item is None or item.getContainer() == current:
+                yield item
+                return
 
-class Session(Thread):
-    def __init__(self, sock):
-        super().__init__()
-        self.socket = sock
+
+@contextmanager
+def _hold_items(item_ids, *cids):
+    """``_hold_item`` for several items, under one ``hold()``.
+
+    Yields the items in order (``None`` for unknown ids).
+    """
+    while True:
+        items = [_directory._items.get(item_id) for item_id in item_ids]
+        current = [item.getContainer() if item is not None else None for item in items]
+        with _locks.hold(*item_ids, *current, *cids):
+            if all(item is None or item.getContainer() == cid for item, cid in zip(items, current)):
+                yield items
+                return
+
+
+def _known(item_ids, items):
+    missing = [item_id for item_id, item in zip(item_ids, items) if item is None]
+    if missing:
+        raise KeyError('Unknown item ' + missing[0])
+
+
+def _read_items(item_ids=None, snapshot=None, serialize=CargoItem.get):
+    """Serialize items, holding the stripes of one chunk at a time.
+
+    With a ``versions.Snapshot``, items are read as they were when it was
+    opened.
+    """
+    if item_ids is None:
+        item_ids = list(_directory._items)
+    lookup = _directory._items.get if snapshot is None else snapshot.item
+    payloads = []
+    for start in range(0, len(item_ids), LIST_CHUNK):
+        chunk = item_ids[start:start + LIST_CHUNK]
+        with _locks.hold(*chunk):
+            for item_id in chunk:
+                item = lookup(item_id)
+                if item is not None:
+                    payloads.append(serialize(item))
+    return payloads
+
+
+def _read_containers(cids=None, snapshot=None, serialize=Container.get):
+    """Serialize containers, holding the stripes of one chunk at a time."""
+    if cids is None:
+        cids = list(_containers)
+    lookup = _containers.get if snapshot is None else snapshot.container
+    payloads = []
+    for start in range(0, len(cids), LIST_CHUNK):
+        chunk = cids[start:start + LIST_CHUNK]
+        with _locks.hold(*chunk):
+            for cid in chunk:
+                cont = lookup(cid)
+                if cont is not None:
+                    payloads.append(serialize(cont))
+    return payloads
+
+
+def _open_snapshot():
+    _materialize()
+    # no mutation is half done while every stripe is held
+    with _locks.hold_all():
+        return open_snapshot(_directory, _containers)
+
+
+def _snapshot_stream(label, chunk):
+    """``_stream_listing`` over a snapshot opened when the first chunk is read."""
+    with _open_snapshot() as snapshot:
+        if label == 'ITEMS':
+            page, read = snapshot.page_items, lambda ids: _read_items(ids, snapshot)
+        else:
+            page, read = snapshot.page_containers, lambda cids: _read_containers(cids, snapshot)
+        yield from _stream_listing(label, page, read, chunk)
+
+
+def _page_containers(after=None, limit=DEFAULT_PAGE):
+    # containers are few, so sorting per page is cheap
+    order = sorted(_containers)
+    start = 0 if after is None else bisect_right(order, after)
+    cids = order[start:start + limit]
+    more = start + limit < len(order)
+    return cids, (cids[-1] if more and cids else None)
+
+
+def _parse_page(cmd, args):
+    """Return ``(cursor, limit)`` from ``<cursor> [limit]``; '-' is the start."""
+    if len(args) > 2:
+        raise ValueError(f'Usage: {cmd} [cursor|-] [limit] or {cmd} STREAM [chunk]')
+    cursor = None if args[0] == '-' else args[0]
+    limit = _parse_limit(cmd, args[1:])
+    return cursor, limit
+
+
+def _parse_limit(cmd, args):
+    if not args:
+        return DEFAULT_PAGE
+    try:
+        limit = int(args[0])
+    except ValueError:
+        raise ValueError(f'{cmd}: limit must be an integer') from None
+    if not 1 <= limit <= MAX_PAGE:
+        raise ValueError(f'{cmd}: limit must be between 1 and {MAX_PAGE}')
+    return limit
+
+
+def _json_array(payloads):
+    # payloads are already JSON, so join them instead of re-encoding
+    return '[' + ', '.join(payloads) + ']'
+
+
+def _stream_listing(label, page, read, chunk):
+    """Yield one ``<label> [...]`` line per chunk, then ``OK <count>``.
+
+    Each chunk is paged and serialized only when the session asks for the
+    next line, so stripes are held for one chunk at a time and the client
+    can process the first chunk before the last one exists.
+    """
+    cursor = None
+    total = 0
+    while True:
+        keys, cursor = page(cursor, chunk)
+        payloads = read(keys)
+        if payloads:
+            total += len(payloads)
+            yield wire.JsonLine(f'{label} ' + _json_array(payloads))
+        if cursor is None:
+            break
+    yield f'OK {total}'
+
+
+# a PROTO request line; input after it may be in the other framing
+_PROTO_LINE = re.compile(rb'^[ \t]*(?:#\S*[ \t]+)?proto\b', re.IGNORECASE | re.MULTILINE)
+# answered on their own: a long poll must not hold back the answers queued
+# before it, and the answer to PROTO goes out in the old framing
+_BLOCKING = ('WAIT_EVENTS', 'PROTO')
+# refused by a read-only replica; its model only changes through the primary
+_WRITES = frozenset(('CREATE_ITEM', 'CREATE_CONTAINER', 'LOAD', 'LOAD_MANY', 'UNLOAD', 'UNLOAD_MANY',
+                     'MOVE', 'COMPLETE', 'SETLOC', 'HANDOFF_OUT', 'HANDOFF_IN', 'SAVE'))
+
+
+class CommandSession:
+    """Protocol state for one client, shared by the threaded and asyncio servers.
+
+    Requests may carry a request id, ``#42 STATUS CI00000001``, which is
+    echoed in front of every line of the answer (``#42 OK ...``), so that
+    a client can match answers to requests among ``EVENT`` lines.  Both
+    servers answer every complete line of a read before writing, and send
+    the answers together.
+
+    ``PROTO BIN`` switches the connection to the length-prefixed frames of
+    ``wire.py``; both framings run the same ``dispatch()``.
+    """
+
+    def __init__(self):
         self.cond = Condition()
-        self.events = []
+        self.events = EventQueue(EVENT_QUEUE_LIMIT, EVENT_QUEUE_POLICY)
         self.username = 'guest'
         self.tracker = Tracker(
             tid=f"TRK{next(tracker_sequence):06d}",
             description="session tracker",
             owner=self.username,
             on_update=self._on_tracker_update,
+            views=_views,
         )
+        _session_trackers.add(self.tracker)
         self._running = True
-        self._buffer = ''
         self.pending_events = 0
         self._event_counter = 0
+        # WAIT_EVENTS/SINCE switch the session from push (EVENT lines) to
+        # polling; the token names its event stream in _ring for RESUME
+        self._polling = False
+        self._last_seq = 0
+        self.token = secrets.token_hex(8)
+        _ring.register(self.token)
+        self._buffer = bytearray()
+        # framing: text lines or wire.py frames; PROTO sets _reframe, which
+        # takes effect once its answer is out
+        self.binary = False
+        self._reframe = None
 
-    def run(self):
-        # start notification agent
-        self.agent = Thread(target=notificationagent, args=(self,))
-        self.agent.daemon = True
-        self.agent.start()
+    def _requests(self, data):
+        """Yield the complete requests of ``data`` and the buffered input."""
+        requests = self._feed(data)
+        while requests:
+            yield from requests
+            if self._reframe is None:
+                return
+            self._switch(self._reframe)
+            self._reframe = None
+            requests = self._feed(b'')
+
+    def _switch(self, binary):
+        self.binary = binary
+
+    def _feed(self, data):
+        """Add received bytes; return the complete requests.
 
+        In text mode these are the non-empty lines.  Everything up to the
+        last newline is decoded and split in one pass; only the unfinished
+        line stays in the buffer, so a long pipelined batch is not copied
+        again for every line it contains.  In binary mode they are decoded
+        ``wire.py`` frames.  Both stop after a ``PROTO`` request.
+        """
+        buffer = self._buffer
+        buffer += data
+        if self.binary:
+            return wire.split_frames(buffer, MAX_LINE)
+        end = buffer.rfind(b'\n') + 1
+        if not end:
+            if len(buffer) > MAX_LINE:
+                raise ValueError('Request line too long')
+            return []
+        proto = _PROTO_LINE.search(buffer, 0, end)
+        if proto is not None:
+            end = buffer.find(b'\n', proto.end()) + 1
+        with memoryview(buffer) as view, view[:end] as head:
+            text = str(head, 'utf-8', 'ignore')
+        del buffer[:end]
+        lines = text.split('\n')
+        lines.pop()
+        if len(buffer) > MAX_LINE or max(map(len, lines)) > MAX_LINE:
+            raise ValueError('Request line too long')
+        return [line for line in map(str.strip, lines) if line]
+
+    def _parse(self, request):
+        """Return ``(tag, command, args)`` for a line or decoded frame."""
+        if isinstance(request, tuple):
+            return request
+        tag, line = split_tag(request)
+        parts = line.split()
+        return tag, parts[0].upper() if parts else '', parts[1:]
+
+    def execute(self, request):
+        """Run one request; returns ``(response, keep_open)``."""
+        tag, cmd, args = self._parse(request)
         try:
-            while self._running:
-                data = self.socket.recv(1024)
-                if data == b'' or not data:
-                    break
-                self._buffer += data.decode('utf-8', errors='ignore')
-                # handle multiple lines in the buffer
-                while '\n' in self._buffer:
-                    line, self._buffer = self._buffer.split('\n', 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        resp, cont = self.handle(line)
-                    except Exception as e:
-                        resp = 'ERR ' + str(e)
-                        cont = True
-                    # send back response line
-                    try:
-                        self.socket.sendall((resp + '\n').encode('utf-8'))
-                    except Exception:
-                        self._running = False
-                        break
-                    if not cont:
-                        self._running = False
-                        break
-        finally:
-            self.close()
+            if not cmd:
+                raise ValueError('Malformed frame' if cmd is None else 'Empty request')
+            resp, cont = self.dispatch(cmd, args)
+        except Exception as e:
+            resp, cont = 'ERR ' + str(e), True
+        return self._reply(tag, resp), cont
+
+    def _reply(self, tag, resp):
+        if not self.binary:
+            return tagged(tag, resp)
+        if isinstance(resp, str):
+            return wire.response_payload(tag, resp)
+        return (wire.response_payload(tag, line) for line in response_lines(resp))
+
+    def _encode(self, lines):
+        """Bytes for answer or event lines in the current framing."""
+        if self.binary:
+            return wire.encode_frames(lines)
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def _event_lines(self, events):
+        if self.binary:
+            return [wire.event_payload(ev) for ev in events]
+        return ['EVENT ' + json.dumps(ev) for ev in events]
 
     def handle(self, line):
         parts = line.split()
-        cmd = parts[0].upper()
-        args = parts[1:]
+        return self.dispatch(parts[0].upper(), parts[1:])
 
+    def dispatch(self, cmd, args):
+        if _read_only and cmd in _WRITES:
+            raise RuntimeError('read-only replica; send writes to the primary')
         if cmd == 'HELP':
-            return ('Commands: HELP, USER <name>, CREATE_ITEM <s> <r> <a> <owner>, CREATE_CONTAINER <cid> <desc> <type> <lon> <lat>, LIST_ITEMS, LIST_CONTAINERS, WATCH <item>, WATCH_CONTAINER <cid>, LOAD <item> <cid>, UNLOAD <item>, COMPLETE <item>, SETLOC <cid> <lon> <lat>, SETVIEW <top> <left> <bottom> <right>, STATUS <item>, WAIT_EVENTS, SAVE, QUIT', True)
+            return ('Commands: HELP, USER <name>, CREATE_ITEM <s> <r> <a> <owner>, CREATE_CONTAINER <cid> <desc> <type> <lon> <lat>, LIST_ITEMS [cursor|-] [limit], LIST_ITEMS STREAM [chunk], LIST_CONTAINERS [cursor|-] [limit], LIST_CONTAINERS STREAM [chunk], FIND_ITEMS <owner|state|container|user> <value>, WATCH <item>, WATCH_CONTAINER <cid>, LOAD <item> <cid>, UNLOAD <item>, LOAD_MANY <cid> <item...>, UNLOAD_MANY <item...>, MOVE <from> <to> <item...>, COMPLETE <item>, SETLOC <cid> <lon> <lat>, SETVIEW <top> <left> <bottom> <right>, CONTAINERS_IN_VIEW [<top> <left> <bottom> <right>], STATUS <item>, WAIT_EVENTS [timeout] [max], SINCE <seq> [max], TOKEN, RESUME <token> <last_seq> [max], EVENT_STATS, PROTO <TEXT|BIN>, SAVE, SAVE_STATS, QUIT', True)
         if cmd == 'USER':
             if len(args) != 1:
                 raise ValueError('Usage: USER <name>')
@@ -189,32 +679,59 @@ class Session(Thread):
         if cmd == 'CREATE_ITEM':
             if len(args) < 4:
                 raise ValueError('Usage: CREATE_ITEM <sender> <recipient> <address> <owner>')
-            with _model_lock:
-                item_id = _directory.create(sendernam=args[0], recipnam=args[1], recipaddr=args[2], owner=args[3])
+            item_id = _directory.create(sendernam=args[0], recipnam=args[1], recipaddr=args[2], owner=args[3])
+            with _locks.hold(item_id):
+                _record('create', id=item_id, sendernam=args[0], recipnam=args[1], recipaddr=args[2], owner=args[3])
             return ('OK ' + item_id, True)
         if cmd == 'CREATE_CONTAINER':
             if len(args) < 5:
                 raise ValueError('Usage: CREATE_CONTAINER <cid> <desc> <type> <lon> <lat>')
-            with _model_lock:
-                cid = args[0]
+            cid = args[0]
+            with _locks.hold(cid):
                 if cid in _containers:
                     raise RuntimeError('container exists')
                 cont = Container(cid=cid, description=args[1], type=args[2], loc=(float(args[3]), float(args[4])))
+                # filed first: a container that cannot be filed is not created
+                _locations.add(cont)
                 _containers[cid] = cont
+                _record('container', cid=cid, description=cont.description, type=cont.type, loc=list(cont.loc))
             return ('OK ' + cid, True)
         if cmd == 'LIST_ITEMS':
-            with _model_lock:
-                items = _directory.list()
-            return ('OK ' + json.dumps([p for _, p in items]), True)
+            if not args:
+                with _open_snapshot() as snapshot:
+                    items = _read_items(snapshot.item_ids, snapshot)
+                return (wire.JsonLine('OK ' + json.dumps(items)), True)
+            if args[0].upper() == 'STREAM':
+                chunk = _parse_limit(cmd, args[1:2])
+                return (_snapshot_stream('ITEMS', chunk), True)
+            cursor, limit = _parse_page(cmd, args)
+            item_ids, next_cursor = _directory.page(cursor, limit)
+            page = '{"items": ' + _json_array(_read_items(item_ids)) + ', "next": ' + json.dumps(next_cursor) + '}'
+            return (wire.JsonLine('OK ' + page), True)
         if cmd == 'LIST_CONTAINERS':
-            with _model_lock:
-                data = [json.loads(c.get()) for c in _containers.values()]
-            return ('OK ' + json.dumps(data), True)
+            if not args:
+                with _open_snapshot() as snapshot:
+                    data = [json.loads(payload) for payload in _read_containers(snapshot.cids, snapshot)]
+                return (wire.JsonLine('OK ' + json.dumps(data)), True)
+            if args[0].upper() == 'STREAM':
+                chunk = _parse_limit(cmd, args[1:2])
+                return (_snapshot_stream('CONTAINERS', chunk), True)
+            cursor, limit = _parse_page(cmd, args)
+            cids, next_cursor = _page_containers(cursor, limit)
+            page = '{"containers": ' + _json_array(_read_containers(cids)) + ', "next": ' + json.dumps(next_cursor) + '}'
+            return (wire.JsonLine('OK ' + page), True)
+        if cmd == 'FIND_ITEMS':
+            if len(args) < 2 or args[0].lower() not in ('owner', 'state', 'container', 'user'):
+                raise ValueError('Usage: FIND_ITEMS <owner|state|container|user> <value>')
+            # states such as 'in transit' contain a space
+            item_ids = _directory.find(**{args[0].lower(): ' '.join(args[1:])})
+            data = [json.loads(payload) for payload in _read_items(item_ids)]
+            return (wire.JsonLine('OK ' + json.dumps(data)), True)
         if cmd == 'WATCH':
             if len(args) != 1:
                 raise ValueError('Usage: WATCH <item_id>')
             item_id = args[0]
-            with _model_lock:
+            with _locks.hold(item_id):
                 item = _directory._items.get(item_id)
                 if item is None:
                     raise KeyError('Unknown item')
@@ -224,7 +741,7 @@ class Session(Thread):
             if len(args) != 1:
                 raise ValueError('Usage: WATCH_CONTAINER <cid>')
             cid = args[0]
-            with _model_lock:
+            with _locks.hold(cid):
                 cont = _containers.get(cid)
                 if cont is None:
                     raise KeyError('Unknown container')
@@ -236,8 +753,7 @@ class Session(Thread):
             if len(args) != 2:
                 raise ValueError('Usage: LOAD <item> <cid>')
             item_id, cid = args[0], args[1]
-            with _model_lock:
-                item = _directory._items.get(item_id)
+            with _hold_item(item_id, cid) as item:
                 cont = _containers.get(cid)
                 if item is None or cont is None:
                     raise KeyError('Unknown item or container')
@@ -247,16 +763,82 @@ class Session(Thread):
                 if current == cid:
                     return (f'OK {item_id} already in {cid}', True)
                 cont.load([item])
+                _record('load', id=item_id, cid=cid)
             return (f'OK loaded {item_id} into {cid}', True)
+        if cmd == 'LOAD_MANY':
+            if len(args) < 2:
+                raise ValueError('Usage: LOAD_MANY <cid> <item...>')
+            cid, item_ids = args[0], list(dict.fromkeys(args[1:]))
+            batch = UpdateBatch()
+            with _hold_items(item_ids, cid) as items:
+                cont = _containers.get(cid)
+                if cont is None:
+                    raise KeyError('Unknown container')
+                _known(item_ids, items)
+                # check every item before changing any
+                for item in items:
+                    current = item.getContainer()
+                    if current and current != cid:
+                        raise RuntimeError(f'Item {item.trackingId()} already in container {current}')
+                todo = [item for item in items if item.getContainer() != cid]
+                cont.load(todo, batch=batch)
+                if todo:
+                    _record('load_many', cid=cid, ids=[item.trackingId() for item in todo])
+            batch.deliver()
+            return (f'OK loaded {len(todo)} into {cid}', True)
+        if cmd == 'UNLOAD_MANY':
+            if not args:
+                raise ValueError('Usage: UNLOAD_MANY <item...>')
+            item_ids = list(dict.fromkeys(args))
+            batch = UpdateBatch()
+            with _hold_items(item_ids) as items:
+                _known(item_ids, items)
+                for item in items:
+                    if item._container is None:
+                        raise RuntimeError(f'Item {item.trackingId()} not in a container')
+                by_container = {}
+                for item in items:
+                    by_container.setdefault(item._container, []).append(item)
+                for cont, group in by_container.items():
+                    try:
+                        cont.unload(group, batch=batch)
+                    except Exception as e:
+                        raise RuntimeError(f'Unload failed: {e}')
+                _record('unload_many', ids=item_ids)
+            batch.deliver()
+            return (f'OK unloaded {len(item_ids)}', True)
+        if cmd == 'MOVE':
+            if len(args) < 3:
+                raise ValueError('Usage: MOVE <from_cid> <to_cid> <item...>')
+            source_id, target_id, item_ids = args[0], args[1], list(dict.fromkeys(args[2:]))
+            batch = UpdateBatch()
+            with _hold_items(item_ids, source_id, target_id) as items:
+                source = _containers.get(source_id)
+                target = _containers.get(target_id)
+                if source is None or target is None:
+                    raise KeyError('Unknown container')
+                _known(item_ids, items)
+                for item in items:
+                    if item.getContainer() != source_id:
+                        raise RuntimeError(f'Item {item.trackingId()} not in container {source_id}')
+                if source is not target:
+                    source.move(items, target, batch=batch)
+                    _record('move', source=source_id, cid=target_id, ids=item_ids)
+            batch.deliver()
+            return (f'OK moved {len(item_ids)} from {source_id} to {target_id}', True)
         if cmd == 'SETLOC':
             if len(args) != 3:
                 raise ValueError('Usage: SETLOC <cid> <lon> <lat>')
             cid = args[0]
-            with _model_lock:
+            batch = UpdateBatch()
+            with _locks.hold(cid):
                 cont = _containers.get(cid)
                 if cont is None:
                     raise KeyError('Unknown container')
-                cont.setlocation(float(args[1]), float(args[2]))
+                cont.setlocation(float(args[1]), float(args[2]), batch=batch)
+                _record('setloc', cid=cid, loc=list(cont.loc))
+            # fan out to the trackers once the stripe is free
+            batch.deliver()
             return (f'OK moved {cid}', True)
         if cmd == 'SETVIEW':
             if len(args) != 4:
@@ -267,12 +849,25 @@ class Session(Thread):
                 raise ValueError('Usage: SETVIEW <top> <left> <bottom> <right>') from exc
             self.tracker.setView(top, left, bottom, right)
             return ('OK view set', True)
+        if cmd == 'CONTAINERS_IN_VIEW':
+            if args:
+                if len(args) != 4:
+                    raise ValueError('Usage: CONTAINERS_IN_VIEW [<top> <left> <bottom> <right>]')
+                try:
+                    rect = tuple(map(float, args))
+                except ValueError as exc:
+                    raise ValueError('Usage: CONTAINERS_IN_VIEW [<top> <left> <bottom> <right>]') from exc
+            else:
+                rect = self.tracker._view_rect
+                if rect is None:
+                    raise RuntimeError('no view set; use SETVIEW or pass a rectangle')
+            cids = sorted(_locations.search(view_box(rect)))
+            return (wire.JsonLine('OK ' + _json_array(_read_containers(cids))), True)
         if cmd == 'UNLOAD':
             if len(args) != 1:
                 raise ValueError('Usage: UNLOAD <item_id>')
             item_id = args[0]
-            with _model_lock:
-                item = _directory._items.get(item_id)
+            with _hold_item(item_id) as item:
                 if item is None:
                     raise KeyError('Unknown item')
                 cont = getattr(item, '_container', None)
@@ -283,12 +878,13 @@ class Session(Thread):
                     cont.unload([item])
                 except Exception as e:
                     raise RuntimeError(f'Unload failed: {e}')
+                _record('unload', id=item_id)
             return (f'OK unloaded {item_id}', True)
         if cmd == 'COMPLETE':
             if len(args) != 1:
                 raise ValueError('Usage: COMPLETE <item_id>')
             item_id = args[0]
-            with _model_lock:
+            with _locks.hold(item_id):
                 item = _directory._items.get(item_id)
                 if item is None:
                     raise KeyError('Unknown item')
@@ -298,99 +894,594 @@ class Session(Thread):
                     item.complete()
                 except Exception as e:
                     raise RuntimeError(f'Complete failed: {e}')
+                _record('complete', id=item_id)
             return (f'OK completed {item_id}', True)
         if cmd == 'STATUS':
             if len(args) != 1:
                 raise ValueError('Usage: STATUS <item_id>')
-            with _model_lock:
+            with _locks.hold(args[0]):
                 item = _directory._items.get(args[0])
                 if item is None:
                     raise KeyError('Unknown item')
-                return ('OK ' + item.get(), True)
+                return (wire.JsonLine('OK ' + item.get()), True)
         if cmd == 'WAIT_EVENTS':
-            timeout = 5.0
-            end = time.time() + timeout
+            return self.wait_events(*self._parse_wait(args))
+        if cmd == 'TOKEN':
+            return (f'OK {self.token}', True)
+        if cmd == 'RESUME':
+            if not 2 <= len(args) <= 3:
+                raise ValueError('Usage: RESUME <token> <last_seq> [max]')
+            try:
+                last_seq = int(args[1])
+            except ValueError:
+                raise ValueError('RESUME: last_seq must be an integer') from None
+            return self.resume(args[0], last_seq, _parse_limit(cmd, args[2:]))
+        if cmd == 'SINCE':
+            if not 1 <= len(args) <= 2:
+                raise ValueError('Usage: SINCE <seq> [max]')
+            try:
+                seq = int(args[0])
+            except ValueError:
+                raise ValueError('SINCE: seq must be an integer') from None
+            return self.events_since(seq, _parse_limit(cmd, args[1:]))
+        if cmd == 'EVENT_STATS':
             with self.cond:
-                start_counter = self._event_counter
-                while self._event_counter == start_counter and self._running:
-                    remaining = end - time.time()
-                    if remaining <= 0:
-                        break
-                    self.cond.wait(timeout=remaining)
-                event_observed = self._event_counter != start_counter
-            if event_observed:
-                return ('OK event available', True)
-            return ('OK no pending events', True)
+                stats = self.events.stats()
+            return (wire.JsonLine('OK ' + json.dumps(stats)), True)
+        if cmd == 'PROTO':
+            mode = args[0].upper() if len(args) == 1 else None
+            if mode not in ('TEXT', 'BIN'):
+                raise ValueError('Usage: PROTO <TEXT|BIN>')
+            self._reframe = mode == 'BIN'
+            return (f'OK {mode}', True)
+        # HANDOFF_OUT/HANDOFF_IN move an item between shards (shard.py)
+        if cmd == 'HANDOFF_OUT':
+            if len(args) not in (1, 2):
+                raise ValueError('Usage: HANDOFF_OUT <item_id> [cid|-]')
+            item_id = args[0]
+            with _hold_item(item_id) as item:
+                if item is None:
+                    raise KeyError('Unknown item')
+                # the container the item must be in: '-' for none (LOAD),
+                # the source container for a MOVE
+                if len(args) == 2:
+                    current = item.getContainer()
+                    if args[1] == '-' and current:
+                        raise RuntimeError(f'Item {item_id} already in container {current}')
+                    if args[1] != '-' and current != args[1]:
+                        raise RuntimeError(f'Item {item_id} not in container {args[1]}')
+                record = {'id': item_id, 'sendernam': item.sender_name, 'recipnam': item.recipient_name,
+                          'recipaddr': item.recipient_address, 'owner': item.owner, 'state': item.state,
+                          'cid': item.getContainer()}
+                if item._container is not None:
+                    item._container.unload([item])
+                for tracker in tuple(item._trackers or ()):
+                    tracker.removeItem([item])
+                _directory.remove(item_id)
+                _record('handoff_out', id=item_id)
+            return ('OK ' + encode_record(record), True)
+        if cmd == 'HANDOFF_IN':
+            if len(args) not in (1, 2):
+                raise ValueError('Usage: HANDOFF_IN <record> [cid]')
+            record = decode_record(args[0])
+            item_id = record['id']
+            with _locks.hold(item_id):
+                if len(args) == 2 and args[1] not in _containers:
+                    raise KeyError('Unknown container')
+                if item_id in _directory._items:
+                    raise RuntimeError('item exists')
+                _directory.add(CargoItem.restore(
+                    item_id, sendernam=record['sendernam'], recipnam=record['recipnam'],
+                    recipaddr=record['recipaddr'], owner=record['owner'], state=record['state'],
+                ))
+                _record('handoff_in', **{key: value for key, value in record.items() if key != 'cid'})
+            return ('OK ' + item_id, True)
         if cmd == 'SAVE':
-            save_state()
+            if not save_state(_state_path):
+                raise RuntimeError(f"save failed: {_save_stats['last_error']}")
             return ('OK saved', True)
+        if cmd == 'SAVE_STATS':
+            stats = dict(_save_stats)
+            stats['autosave'] = _autosaver.stats() if _autosaver is not None else None
+            return (wire.JsonLine('OK ' + json.dumps(stats)), True)
         if cmd == 'QUIT':
             return ('OK bye', False)
         raise ValueError('Unknown command')
 
-    def _on_tracker_update(self, tracker_obj, updated_object, obj_id):
-        brief = {
-            'when': time.time(),
-            'obj': ('generic', None, None),
-        }
-        if isinstance(updated_object, CargoItem):
-            brief['obj'] = ('cargo', obj_id, getattr(updated_object, 'state', None))
-        elif isinstance(updated_object, Container):
-            brief['obj'] = ('container', obj_id, getattr(updated_object, 'loc', None))
-        elif isinstance(updated_object, Tracker):
-            brief['obj'] = ('tracker', tracker_obj.tid, None)
+    def wait_events(self, timeout=5.0, limit=None):
+        """Without ``limit``: report whether an event arrived within
+        ``timeout``.  With it: return up to ``limit`` queued events, waiting
+        up to ``timeout`` for the first one."""
+        end = time.time() + timeout
+        with self.cond:
+            if limit is not None:
+                self._polling = True
+            start_counter = self._event_counter
+            while not self._wait_done(start_counter, limit) and self._running:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(timeout=remaining)
+            if limit is not None:
+                return self._poll(limit)
+            event_observed = self._event_counter != start_counter
+        return self._wait_result(event_observed)
 
+    def _parse_wait(self, args):
+        """``WAIT_EVENTS [timeout] [max]``; no arguments keeps the old reply."""
+        if not args:
+            return 5.0, None
+        if len(args) > 2:
+            raise ValueError('Usage: WAIT_EVENTS [timeout] [max]')
+        try:
+            timeout = float(args[0])
+        except ValueError:
+            raise ValueError('WAIT_EVENTS: timeout must be a number') from None
+        if not 0 <= timeout <= MAX_WAIT:
+            raise ValueError(f'WAIT_EVENTS: timeout must be between 0 and {MAX_WAIT:g}')
+        return timeout, _parse_limit('WAIT_EVENTS', args[1:])
+
+    def _wait_done(self, start_counter, limit):
+        if limit is None:
+            return self._event_counter != start_counter
+        return bool(self.events)
+
+    def _wait_result(self, event_observed):
+        if event_observed:
+            return ('OK event available', True)
+        return ('OK no pending events', True)
+
+    def events_since(self, seq, limit):
+        """Return the events after ``seq``: first those that already left
+        the queue (kept in ``_ring``), then queued ones."""
+        with self.cond:
+            self._polling = True
+            replay = _ring.since(self.token, seq, limit)
+            if replay is None:
+                raise RuntimeError(f'SINCE: events after {seq} are no longer available')
+            return self._poll(limit - len(replay), replay)
+
+    def _poll(self, limit, events=None):
+        # caller holds cond
+        events = list(events or ())
+        taken = []
+        while self.events and len(taken) < limit:
+            taken.append(self.events.popleft())
+        self._delivered(taken)
+        events.extend(taken)
+        last = events[-1]['seq'] if events else self._last_seq
+        return (wire.JsonLine('OK ' + json.dumps({'events': events, 'seq': last})), True)
+
+    def _delivered(self, events):
+        # caller holds cond: events left the queue, keep them for SINCE/RESUME
+        if not events:
+            return
+        _ring.extend(self.token, events)
+        self._last_seq = max(self._last_seq, events[-1]['seq'])
+        self.pending_events = max(0, self.pending_events - len(events))
+        if self.pending_events == 0:
+            self.cond.notify_all()
+
+    def resume(self, token, last_seq, limit):
+        """Take over the tracker of the closed session ``token`` and return
+        the events it got after ``last_seq``."""
+        _expire_parked()
+        with _parking_lock:
+            parked = _parked.get(token)
+            if parked is None:
+                raise KeyError('Unknown or expired token')
+            missed = _ring.since(token, last_seq)
+            if missed is None:
+                raise RuntimeError(f'RESUME: events after {last_seq} are no longer available')
+            del _parked[token]
+            old_token, self.token = self.token, token
+            # from here on the parked tracker's events come to this session
+            parked.session = self
+        _release_tracker(self.tracker)
+        _ring.forget(old_token)
+        self.tracker = parked.tracker
+        self.tracker._on_update = self._on_tracker_update
         with self.cond:
+            # the rest is left for SINCE
+            self._last_seq = max(self._last_seq, last_seq)
+            missed = missed[:limit]
+            last = missed[-1]['seq'] if missed else self._last_seq
+        return (wire.JsonLine('OK ' + json.dumps({'events': missed, 'seq': last})), True)
+
+    def _on_tracker_update(self, tracker_obj, updated_object, obj_id, item_ids=None, loc=None):
+        brief = _event_record(tracker_obj, updated_object, obj_id, item_ids, loc)
+        with self.cond:
+            # drawn under cond, so a session queues its events in seq order
+            brief['seq'] = next(_event_seq)
+            queued = len(self.events)
+            if not self.events.push(brief):
+                # disconnect policy: the client cannot keep up
+                self._disconnect()
             self._event_counter += 1
-            self.events.append(brief)
-            self.pending_events += 1
+            # coalesced or dropped events do not add to the backlog
+            self.pending_events += len(self.events) - queued
             self.cond.notify_all()
 
     def close(self):
-        # unregister watchers
-        with _model_lock:
-            try:
-                self.tracker.delete()
-            except Exception:
-                pass
+        self._close_transport()
+        # stop agent; whatever it did not send can still be resumed
+        self._running = False
+        with self.cond:
+            self._delivered(self.events.drain())
+            self.cond.notify_all()
+        # keep the watchers for RESUME, or unregister them
+        if RESUME_GRACE > 0:
+            _park(self.tracker, self.token)
+        else:
+            _release_tracker(self.tracker)
+            _ring.forget(self.token)
+        _expire_parked()
+
+    def _disconnect(self):
+        """Drop the connection from any thread; takes no model lock.
+
+        The command loop then sees end of input and runs ``close()``."""
+        self._running = False
+
+    def _close_transport(self):
+        """Close the connection, if there is one; a bare ``CommandSession``
+        (as used in tests) has none."""
+
+
+def _event_record(tracker_obj, updated_object, obj_id, item_ids=None, loc=None):
+    """Turn a tracker callback into an event dict (without its seq).
+
+    ``loc`` is a container's location when its update was recorded.
+    """
+    brief = {
+        'when': time.time(),
+        'obj': ('generic', None, None),
+    }
+    if isinstance(updated_object, CargoItem):
+        brief['obj'] = ('cargo', obj_id, getattr(updated_object, 'state', None))
+    elif isinstance(updated_object, Container):
+        brief['obj'] = ('container', obj_id, loc if loc is not None else getattr(updated_object, 'loc', None))
+    elif isinstance(updated_object, Tracker):
+        brief['obj'] = ('tracker', tracker_obj.tid, None)
+    if item_ids is not None:
+        # one event for a container update and the watched items inside
+        brief['items'] = item_ids
+    return brief
+
+
+class _Parked:
+    """The tracker of a closed session, waiting for a RESUME.
+
+    Until a session adopts it, its events go straight into ``_ring``.
+    """
+
+    __slots__ = ('tracker', 'token', 'deadline', 'session')
+
+    def __init__(self, tracker, token):
+        self.tracker = tracker
+        self.token = token
+        self.deadline = time.time() + RESUME_GRACE
+        self.session = None
+
+    def on_update(self, tracker_obj, updated_object, obj_id, item_ids=None, loc=None):
+        with _parking_lock:
+            session = self.session
+            if session is None:
+                if self.deadline <= time.time():
+                    # expired: the reaper is about to release the tracker
+                    return
+                brief = _event_record(tracker_obj, updated_object, obj_id, item_ids, loc)
+                brief['seq'] = next(_event_seq)
+                _ring.extend(self.token, [brief])
+                return
+        # adopted by RESUME while this callback was on its way
+        session._on_tracker_update(tracker_obj, updated_object, obj_id, item_ids, loc)
+
+
+def _park(tracker, token):
+    global _reaper
+    parked = _Parked(tracker, token)
+    tracker._on_update = parked.on_update
+    with _parking_lock:
+        _parked[token] = parked
+        if _reaper is None:
+            _reaper = Thread(target=_reap_parked, daemon=True)
+            _reaper.start()
+    _reaper_wake.set()
+
+
+def _reap_parked():
+    """Expire parked trackers as their grace periods end, whether or not
+    sessions keep closing and resuming."""
+    while True:
+        with _parking_lock:
+            deadline = min((parked.deadline for parked in _parked.values()), default=None)
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        _reaper_wake.wait(timeout)
+        _reaper_wake.clear()
+        try:
+            _expire_parked()
+        except Exception as exc:
+            print(f'WARN: releasing parked trackers failed: {exc}')
+
+
+def _expire_parked():
+    """Delete the parked trackers whose grace period is over."""
+    now = time.time()
+    with _parking_lock:
+        expired = [parked for parked in _parked.values() if parked.deadline <= now]
+        for parked in expired:
+            del _parked[parked.token]
+    for parked in expired:
+        _release_tracker(parked.tracker)
+        _ring.forget(parked.token)
+
+
+def _release_tracker(tracker):
+    """Unregister ``tracker`` from everything it watches."""
+    tracked = [item.trackingId() for item in tracker._items]
+    tracked.extend(cont.cid for cont in tracker._containers)
+    with _locks.hold(*tracked):
+        try:
+            tracker.delete()
+        except Exception:
+            pass
+
+
+class Session(CommandSession, Thread):
+    """Serves one connection on a dedicated thread plus a notification thread."""
+
+    def __init__(self, sock):
+        Thread.__init__(self)
+        CommandSession.__init__(self)
+        self.socket = sock
+        # the command loop and the notification agent share the socket;
+        # whole lines must not interleave
+        self._send_lock = Lock()
+
+    def run(self):
+        # start notification agent
+        self.agent = Thread(target=notificationagent, args=(self,))
+        self.agent.daemon = True
+        self.agent.start()
+
+        try:
+            while self._running:
+                data = self.socket.recv(RECV_SIZE)
+                if data == b'' or not data:
+                    break
+                # answer every complete request of this read, then write once
+                out, size = [], 0
+                for request in self._requests(data):
+                    request = self._parse(request)
+                    blocking = request[1] in _BLOCKING
+                    if out and blocking:
+                        self.send_lines(out)
+                        out, size = [], 0
+                    resp, cont = self.execute(request)
+                    for text in response_lines(resp):
+                        out.append(text)
+                        size += len(text)
+                        if size >= PIPELINE_FLUSH or blocking:
+                            self.send_lines(out)
+                            out, size = [], 0
+                    if not cont:
+                        self._running = False
+                        break
+                if out:
+                    self.send_lines(out)
+        except (OSError, ValueError):
+            # peer went away or sent an over-long line
+            pass
+        finally:
+            self.close()
+
+    def send(self, line):
+        self.send_lines([line])
+
+    def send_lines(self, lines):
+        """Send several lines (or frame payloads) with one ``sendall``."""
+        with self._send_lock:
+            self.socket.sendall(self._encode(lines))
+
+    def send_events(self, events):
+        # encoded under the lock, so no event is framed for the wrong mode
+        with self._send_lock:
+            self.socket.sendall(self._encode(self._event_lines(events)))
+
+    def _switch(self, binary):
+        with self._send_lock:
+            super()._switch(binary)
+
+    def _disconnect(self):
+        super()._disconnect()
+        try:
+            # wakes the recv() in run()
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_transport(self):
         try:
             self.socket.close()
         except Exception:
             pass
-        # stop agent
+
+
+class AsyncSession(CommandSession):
+    """Serves one connection as a coroutine on the asyncio event loop.
+
+    Tracker callbacks may fire on any thread, so they only queue the event
+    and schedule a wakeup on the loop; the writes happen in
+    ``async_notificationagent`` without ever blocking the loop.
+    """
+
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._waiters = []
+
+    async def run(self):
+        self.agent = self._loop.create_task(async_notificationagent(self))
+        try:
+            cont = True
+            while self._running and cont:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                out = []
+                for request in self._requests(data):
+                    request = self._parse(request)
+                    blocking = request[1] in _BLOCKING
+                    if out and blocking:
+                        await self._write_lines(out)
+                        out = []
+                    resp, cont = await self.execute_async(request)
+                    if isinstance(resp, str):
+                        out.append(resp)
+                        if blocking:
+                            await self._write_lines(out)
+                            out = []
+                    else:
+                        # a streamed listing is drained per chunk, so it
+                        # yields to other clients
+                        for text in response_lines(resp):
+                            out.append(text)
+                            await self._write_lines(out)
+                            out = []
+                    if not cont:
+                        break
+                if out:
+                    await self._write_lines(out)
+        except (ConnectionError, ValueError):
+            # peer went away or sent an over-long line
+            pass
+        finally:
+            self.close()
+            await self.agent
+
+    async def execute_async(self, request):
+        """``execute()``, with ``WAIT_EVENTS`` waiting on the event loop."""
+        tag, cmd, args = self._parse(request)
+        if cmd != 'WAIT_EVENTS':
+            return self.execute(request)
+        try:
+            resp, cont = await self.wait_events_async(*self._parse_wait(args))
+        except Exception as e:
+            resp, cont = 'ERR ' + str(e), True
+        return self._reply(tag, resp), cont
+
+    async def _write_lines(self, lines):
+        self.writer.write(self._encode(lines))
+        await self.writer.drain()
+
+    async def wait_events_async(self, timeout=5.0, limit=None):
+        if limit is not None:
+            self._polling = True
+        start_counter = self._event_counter
+        end = self._loop.time() + timeout
+        while not self._wait_done(start_counter, limit) and self._running:
+            remaining = end - self._loop.time()
+            if remaining <= 0:
+                break
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                break
+        if limit is not None:
+            with self.cond:
+                return self._poll(limit)
+        return self._wait_result(self._event_counter != start_counter)
+
+    def _on_tracker_update(self, tracker_obj, updated_object, obj_id, item_ids=None, loc=None):
+        super()._on_tracker_update(tracker_obj, updated_object, obj_id, item_ids, loc)
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        try:
+            self._loop.call_soon_threadsafe(self._signal)
+        except RuntimeError:
+            # event loop already closed
+            pass
+
+    def _signal(self):
+        self._wakeup.set()
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _disconnect(self):
+        super()._disconnect()
+        try:
+            # the reader then sees end of input
+            self._loop.call_soon_threadsafe(self.writer.transport.abort)
+        except RuntimeError:
+            pass
+
+    def _close_transport(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
         self._running = False
-        with self.cond:
-            self.cond.notify_all()
+        self._schedule_wakeup()
 
 
 def notificationagent(session):
+    """Send queued events; each wakeup drains the queue into one write."""
     while True:
         with session.cond:
-            while not session.events and session._running:
+            # a polling session collects its events with WAIT_EVENTS/SINCE
+            while (session._polling or not session.events) and session._running:
                 session.cond.wait()
-            if not session._running and not session.events:
+            if not session._running and (session._polling or not session.events):
                 break
-            ev = session.events.pop(0)
+            if not EVENT_FLUSH_DELAY:
+                events = session.events.drain()
+                session._delivered(events)
+        if EVENT_FLUSH_DELAY:
+            # let the rest of a burst arrive before writing
+            time.sleep(EVENT_FLUSH_DELAY)
+            with session.cond:
+                events = [] if session._polling else session.events.drain()
+                session._delivered(events)
+        if not events:
+            continue
         try:
-            session.socket.sendall(('EVENT ' + json.dumps(ev) + '\n').encode('utf-8'))
+            session.send_events(events)
         except Exception:
             session._running = False
             break
-        finally:
-            with session.cond:
-                session.pending_events = max(0, session.pending_events - 1)
-                if session.pending_events == 0:
-                    session.cond.notify_all()
 
 
-if __name__ == '__main__':
-    port = 5000
-    if len(sys.argv) > 1:
+async def async_notificationagent(session):
+    while True:
+        await session._wakeup.wait()
+        if EVENT_FLUSH_DELAY and session._running:
+            await asyncio.sleep(EVENT_FLUSH_DELAY)
+        session._wakeup.clear()
+        with session.cond:
+            events = [] if session._polling else session.events.drain()
+            session._delivered(events)
+        if not session._running:
+            break
+        if not events:
+            continue
+        session.writer.write(session._encode(session._event_lines(events)))
         try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print('port must be integer, using 5000')
-    load_state()
+            await session.writer.drain()
+        except Exception:
+            session._running = False
+            break
+
+
+def serve_threaded(port):
     serversocket = socket(AF_INET, SOCK_STREAM)
     serversocket.bind(('', port))
     serversocket.listen(10)
@@ -399,8 +1490,146 @@ if __name__ == '__main__':
     try:
         while True:
             ns, peer = serversocket.accept()
+            # answers are already batched per read; don't let Nagle hold
+            # them back waiting for a delayed ACK (asyncio does the same)
+            ns.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
             s = Session(ns)
             s.start()
     finally:
         serversocket.close()
-        save_state()
+
+
+async def _serve_connection(reader, writer):
+    await AsyncSession(reader, writer).run()
+
+
+async def serve_asyncio(port):
+    server = await asyncio.start_server(_serve_connection, port=port, backlog=1024)
+    print('server2 (asyncio) listening on port', port)
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Cargo tracking server')
+    parser.add_argument('port', nargs='?', default='5000')
+    parser.add_argument('--mode', choices=('thread', 'asyncio'), default='thread',
+                        help='thread: one Session thread per client; '
+                             'asyncio: one coroutine per client on a single event loop')
+    parser.add_argument('--state-file', default=STATE_FILE,
+                        help='snapshot path; a .bin extension selects the compact binary format')
+    parser.add_argument('--store', choices=('objects', 'columnar'), default='objects',
+                        help='objects: one CargoItem per item; '
+                             'columnar: items kept in column arrays (CargoStore)')
+    parser.add_argument('--lazy-load', action='store_true',
+                        help='map a .bin state file at startup and read objects as they are used; '
+                             'the first compaction or autosave after a write still builds the whole '
+                             'model (raise --compact-interval to put it off)')
+    parser.add_argument('--no-journal', dest='journal', action='store_false',
+                        help='persist only on SAVE/shutdown instead of journaling every mutation')
+    parser.add_argument('--event-limit', type=int, default=EVENT_QUEUE_LIMIT,
+                        help='most pending events kept per client')
+    parser.add_argument('--event-policy', choices=POLICIES, default=EVENT_QUEUE_POLICY,
+                        help='on a full event queue: coalesce updates per object, '
+                             'drop the oldest event, or disconnect the client')
+    parser.add_argument('--event-flush-delay', type=float, default=EVENT_FLUSH_DELAY,
+                        help='seconds to gather a burst of events into one write (default: 0)')
+    parser.add_argument('--event-ring', type=int, default=EVENT_RING_SIZE,
+                        help='recent events kept for SINCE and RESUME (all sessions)')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help='seconds a closed session can be resumed (0: never)')
+    parser.add_argument('--recv-size', type=int, default=RECV_SIZE,
+                        help='bytes read from a client socket at a time')
+    parser.add_argument('--max-line', type=int, default=MAX_LINE,
+                        help='longest request line accepted; longer ones close the connection')
+    parser.add_argument('--shard', metavar='K/N',
+                        help='run as shard K (0-based) of N behind shard.py')
+    parser.add_argument('--compact-interval', type=float, default=60.0,
+                        help='seconds between background journal compactions')
+    parser.add_argument('--autosave-interval', type=float,
+                        help='seconds between background saves when something changed '
+                             '(0: off; default: 30 with --no-journal, off with the journal)')
+    parser.add_argument('--autosave-every', type=int,
+                        help='save in the background after this many mutations '
+                             '(0: off; default: 10000 with --no-journal, off with the journal)')
+    parser.add_argument('--replication-port', type=int,
+                        help='publish every mutation to replicas connecting on this port')
+    parser.add_argument('--replica-of', metavar='HOST:PORT',
+                        help="serve reads from a copy of the primary at HOST:PORT (its replication port)")
+    args = parser.parse_args(argv)
+    try:
+        args.port = int(args.port)
+    except ValueError:
+        print('port must be integer, using 5000')
+        args.port = 5000
+    if args.shard is not None:
+        try:
+            index, shards = (int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error('--shard must be K/N')
+        if not 0 <= index < shards:
+            parser.error('--shard K/N needs 0 <= K < N')
+        args.shard = (index, shards)
+    if args.replica_of is not None:
+        host, _, port = args.replica_of.rpartition(':')
+        try:
+            args.replica_of = (host or '127.0.0.1', int(port))
+        except ValueError:
+            parser.error('--replica-of must be HOST:PORT')
+        if args.replication_port is not None:
+            parser.error('a replica cannot publish to replicas of its own')
+    # the journal's compactor already snapshots the state in the background
+    if args.autosave_interval is None:
+        args.autosave_interval = 0.0 if args.journal else 30.0
+    if args.autosave_every is None:
+        args.autosave_every = 0 if args.journal else 10000
+    if args.lazy_load and (args.store != 'objects' or not is_binary_snapshot(args.state_file)):
+        parser.error('--lazy-load needs a .bin --state-file and --store objects')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    _state_path = args.state_file
+    _lazy_load = args.lazy_load
+    EVENT_QUEUE_LIMIT = args.event_limit
+    EVENT_QUEUE_POLICY = args.event_policy
+    EVENT_FLUSH_DELAY = args.event_flush_delay
+    RESUME_GRACE = args.resume_grace
+    RECV_SIZE = args.recv_size
+    MAX_LINE = args.max_line
+    if args.shard is not None:
+        _shard = args.shard
+        CargoItem._id_sequence = _id_sequence_after(0)
+    _ring = EventRing(args.event_ring)
+    if args.store == 'columnar':
+        _directory_class = CargoStore
+        _directory = CargoStore()
+    if args.replica_of is not None:
+        # the primary owns the state file and the journal
+        _read_only = True
+        Thread(target=follow, args=(args.replica_of, _install_replica, _apply_replicated), daemon=True).start()
+    else:
+        load_state()
+        if args.journal:
+            enable_journal(compact_interval=args.compact_interval)
+        if args.replication_port is not None:
+            _replication = ReplicationHub()
+            serve_replication(args.replication_port, _replication_snapshot, _replication)
+        if args.autosave_interval > 0 or args.autosave_every > 0:
+            _autosaver = Autosaver(save_state, interval=args.autosave_interval or None,
+                                   threshold=args.autosave_every or None)
+            _autosaver.start()
+    try:
+        if args.mode == 'asyncio':
+            asyncio.run(serve_asyncio(args.port))
+        else:
+            serve_threaded(args.port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if _autosaver is not None:
+            _autosaver.stop()
+        if not _read_only:
+            save_state()
+        close_journal()
@@ -0,0 +1,510 @@
+"""Sharded deployment: N server processes behind a routing front end.
+
+Every shard is a plain ``server.py --shard K/N`` process that owns part of
+the model:
+
+* a container lives on shard ``crc32(cid) % N``;
+* an item is created on some shard and keeps an id that names it: shard K
+  hands out the id numbers K+1, K+1+N, ... (``server._id_sequence_after``),
+  so ``home_shard()`` is the id number minus one, modulo N;
+* an item loaded into a container of another shard moves there.  The
+  router does a two-step handoff: ``HANDOFF_OUT`` takes the item out of its
+  shard (unloading it there) and ``HANDOFF_IN`` adds it to the container's
+  shard.  ``HANDOFF_OUT`` is told which container the item must be in (none
+  for a LOAD, the source for a MOVE) and refuses otherwise, as a single
+  server would.  If the second step fails the item is handed back.  ``_located``
+  remembers items away from their home shard; after a router restart they
+  are found again by asking every shard.
+
+``Router`` serves the usual text protocol.  Each client gets one
+connection per shard, so ``USER``, ``SETVIEW`` and watches keep per-shard
+sessions.  Events from every shard are passed through as they come.
+Commands on one item or container go to its shard, listings and searches
+go to every shard and are merged, and settings (``USER``, ``SETVIEW``,
+``SAVE``) are sent to all of them.  A bulk command is not atomic across
+shards: it is checked and applied per shard.  ``WAIT_EVENTS``, ``SINCE``,
+``TOKEN``, ``RESUME`` and ``PROTO`` are only served by a shard itself.
+
+Clients may also connect to the shards directly, routing with
+``container_shard()``/``home_shard()``; the router is a single process,
+so that is how a deployment gets past one core.
+
+Usage: python shard.py [port] --shards N [--base-port P] [server options]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import zlib
+from collections import deque
+from itertools import count
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+from protocol import DEFAULT_PAGE, decode_record, split_tag, tagged
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the answer lines a shard sends before the final one of a streamed listing
+_CHUNK_LABELS = ('ITEMS', 'CONTAINERS')
+_UNKNOWN_ITEM = "ERR 'Unknown item'"
+# a bulk command's answer names the first unknown item
+_UNKNOWN_ONE = "ERR 'Unknown item "
+_SHARD_ONLY = ('WAIT_EVENTS', 'SINCE', 'TOKEN', 'RESUME', 'PROTO', 'HANDOFF_OUT', 'HANDOFF_IN')
+# commands that start with one request to one shard: a client may pipeline
+# them, up to MAX_PIPELINE unanswered ones; any other command waits for
+# the answers before it and runs alone
+_PIPELINED = ('HELP', 'CREATE_ITEM', 'CREATE_CONTAINER', 'WATCH_CONTAINER', 'SETLOC',
+              'STATUS', 'COMPLETE', 'UNLOAD', 'WATCH')
+MAX_PIPELINE = 1000
+# seconds the router waits for its shards to accept connections at startup
+SHARD_START_TIMEOUT = 60.0
+
+
+def container_shard(cid: str, shards: int) -> int:
+    return zlib.crc32(cid.encode('utf-8')) % shards
+
+
+def home_shard(item_id: str, shards: int) -> int:
+    """Shard that created ``item_id`` (``CI<number>``)."""
+    try:
+        return (int(item_id[2:]) - 1) % shards
+    except ValueError:
+        return 0
+
+
+class ShardLink:
+    """One client's connection to one shard.
+
+    A shard answers requests in order, so answers are matched to requests
+    by position; ``EVENT`` lines in between go to ``on_event``.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 on_event: Callable[[bytes], None]) -> None:
+        self.reader = reader
+        self.writer = writer
+        self._on_event = on_event
+        self._pending: Deque[Tuple[asyncio.Future, List[str]]] = deque()
+        self._task = asyncio.get_running_loop().create_task(self._read())
+
+    async def request(self, line: str) -> List[str]:
+        """Send one request line; returns the lines of its answer."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((future, []))
+        self.writer.write((line + '\n').encode('utf-8'))
+        return await future
+
+    async def _read(self) -> None:
+        try:
+            async for raw in self.reader:
+                if raw.startswith(b'EVENT '):
+                    self._on_event(raw)
+                    continue
+                if not self._pending:
+                    continue
+                line = raw.decode('utf-8', errors='ignore').rstrip('\r\n')
+                future, lines = self._pending[0]
+                lines.append(line)
+                if line.split(' ', 1)[0] not in _CHUNK_LABELS:
+                    self._pending.popleft()
+                    if not future.done():
+                        future.set_result(lines)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            while self._pending:
+                future, _ = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError('shard connection lost'))
+
+    async def close(self) -> None:
+        self.writer.close()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class Router:
+    """Routes client sessions to the shards listening at ``addresses``."""
+
+    def __init__(self, addresses: Sequence[Tuple[str, int]]) -> None:
+        if not addresses:
+            raise ValueError('a router needs at least one shard')
+        self.addresses = list(addresses)
+        self.shards = len(self.addresses)
+        # items handed off away from their home shard
+        self._located: Dict[str, int] = {}
+        # item -> client sessions watching it, re-watched after a handoff
+        self._watchers: Dict[str, Set['RouterSession']] = {}
+        self._handoff = asyncio.Lock()
+        self._next_shard = count()
+
+    def item_shard(self, item_id: str) -> int:
+        shard = self._located.get(item_id)
+        return home_shard(item_id, self.shards) if shard is None else shard
+
+    def container_shard(self, cid: str) -> int:
+        return container_shard(cid, self.shards)
+
+    def create_shard(self) -> int:
+        return next(self._next_shard) % self.shards
+
+    def moved(self, item_id: str, shard: int) -> None:
+        if shard == home_shard(item_id, self.shards):
+            self._located.pop(item_id, None)
+        else:
+            self._located[item_id] = shard
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = RouterSession(self, reader, writer)
+        try:
+            await session.connect()
+        except OSError:
+            writer.write(b'ERR shard unavailable\n')
+            writer.close()
+            return
+        await session.run()
+
+
+class RouterSession:
+    """One client of the router, with its link to every shard.
+
+    Requests run as tasks and ``_write_answers`` writes their answers in
+    request order, every answer that is ready in one write.  A pipelined
+    command sends its shard request as soon as its task starts; tasks start
+    in creation order, so every shard sees a client's requests in order.
+    """
+
+    def __init__(self, router: Router, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.router = router
+        self.reader = reader
+        self.writer = writer
+        self.links: List[ShardLink] = []
+        self._answers: Deque[Tuple[Optional[str], asyncio.Task]] = deque()
+        self._queued = asyncio.Event()
+        self._written = asyncio.Event()
+        self._closing = False
+
+    async def connect(self) -> None:
+        for host, port in self.router.addresses:
+            reader, writer = await asyncio.open_connection(host, port)
+            self.links.append(ShardLink(reader, writer, self.writer.write))
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        writing = loop.create_task(self._write_answers())
+        try:
+            async for raw in self.reader:
+                tag, line = split_tag(raw.decode('utf-8', errors='ignore').strip())
+                if not line:
+                    continue
+                pipelined = line.split(None, 1)[0].upper() in _PIPELINED
+                if not pipelined or len(self._answers) >= MAX_PIPELINE:
+                    await self._caught_up()
+                self._answers.append((tag, loop.create_task(self._execute(line))))
+                self._queued.set()
+                if not pipelined:
+                    await self._caught_up()
+                if self._closing:
+                    break
+            await self._caught_up()
+        except (ConnectionError, ValueError):
+            # client went away or sent an over-long line
+            pass
+        finally:
+            writing.cancel()
+            for watchers in self.router._watchers.values():
+                watchers.discard(self)
+            for link in self.links:
+                await link.close()
+            self.writer.close()
+
+    async def _caught_up(self) -> None:
+        """Wait until every queued answer has been written."""
+        while self._answers:
+            self._written.clear()
+            await self._written.wait()
+
+    async def _execute(self, line: str) -> Tuple[List[str], bool]:
+        try:
+            return await self.execute(line)
+        except ConnectionError as e:
+            return ['ERR ' + str(e)], False
+        except Exception as e:
+            return ['ERR ' + str(e)], True
+
+    async def _write_answers(self) -> None:
+        answers = self._answers
+        try:
+            while True:
+                if not answers:
+                    self._written.set()
+                    self._queued.clear()
+                    await self._queued.wait()
+                    continue
+                out: List[str] = []
+                # the first answer, then whatever is ready behind it
+                while answers and not self._closing and (not out or answers[0][1].done()):
+                    tag, task = answers[0]
+                    lines, cont = await task
+                    answers.popleft()
+                    out.extend(tagged(tag, text) for text in lines)
+                    self._closing = not cont
+                self.writer.write(('\n'.join(out) + '\n').encode('utf-8'))
+                await self.writer.drain()
+        except ConnectionError:
+            self._closing = True
+        finally:
+            for _, task in answers:
+                task.cancel()
+            answers.clear()
+            self._written.set()
+
+    async def execute(self, line: str) -> Tuple[List[str], bool]:
+        parts = line.split()
+        cmd = parts[0].upper()
+        args = parts[1:]
+        router = self.router
+
+        if cmd == 'QUIT':
+            return ['OK bye'], False
+        if cmd in _SHARD_ONLY:
+            raise ValueError(f'{cmd} is not supported by the router')
+        if cmd == 'HELP':
+            return await self.links[0].request(line), True
+        if cmd in ('USER', 'SETVIEW', 'SAVE'):
+            answers = await self._all(line)
+            failed = [lines[-1] for lines in answers if not lines[-1].startswith('OK')]
+            return (failed[:1] or answers[0]), True
+        if cmd == 'CREATE_ITEM':
+            return await self.links[router.create_shard()].request(line), True
+        if cmd in ('CREATE_CONTAINER', 'WATCH_CONTAINER', 'SETLOC') and args:
+            return await self.links[router.container_shard(args[0])].request(line), True
+        if cmd in ('STATUS', 'COMPLETE', 'UNLOAD', 'WATCH') and len(args) == 1:
+            lines = await self._on_item(args[0], line)
+            if cmd == 'WATCH' and lines[-1].startswith('OK'):
+                router._watchers.setdefault(args[0], set()).add(self)
+            return lines, True
+        if cmd == 'LOAD' and len(args) == 2:
+            return await self._load(args[1], args[:1], line), True
+        if cmd == 'LOAD_MANY' and len(args) >= 2:
+            return await self._load(args[0], args[1:], line), True
+        if cmd == 'MOVE' and len(args) >= 3:
+            source, target, item_ids = args[0], args[1], args[2:]
+            if router.container_shard(source) == router.container_shard(target):
+                return await self._load(target, item_ids, line), True
+            # each item is handed off only if it is in ``source``
+            lines = await self._load(target, item_ids, 'LOAD_MANY ' + ' '.join([target] + item_ids), source)
+            if lines[-1].startswith('OK'):
+                lines = [f'OK moved {len(item_ids)} from {source} to {target}']
+            return lines, True
+        if cmd == 'UNLOAD_MANY' and args:
+            unloaded = 0
+            pending = list(dict.fromkeys(args))
+            while pending:
+                groups: Dict[int, List[str]] = {}
+                for item_id in pending:
+                    groups.setdefault(router.item_shard(item_id), []).append(item_id)
+                pending = []
+                for shard, item_ids in groups.items():
+                    lines = await self.links[shard].request('UNLOAD_MANY ' + ' '.join(item_ids))
+                    # a shard checks every item before unloading any: if it
+                    # does not have one the router lost track of, find that
+                    # item and send the group again
+                    answer = lines[-1]
+                    missing = answer[len(_UNKNOWN_ONE):-1] if answer.startswith(_UNKNOWN_ONE) else None
+                    if missing in item_ids and await self._locate(missing) not in (None, shard):
+                        pending.extend(item_ids)
+                        continue
+                    if not lines[-1].startswith('OK'):
+                        return lines, True
+                    unloaded += len(item_ids)
+            return [f'OK unloaded {unloaded}'], True
+        if cmd in ('LIST_ITEMS', 'LIST_CONTAINERS', 'FIND_ITEMS', 'CONTAINERS_IN_VIEW', 'EVENT_STATS', 'SAVE_STATS'):
+            return await self._merged(cmd, args, line), True
+        # unknown commands and usage errors: any shard answers them the same
+        return await self.links[0].request(line), True
+
+    async def _all(self, line: str) -> List[List[str]]:
+        return list(await asyncio.gather(*(link.request(line) for link in self.links)))
+
+    async def _on_item(self, item_id: str, line: str) -> List[str]:
+        lines = await self.links[self.router.item_shard(item_id)].request(line)
+        if lines[-1] == _UNKNOWN_ITEM and await self._locate(item_id) is not None:
+            lines = await self.links[self.router.item_shard(item_id)].request(line)
+        return lines
+
+    async def _locate(self, item_id: str) -> Optional[int]:
+        """Find an item the router has lost track of (e.g. after a restart)."""
+        answers = await self._all('STATUS ' + item_id)
+        for shard, lines in enumerate(answers):
+            if lines[-1].startswith('OK'):
+                self.router.moved(item_id, shard)
+                return shard
+        return None
+
+    async def _load(self, cid: str, item_ids: List[str], line: str, source: Optional[str] = None) -> List[str]:
+        """Bring ``item_ids`` to the shard of ``cid``, then run ``line`` there.
+
+        A handed off item must be in no container, or in ``source`` for a
+        MOVE, as a single server checks before a LOAD or MOVE.
+        """
+        router = self.router
+        target = router.container_shard(cid)
+        for item_id in item_ids:
+            if source is not None or router.item_shard(item_id) != target:
+                error = await self._handoff(item_id, target, cid, source)
+                if error is not None:
+                    return [error]
+        return await self.links[target].request(line)
+
+    async def _handoff(self, item_id: str, target: int, cid: str, expected: Optional[str] = None) -> Optional[str]:
+        """Move one item to shard ``target``; returns an error line or None.
+
+        The item must be in container ``expected``, or in none if that is
+        None; the shard holding it refuses the handoff otherwise.
+        """
+        router = self.router
+        out_line = f'HANDOFF_OUT {item_id} {expected or "-"}'
+        async with router._handoff:
+            # an item in ``expected`` lives on that container's shard
+            source = router.item_shard(item_id) if expected is None else router.container_shard(expected)
+            if source == target:
+                return None
+            out = (await self.links[source].request(out_line))[-1]
+            if out == _UNKNOWN_ITEM:
+                source = await self._locate(item_id)
+                if source is None or (source == target and expected is None):
+                    return None if source == target else out
+                # on the wrong shard for ``expected``: the shard says why
+                out = (await self.links[source].request(out_line))[-1]
+            if not out.startswith('OK '):
+                return out
+            record = out[3:]
+            answer = (await self.links[target].request(f'HANDOFF_IN {record} {cid}'))[-1]
+            if not answer.startswith('OK'):
+                # hand it back, into the container it came from
+                previous = decode_record(record).get('cid')
+                await self.links[source].request(f'HANDOFF_IN {record}')
+                if previous:
+                    await self.links[source].request(f'LOAD {item_id} {previous}')
+                return answer
+            router.moved(item_id, target)
+            for session in list(router._watchers.get(item_id, ())):
+                await session.links[target].request('WATCH ' + item_id)
+        return None
+
+    async def _merged(self, cmd: str, args: List[str], line: str) -> List[str]:
+        answers = await self._all(line)
+        for lines in answers:
+            if not lines[-1].startswith('OK'):
+                return lines
+        if args and args[0].upper() == 'STREAM' and cmd in ('LIST_ITEMS', 'LIST_CONTAINERS'):
+            chunks = [text for lines in answers for text in lines[:-1]]
+            total = sum(int(lines[-1][3:]) for lines in answers)
+            return chunks + [f'OK {total}']
+        bodies = [json.loads(lines[-1][3:]) for lines in answers]
+        if cmd in ('EVENT_STATS', 'SAVE_STATS'):
+            # one entry per shard
+            return ['OK ' + json.dumps(bodies)]
+        if isinstance(bodies[0], list):
+            return ['OK ' + json.dumps([entry for body in bodies for entry in body])]
+        # a page: every shard's page after the cursor, merged by id; the
+        # next page asks every shard again after the last id kept
+        key, id_field = ('items', 'id') if cmd == 'LIST_ITEMS' else ('containers', 'cid')
+        limit = int(args[1]) if len(args) > 1 else DEFAULT_PAGE
+        entries = sorted((entry for body in bodies for entry in body[key]), key=lambda entry: entry[id_field])
+        more = len(entries) > limit or any(body['next'] is not None for body in bodies)
+        entries = entries[:limit]
+        page = {key: entries, 'next': entries[-1][id_field] if more and entries else None}
+        return ['OK ' + json.dumps(page)]
+
+
+async def serve_router(port: int, addresses: Sequence[Tuple[str, int]]) -> None:
+    router = Router(addresses)
+    server = await asyncio.start_server(router.serve, port=port, backlog=1024)
+    print(f'router listening on port {port}, {len(addresses)} shards')
+    async with server:
+        await server.serve_forever()
+
+
+def shard_state_file(state_file: str, index: int) -> str:
+    """The snapshot of shard ``index``: ``state.json`` becomes ``state.shardK.json``."""
+    base, ext = os.path.splitext(state_file)
+    return f'{base}.shard{index}{ext}'
+
+
+def start_shards(shards: int, base_port: int, server_args: Sequence[str] = (),
+                 state_file: str = 'server_state.json') -> List[subprocess.Popen]:
+    """Start ``shards`` server processes on ``base_port``, ``base_port + 1``, ...
+
+    Each one saves to its own file named after ``state_file``.
+    """
+    procs = []
+    for index in range(shards):
+        procs.append(subprocess.Popen([
+            sys.executable, os.path.join(HERE, 'server.py'), str(base_port + index),
+            *server_args,
+            '--shard', f'{index}/{shards}',
+            '--state-file', shard_state_file(state_file, index),
+        ]))
+    return procs
+
+
+def wait_for_shards(addresses: Sequence[Tuple[str, int]], procs: Sequence[subprocess.Popen] = (),
+                    timeout: float = SHARD_START_TIMEOUT) -> None:
+    """Wait until every shard accepts connections (a snapshot may take a
+    while to load); raises ``RuntimeError`` if one exits or ``timeout``
+    seconds pass first."""
+    deadline = time.monotonic() + timeout
+    for index, address in enumerate(addresses):
+        while True:
+            try:
+                socket.create_connection(address, timeout=1.0).close()
+                break
+            except OSError:
+                if index < len(procs) and procs[index].poll() is not None:
+                    raise RuntimeError(f'shard {index} exited with status {procs[index].returncode}') from None
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'shard {index} at {address[0]}:{address[1]} did not start') from None
+                time.sleep(0.05)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Sharded cargo tracking server')
+    parser.add_argument('port', nargs='?', type=int, default=5000)
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--base-port', type=int, default=5101, help='port of shard 0; shard K listens on base + K')
+    parser.add_argument('--connect', help='route to running shards instead: host:port,host:port,...')
+    parser.add_argument('--state-file', default='server_state.json',
+                        help='snapshot name; shard K saves to <name>.shardK<ext>')
+    args, server_args = parser.parse_known_args(argv)
+    procs = []
+    if args.connect:
+        addresses = [(host, int(port)) for host, port in (entry.rsplit(':', 1) for entry in args.connect.split(','))]
+    else:
+        procs = start_shards(args.shards, args.base_port, server_args, args.state_file)
+        addresses = [('127.0.0.1', args.base_port + index) for index in range(args.shards)]
+    try:
+        wait_for_shards(addresses, procs)
+        asyncio.run(serve_router(args.port, addresses))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
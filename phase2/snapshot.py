@@ -0,0 +1,569 @@
+"""Snapshot file formats for the cargo server.
+
+The JSON snapshot is a single object with a ``containers`` and an ``items``
+array.  It is written one record per line, containers first, and read back
+incrementally so that loading never holds more than one parsed record (plus
+the model being rebuilt) in memory.
+
+The binary snapshot (any path ending in ``.bin``) is a fixed header
+followed by length-prefixed records::
+
+    header   <8s H H I Q I>  magic, version, flags, containers, items, strings
+    record   <I> length, then ``length`` bytes starting with a kind byte
+      string     kind 1, UTF-8 text; strings are numbered in file order
+      container  kind 2, <I I I d d> cid, description, type, lon, lat
+      item       kind 3, <I I I I I I B> sender, recipient, address, owner,
+                 state, container (NO_STRING if none), deleted flag,
+                 followed by the UTF-8 tracking id
+
+Repeated text (owners, senders, states, container ids) is written once as
+a string record and referenced by index afterwards.
+
+Version 2 files append an index after the records, so ``MappedSnapshot``
+can map the file and decode single records on demand instead of reading
+it through::
+
+    offsets  <Q> per string, per container, then per item in id order
+    members  <Q> per container, the offset of its member list
+    lists    per container <I> count, then <I> item positions (id order)
+    trailer  <Q I 8s> index offset, position of the highest id, index magic
+
+``iter_binary_records`` reads both versions and ignores the index.  Both
+readers yield the same normalized records::
+
+    ("container", (cid, description, type, (lon, lat)))
+    ("item", (id, sendernam, recipnam, recipaddr, owner, state, container, deleted))
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_SEPARATOR = re.compile(r"[ \t\r\n]*([,\]])")
+
+
+class _JsonStream:
+    """Pulls JSON values out of a text stream one at a time."""
+
+    def __init__(self, handle: TextIO, chunk_size: int = 1 << 16) -> None:
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._handle.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # drop the consumed prefix; what is left is at most one partial value
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expected '{char}' in snapshot, found '{found or 'EOF'}'")
+        self._pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        scan = self._decoder.scan_once
+        while True:
+            try:
+                obj, end = scan(self._buf, self._pos)
+            except (StopIteration, json.JSONDecodeError):
+                # the value is cut off at the end of the buffer
+                if not self._fill():
+                    raise ValueError(f"invalid JSON value in snapshot at offset {self._pos}")
+                continue
+            if end == len(self._buf) and self._fill():
+                # a number may continue in the next chunk; decode again
+                continue
+            self._pos = end
+            return obj
+
+    def array(self) -> Iterator[Any]:
+        """Yield the elements of the array whose ``[`` was just consumed."""
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        skip = _WHITESPACE.match
+        separator = _SEPARATOR.match
+        scan = self._decoder.scan_once
+        while True:
+            buf = self._buf
+            pos = skip(buf, self._pos).end()
+            try:
+                obj, end = scan(buf, pos)
+                match = separator(buf, end)
+            except (StopIteration, json.JSONDecodeError):
+                match = None
+            if match is None:
+                # element or its separator is cut off at the end of the buffer
+                if not self._fill():
+                    raise ValueError(f"invalid array element in snapshot at offset {pos}")
+                continue
+            self._pos = match.end()
+            yield obj
+            if match.group(1) == "]":
+                return
+
+
+def iter_json_snapshot(handle: TextIO, chunk_size: int = 1 << 16) -> Iterator[Tuple[str, Any]]:
+    """Yield ``(section, record)`` pairs from a JSON snapshot, in file order.
+
+    Every top-level array is streamed element by element; other top-level
+    values are skipped.
+    """
+    stream = _JsonStream(handle, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if stream.peek() == "[":
+            stream.expect("[")
+            for record in stream.array():
+                yield key, record
+        else:
+            stream.value()
+        if stream.peek() != ",":
+            break
+        stream.expect(",")
+    stream.expect("}")
+
+
+def write_json_snapshot(
+    handle: TextIO,
+    containers: Iterable[str],
+    items: Iterable[str],
+) -> None:
+    """Write already-serialized container and item payloads as a snapshot.
+
+    Containers come first so a streaming reader can link every item to its
+    container as soon as the item is read.
+    """
+    for index, (section, payloads) in enumerate((("containers", containers), ("items", items))):
+        handle.write("{" if index == 0 else ",\n")
+        handle.write(f'"{section}": [')
+        first = True
+        for payload in payloads:
+            handle.write("\n" if first else ",\n")
+            handle.write(payload)
+            first = False
+        handle.write("\n]")
+    handle.write("}\n")
+
+
+def iter_json_records(handle: TextIO) -> Iterator[Tuple[str, tuple]]:
+    """Yield normalized records from a JSON snapshot, skipping bad ones."""
+    for section, payload in iter_json_snapshot(handle):
+        try:
+            if section == "containers":
+                yield "container", (
+                    payload["cid"],
+                    payload["description"],
+                    payload["type"],
+                    tuple(payload["loc"]),
+                )
+            elif section == "items":
+                yield "item", (
+                    payload["id"],
+                    payload["sendernam"],
+                    payload["recipnam"],
+                    payload["recipaddr"],
+                    payload["owner"],
+                    payload.get("state", "accepted"),
+                    payload.get("container"),
+                    payload.get("deleted", False),
+                )
+        except (KeyError, TypeError):
+            continue
+
+
+############ Binary format ############
+
+BINARY_MAGIC = b"CARGOSNP"
+INDEX_MAGIC = b"CARGOIDX"
+BINARY_VERSION = 2
+NO_STRING = 0xFFFFFFFF
+
+_HEADER = struct.Struct("<8sHHIQI")
+_LENGTH = struct.Struct("<I")
+_OFFSET = struct.Struct("<Q")
+_CONTAINER = struct.Struct("<BIIIdd")
+_ITEM = struct.Struct("<BIIIIIIB")
+_TRAILER = struct.Struct("<QI8s")
+_KIND_STRING = 1
+_KIND_CONTAINER = 2
+_KIND_ITEM = 3
+
+
+def is_binary_snapshot(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() == ".bin"
+
+
+def item_record(item: Any) -> tuple:
+    """Return the normalized snapshot record of a ``CargoItem``."""
+    return (
+        item.trackingId(),
+        item.sender_name,
+        item.recipient_name,
+        item.recipient_address,
+        item.owner,
+        item.state,
+        item.getContainer(),
+        item._deleted,
+    )
+
+
+def container_record(container: Any) -> tuple:
+    """Return the normalized snapshot record of a ``Container``."""
+    return (container.cid, container.description, container.type, tuple(container.loc))
+
+
+def id_rank(item_id: str) -> Tuple[int, str]:
+    """Sort key under which the newest generated tracking id is the highest."""
+    return len(item_id), item_id
+
+
+class _RecordWriter:
+    """Writes length-prefixed records, keeping track of their offsets, and
+    interns strings, emitting each one the first time."""
+
+    def __init__(self, handle: BinaryIO, pos: int) -> None:
+        self._write = handle.write
+        self.pos = pos
+        self._index: Dict[str, int] = {}
+        self.string_offsets: List[int] = []
+
+    def record(self, body: bytes) -> int:
+        offset = self.pos
+        self._write(_LENGTH.pack(len(body)))
+        self._write(body)
+        self.pos += _LENGTH.size + len(body)
+        return offset
+
+    def ref(self, text: Optional[str]) -> int:
+        if text is None:
+            return NO_STRING
+        idx = self._index.get(text)
+        if idx is None:
+            idx = self._index[text] = len(self._index)
+            self.string_offsets.append(self.record(bytes((_KIND_STRING,)) + text.encode("utf-8")))
+        return idx
+
+
+def _packed(code: str, values: List[int]) -> bytes:
+    data = array(code, values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def write_binary_snapshot(
+    handle: BinaryIO,
+    containers: List[tuple],
+    items: List[tuple],
+) -> None:
+    """Write normalized container and item records in the binary format.
+
+    ``handle`` must be seekable: the string count is patched into the
+    header once all records are written.
+    """
+    start = handle.tell()
+    handle.write(_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(containers), len(items), 0))
+    out = _RecordWriter(handle, start + _HEADER.size)
+    ref = out.ref
+    record = out.record
+    container_offsets = []
+    for cid, description, type_, loc in containers:
+        container_offsets.append(record(
+            _CONTAINER.pack(_KIND_CONTAINER, ref(cid), ref(description), ref(type_), loc[0], loc[1])
+        ))
+    item_offsets = []
+    for item_id, sender, recipient, address, owner, state, container_id, deleted in items:
+        item_offsets.append(record(_ITEM.pack(
+            _KIND_ITEM,
+            ref(sender),
+            ref(recipient),
+            ref(address),
+            ref(owner),
+            ref(state),
+            ref(container_id),
+            1 if deleted else 0,
+        ) + item_id.encode("utf-8")))
+    _write_index(handle, out.pos, out.string_offsets, containers, container_offsets, items, item_offsets)
+    end = handle.tell()
+    handle.seek(start)
+    handle.write(_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(containers), len(items), len(out.string_offsets)))
+    handle.seek(end)
+
+
+def _write_index(
+    handle: BinaryIO,
+    pos: int,
+    string_offsets: List[int],
+    containers: List[tuple],
+    container_offsets: List[int],
+    items: List[tuple],
+    item_offsets: List[int],
+) -> None:
+    ids = [item[0] for item in items]
+    if any(a >= b for a, b in zip(ids, islice(ids, 1, None))):
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        ids = [ids[i] for i in order]
+        item_offsets = [item_offsets[i] for i in order]
+        items = [items[i] for i in order]
+    slots = {container[0]: slot for slot, container in enumerate(containers)}
+    members: List[List[int]] = [[] for _ in containers]
+    for position, item in enumerate(items):
+        slot = slots.get(item[6])
+        if slot is not None:
+            members[slot].append(position)
+    top = bisect_left(ids, max(ids, key=id_rank)) if ids else NO_STRING
+
+    lists = []
+    list_offsets = []
+    at = pos + _OFFSET.size * (len(string_offsets) + 2 * len(containers) + len(items))
+    for positions in members:
+        list_offsets.append(at)
+        lists.append(_LENGTH.pack(len(positions)) + _packed("I", positions))
+        at += len(lists[-1])
+    handle.write(_packed("Q", string_offsets + container_offsets + item_offsets + list_offsets))
+    handle.write(b"".join(lists))
+    handle.write(_TRAILER.pack(pos, top, INDEX_MAGIC))
+
+
+def iter_binary_records(handle: BinaryIO, chunk_size: int = 1 << 20) -> Iterator[Tuple[str, tuple]]:
+    """Yield normalized records from a binary snapshot, reading in chunks.
+
+    Raises ``ValueError`` for a truncated or corrupt snapshot.
+    """
+    try:
+        yield from _binary_records(handle, chunk_size)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        # e.g. a string number past the strings read so far
+        raise ValueError("corrupt binary snapshot") from None
+
+
+def _binary_records(handle: BinaryIO, chunk_size: int) -> Iterator[Tuple[str, tuple]]:
+    header = handle.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+        raise ValueError("binary snapshot header truncated")
+    magic, version, _flags, n_containers, n_items, n_strings = _HEADER.unpack(header)
+    if magic != BINARY_MAGIC:
+        raise ValueError("not a binary cargo snapshot")
+    if version not in (1, BINARY_VERSION):
+        raise ValueError(f"unsupported binary snapshot version {version}")
+
+    strings: List[str] = []
+    seen_containers = seen_items = 0
+    # a version 2 index follows the last record and is not read here
+    left = n_containers + n_items + n_strings
+    unpack_length = _LENGTH.unpack_from
+    unpack_container = _CONTAINER.unpack_from
+    unpack_item = _ITEM.unpack_from
+    item_size = _ITEM.size
+    container_size = _CONTAINER.size
+    buf = b""
+    while left:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        # what is left of buf is at most one partial record
+        buf = buf + chunk if buf else chunk
+        pos = 0
+        end = len(buf)
+        while left and pos + 4 <= end:
+            (length,) = unpack_length(buf, pos)
+            if pos + 4 + length > end:
+                break
+            body = pos + 4
+            pos = body + length
+            left -= 1
+            if not length:
+                raise ValueError("corrupt binary snapshot")
+            kind = buf[body]
+            if kind == _KIND_STRING:
+                strings.append(buf[body + 1:pos].decode("utf-8"))
+            elif kind == _KIND_ITEM:
+                if length < item_size:
+                    raise ValueError("corrupt binary snapshot")
+                _, sender, recipient, address, owner, state, container, deleted = unpack_item(buf, body)
+                seen_items += 1
+                yield "item", (
+                    buf[body + item_size:pos].decode("utf-8"),
+                    strings[sender],
+                    strings[recipient],
+                    strings[address],
+                    strings[owner],
+                    strings[state],
+                    None if container == NO_STRING else strings[container],
+                    deleted == 1,
+                )
+            elif kind == _KIND_CONTAINER:
+                if length < container_size:
+                    raise ValueError("corrupt binary snapshot")
+                _, cid, description, type_, lon, lat = unpack_container(buf, body)
+                seen_containers += 1
+                yield "container", (strings[cid], strings[description], strings[type_], (lon, lat))
+            else:
+                raise ValueError(f"unknown binary snapshot record kind {kind}")
+        buf = buf[pos:]
+
+    if left or (version == 1 and (buf or handle.read(1))) or (
+        (seen_containers, seen_items, len(strings)) != (n_containers, n_items, n_strings)
+    ):
+        raise ValueError("binary snapshot truncated")
+
+
+class MappedSnapshot:
+    """Random access to a version 2 binary snapshot through ``mmap``.
+
+    Nothing is decoded up front: records are read from the mapped file
+    when asked for, and the pages the OS never had to fault in cost no
+    memory.  Items are addressed by *position*, their rank in id order.
+    Instances are read-only and may be shared between threads.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._open_index()
+        except (ValueError, struct.error):
+            self._map.close()
+            raise
+
+    def _open_index(self) -> None:
+        data = self._map
+        if len(data) < _HEADER.size + _TRAILER.size:
+            raise ValueError("binary snapshot truncated")
+        magic, version, _flags, n_containers, n_items, n_strings = _HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError("not a binary cargo snapshot")
+        if version != BINARY_VERSION:
+            raise ValueError(f"binary snapshot version {version} has no index")
+        index, top, index_magic = _TRAILER.unpack_from(data, len(data) - _TRAILER.size)
+        if index_magic != INDEX_MAGIC:
+            raise ValueError("binary snapshot index missing")
+        self.n_containers = n_containers
+        self.n_items = n_items
+        self._strings_at = index
+        self._containers_at = index + _OFFSET.size * n_strings
+        self._items_at = self._containers_at + _OFFSET.size * n_containers
+        self._lists_at = self._items_at + _OFFSET.size * n_items
+        self._top = top
+        # decoded strings by number; filled as records are read
+        self._strings: Dict[int, str] = {}
+
+    def close(self) -> None:
+        self._map.close()
+
+    def _offset(self, table: int, number: int) -> int:
+        return _OFFSET.unpack_from(self._map, table + _OFFSET.size * number)[0]
+
+    def _string(self, number: int) -> Optional[str]:
+        if number == NO_STRING:
+            return None
+        text = self._strings.get(number)
+        if text is None:
+            at = self._offset(self._strings_at, number)
+            (length,) = _LENGTH.unpack_from(self._map, at)
+            text = self._strings[number] = self._map[at + 5:at + 4 + length].decode("utf-8")
+        return text
+
+    def container(self, slot: int) -> tuple:
+        """The normalized record of the ``slot``-th container."""
+        at = self._offset(self._containers_at, slot) + _LENGTH.size
+        _, cid, description, type_, lon, lat = _CONTAINER.unpack_from(self._map, at)
+        return self._string(cid), self._string(description), self._string(type_), (lon, lat)
+
+    def members(self, slot: int) -> Tuple[int, ...]:
+        """Positions of the items saved in the ``slot``-th container."""
+        at = self._offset(self._lists_at, slot)
+        (count,) = _LENGTH.unpack_from(self._map, at)
+        return struct.unpack_from(f"<{count}I", self._map, at + _LENGTH.size)
+
+    def _id_bytes(self, position: int) -> bytes:
+        at = self._offset(self._items_at, position)
+        (length,) = _LENGTH.unpack_from(self._map, at)
+        return self._map[at + _LENGTH.size + _ITEM.size:at + _LENGTH.size + length]
+
+    def item_id(self, position: int) -> str:
+        return self._id_bytes(position).decode("utf-8")
+
+    def item(self, position: int) -> tuple:
+        """The normalized record of the item at ``position``."""
+        return next(self.items((position,)))
+
+    def items(self, positions: Iterable[int]) -> Iterator[tuple]:
+        """The normalized records of the items at ``positions``, in turn."""
+        data = self._map
+        table = self._items_at
+        unpack_offset = _OFFSET.unpack_from
+        unpack_length = _LENGTH.unpack_from
+        unpack_item = _ITEM.unpack_from
+        item_size = _ITEM.size
+        cached = self._strings.get
+        string = self._string
+        for position in positions:
+            (at,) = unpack_offset(data, table + 8 * position)
+            (length,) = unpack_length(data, at)
+            body = at + 4
+            _, sender, recipient, address, owner, state, container, deleted = unpack_item(data, body)
+            yield (
+                data[body + item_size:body + length].decode("utf-8"),
+                cached(sender) or string(sender),
+                cached(recipient) or string(recipient),
+                cached(address) or string(address),
+                cached(owner) or string(owner),
+                cached(state) or string(state),
+                None if container == NO_STRING else cached(container) or string(container),
+                deleted == 1,
+            )
+
+    def find(self, item_id: str) -> Optional[int]:
+        """The position of ``item_id``, or ``None``; a binary search."""
+        # UTF-8 bytes sort like the code points they encode
+        key = item_id.encode("utf-8")
+        low, high = 0, self.n_items
+        while low < high:
+            middle = (low + high) // 2
+            if self._id_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_items and self._id_bytes(low) == key:
+            return low
+        return None
+
+    def top_id(self) -> Optional[str]:
+        """The highest item id under ``id_rank``, or ``None`` without items."""
+        return None if self._top == NO_STRING else self.item_id(self._top)
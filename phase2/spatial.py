@@ -0,0 +1,169 @@
+"""Uniform-grid spatial indexes for container locations and tracker views.
+
+Boxes are ``(left, bottom, right, top)`` in degrees (longitude, latitude);
+a point is a box with no extent.  ``GridIndex`` files every key under each
+grid cell its box overlaps, so a rectangle or point query only visits the
+cells it covers instead of every key.  Boxes that span more than
+``max_cells`` cells (e.g. a tracker watching the whole map) are kept in a
+small side list and checked one by one.
+"""
+
+from __future__ import annotations
+
+import math
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+Box = Tuple[float, float, float, float]
+
+
+def point_box(loc: Tuple[float, float]) -> Box:
+    lon, lat = loc
+    return (lon, lat, lon, lat)
+
+
+def view_box(view_rect: Tuple[float, float, float, float]) -> Box:
+    """Convert a tracker ``(top, left, bottom, right)`` view to a box."""
+    top, left, bottom, right = view_rect
+    return (left, bottom, right, top)
+
+
+def _finite(box: Box) -> Box:
+    if not all(math.isfinite(value) for value in box):
+        raise ValueError("coordinates must be finite numbers")
+    return box
+
+
+def _inverted(box: Box) -> bool:
+    return box[0] > box[2] or box[1] > box[3]
+
+
+def _overlaps(a: Box, b: Box) -> bool:
+    # an inverted box (left > right or bottom > top) overlaps nothing
+    if _inverted(a) or _inverted(b):
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class GridIndex:
+    """Maps keys to boxes and answers overlap queries through a grid."""
+
+    def __init__(self, cell_size: float = 1.0, max_cells: int = 4096) -> None:
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self._lock = Lock()
+        self._boxes: Dict[Any, Box] = {}
+        self._cells: Dict[Tuple[int, int], Set[Any]] = {}
+        self._large: Set[Any] = set()
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._boxes
+
+    def insert(self, key: Any, box: Box) -> None:
+        """Add ``key`` or move it to ``box``."""
+        # checked before anything changes: a box that cannot be filed
+        # could not be removed again either
+        cells = 0 if _inverted(_finite(box)) else self._cell_count(box)
+        with self._lock:
+            self._remove_locked(key)
+            self._boxes[key] = box
+            if _inverted(box):
+                # keep it only for membership
+                return
+            if cells > self.max_cells:
+                self._large.add(key)
+                return
+            for cell in self._cells_of(box):
+                self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key: Any) -> None:
+        with self._lock:
+            self._remove_locked(key)
+
+    def search(self, box: Box) -> List[Any]:
+        """Return the keys whose box overlaps ``box``."""
+        _finite(box)
+        with self._lock:
+            boxes = self._boxes
+            if self._cell_count(box) > len(boxes):
+                # covering more cells than there are keys: scanning is cheaper
+                return [key for key, other in boxes.items() if _overlaps(box, other)]
+            found: Set[Any] = set()
+            cells = self._cells
+            for cell in self._cells_of(box):
+                keys = cells.get(cell)
+                if keys:
+                    found.update(keys)
+            found.update(self._large)
+            return [key for key in found if _overlaps(box, boxes[key])]
+
+    def containing(self, loc: Tuple[float, float]) -> List[Any]:
+        """Return the keys whose box contains the point ``loc``."""
+        return self.search(point_box(loc))
+
+    def _remove_locked(self, key: Any) -> None:
+        box = self._boxes.pop(key, None)
+        if box is None:
+            return
+        if key in self._large:
+            self._large.discard(key)
+            return
+        if _inverted(box):
+            return
+        for cell in self._cells_of(box):
+            keys = self._cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._cells[cell]
+
+    def _cell_range(self, box: Box) -> Tuple[int, int, int, int]:
+        size = self.cell_size
+        return (
+            math.floor(box[0] / size),
+            math.floor(box[1] / size),
+            math.floor(box[2] / size),
+            math.floor(box[3] / size),
+        )
+
+    def _cell_count(self, box: Box) -> int:
+        x0, y0, x1, y1 = self._cell_range(box)
+        return max(0, x1 - x0 + 1) * max(0, y1 - y0 + 1)
+
+    def _cells_of(self, box: Box) -> Iterator[Tuple[int, int]]:
+        x0, y0, x1, y1 = self._cell_range(box)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield (x, y)
+
+
+class LocationIndex(GridIndex):
+    """Container locations by ``cid``, plus the tracker view index.
+
+    Containers added here keep a reference in ``_space`` and report their
+    moves through ``Container.setlocation``.  ``views`` holds the view
+    rectangle of every tracker that has one; it outlives a location index
+    that is rebuilt by a reload.
+    """
+
+    def __init__(self, views: Optional[GridIndex] = None, cell_size: float = 1.0) -> None:
+        super().__init__(cell_size)
+        self.views = views if views is not None else GridIndex(cell_size)
+
+    def add(self, container: Any) -> None:
+        container._space = self
+        self.insert(container.cid, point_box(container.loc))
+
+    def interested_in(self, *locs: Tuple[float, float]) -> Callable[[Any], bool]:
+        """Return a predicate accepting trackers that may care about ``locs``:
+        those without a view and those whose view contains one of them."""
+        views = self.views
+        hits: Set[Any] = set()
+        for loc in locs:
+            hits.update(views.containing(loc))
+        return lambda tracker: tracker in hits or tracker not in views
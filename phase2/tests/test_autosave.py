@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from autosave import Autosaver
+
+
+def _saver(**kwargs):
+    saved = threading.Event()
+    calls = []
+
+    def save():
+        calls.append(time.monotonic())
+        saved.set()
+
+    autosaver = Autosaver(save, **kwargs)
+    autosaver.start()
+    return autosaver, saved, calls
+
+
+def test_1():  # Tests a save starts once the mutation threshold is reached
+    autosaver, saved, calls = _saver(interval=None, threshold=3)
+    try:
+        autosaver.mutated()
+        autosaver.mutated()
+        assert not saved.wait(0.1)
+        autosaver.mutated()
+        assert saved.wait(5)
+        assert len(calls) == 1 and autosaver.pending == 0
+    finally:
+        autosaver.stop()
+        autosaver.join(5)
+    assert not autosaver.is_alive()
+
+
+def test_2():  # Tests the interval only saves when something changed
+    autosaver, saved, calls = _saver(interval=0.05, threshold=None)
+    try:
+        assert not saved.wait(0.2)
+        autosaver.mutated()
+        assert saved.wait(5)
+        time.sleep(0.2)
+        assert len(calls) == 1
+        assert autosaver.stats() == {"interval": 0.05, "threshold": None, "pending": 0, "saves": 1}
+    finally:
+        autosaver.stop()
+        autosaver.join(5)
+    with pytest.raises(ValueError):
+        Autosaver(lambda: None, interval=0)
+
+
+def test_3():  # Tests a failed save keeps the mutations pending, is retried and is not counted
+    results = [False, True]
+    saved = threading.Event()
+
+    def save():
+        if len(results) == 1:
+            saved.set()
+        return results.pop(0)
+
+    autosaver = Autosaver(save, interval=0.05, threshold=None)
+    autosaver.start()
+    try:
+        autosaver.mutated(2)
+        assert saved.wait(5)
+        time.sleep(0.1)
+        assert not results and autosaver.pending == 0 and autosaver.saves == 1
+    finally:
+        autosaver.stop()
+        autosaver.join(5)
@@ -186,3 +186,96 @@ def test_12():  # Tests directory delete requires detach first
     directory.delete(item_id)
 
     assert directory.list() == []
+
+
+def test_13():  # Tests restore keeps the saved id without drawing a new one
+    before = make_item().trackingId()
+
+    restored = CargoItem.restore(
+        "CI00000500", sendernam="S", recipnam="R", recipaddr="A", owner="O", state="complete"
+    )
+    after = make_item().trackingId()
+
+    assert restored.trackingId() == "CI00000500"
+    assert restored.state == "complete"
+    assert int(after[2:]) == int(before[2:]) + 1
+    with pytest.raises(ValueError):
+        CargoItem.restore("CI00000501", sendernam="", recipnam="R", recipaddr="A", owner="O")
+
+
+def test_14():  # Tests slotted layout with lazy tracker set and derived container id
+    item = make_item()
+    tracker = TrackerWithArg()
+
+    assert not hasattr(item, "__dict__")
+    assert item._trackers is None
+    item.track(tracker)
+    item.untrack(tracker)
+    assert item._trackers is None
+
+    container = DummyContainer(cid="CONT-2")
+    item.setContainer(container)
+    assert item.getContainer() == "CONT-2"
+    container.cid = "CONT-3"
+    assert item.getContainer() == "CONT-3"
+    assert json.loads(item.get())["container"] == "CONT-3"
+
+
+def test_15():  # Tests secondary indexes follow update, setContainer, complete and delete
+    directory = CargoDirectory()
+    first = directory.create(sendernam="S", recipnam="R", recipaddr="A", owner="Ann")
+    second = directory.create(sendernam="S", recipnam="R", recipaddr="A", owner="Ann")
+    hub = DummyContainer(state="waiting", cid="HUB-1")
+
+    directory.get(first).setContainer(hub)
+    directory.get(second).update(owner="Bob")
+
+    assert directory.find(owner="Ann") == [first]
+    assert directory.find(state="waiting") == [first]
+    assert directory.find(container="HUB-1") == [first]
+    assert directory.find(owner="Bob", state="accepted") == [second]
+    assert directory.find(owner="Bob", state="waiting") == []
+
+    directory.get(first).complete()
+    assert directory.find(state="complete") == [first]
+    assert directory.find(state="waiting") == []
+
+    directory.attach(second, "user1")
+    assert directory.find(user="user1") == [second]
+    directory.detach(second, "user1")
+    directory.delete(second)
+    assert directory.find(owner="Bob") == []
+    assert directory.find(user="user1") == []
+    with pytest.raises(ValueError):
+        directory.find()
+
+
+def test_16():  # Tests get() is cached until a mutation invalidates it
+    item = make_item()
+
+    first = item.get()
+    assert item.get() is first
+    item.update(owner="Other")
+    assert json.loads(item.get())["owner"] == "Other"
+    item.setContainer(DummyContainer(state="in transit", cid="T-1"))
+    assert json.loads(item.get())["container"] == "T-1"
+    item.complete()
+    assert json.loads(item.get())["state"] == "complete"
+    with pytest.raises(ValueError):
+        item.update(recipnam="Elif", owner="")
+    assert json.loads(item.get())["recipnam"] == "Elif"
+    item.delete()
+    assert json.loads(item.get())["deleted"] is True
+
+
+def test_17():  # Tests page() resumes after a cursor in id order
+    directory = CargoDirectory()
+    for n in (3, 1, 4, 2):
+        directory.add(CargoItem.restore(f"CI0000080{n}", "S", "R", "A", "O"))
+
+    assert directory.page(limit=3) == (["CI00000801", "CI00000802", "CI00000803"], "CI00000803")
+    assert directory.page("CI00000803", 3) == (["CI00000804"], None)
+    directory.delete("CI00000802")
+    assert directory.page("CI00000801", 1) == (["CI00000803"], "CI00000803")
+    with pytest.raises(ValueError):
+        directory.page(limit=0)
@@ -0,0 +1,150 @@
+import json
+import sys
+import threading
+
+import pytest
+
+from cargo_item import CargoItem
+from cargo_store import CargoItemView, CargoStore
+from container import Container
+
+
+def make_store(n=1, **overrides):
+    store = CargoStore()
+    params = {
+        "sendernam": "Nehir",
+        "recipnam": "Aybeniz",
+        "recipaddr": "Ankara",
+        "owner": "Carrier",
+    }
+    params.update(overrides)
+    ids = [store.create(**params) for _ in range(n)]
+    return store, ids
+
+
+class RecordingTracker:
+    def __init__(self):
+        self.calls = []
+
+    def updated(self, obj):
+        self.calls.append(obj)
+
+
+def test_1():  # Tests the directory API works on the columnar store
+    store, (item_id,) = make_store()
+
+    item = store.get(item_id)
+    assert isinstance(item, CargoItemView)
+    assert isinstance(item, CargoItem)
+    assert item.trackingId() == item_id
+    assert json.loads(item.get())["owner"] == "Carrier"
+    assert store.list() == [(item_id, item.get())]
+
+    store.attach(item_id, "user1")
+    assert [i for i, _ in store.listattached("user1")] == [item_id]
+    with pytest.raises(RuntimeError):
+        store.delete(item_id)
+    store.detach(item_id, "user1")
+    store.delete(item_id)
+
+    assert store.list() == []
+    with pytest.raises(KeyError):
+        store.get(item_id)
+
+
+def test_2():  # Tests views write through to the columns and compare by row
+    store, (item_id,) = make_store()
+
+    store.get(item_id).update(owner="Other", recipnam="Elif")
+    item = store.get(item_id)
+
+    assert item == store.get(item_id)
+    assert hash(item) == hash(store.get(item_id))
+    assert item.owner == "Other"
+    assert item.recipient_name == "Elif"
+    with pytest.raises(ValueError):
+        item.update(owner="")
+
+
+def test_3():  # Tests container links and tracker notifications go through views
+    store, (item_id,) = make_store()
+    hub = Container(cid="H1", description="Hub", type="Hub", loc=(1.0, 2.0))
+    tracker = RecordingTracker()
+
+    store.get(item_id).track(tracker)
+    hub.load([store.get(item_id)])
+
+    item = store.get(item_id)
+    assert item in hub._items
+    assert item.getContainer() == "H1"
+    assert item.state == "waiting"
+    assert tracker.calls == [item]
+    assert json.loads(hub.get())["items"] == [item_id]
+
+    hub.unload([store.get(item_id)])
+    assert store.get(item_id).getContainer() is None
+    assert hub._items == set()
+
+
+def test_4():  # Tests column scans count states and filter owners over live rows
+    store, ids = make_store(4)
+    extra = store.create(sendernam="S", recipnam="R", recipaddr="A", owner="Other")
+    store.get(ids[0]).complete()
+    store.delete(ids[1])
+
+    assert store.state_counts() == {"accepted": 3, "complete": 1}
+    assert store.owned_by("Carrier") == [ids[0], ids[2], ids[3]]
+    assert store.owned_by("Other") == [extra]
+    assert store.owned_by("Nobody") == []
+    assert store.in_state("complete") == [ids[0]]
+
+
+def test_5():  # Tests add() absorbs a restored item and interns its strings
+    store = CargoStore()
+    for n in range(3):
+        store.add(CargoItem.restore(f"CI0000070{n}", "S", "R", "A", "O", state="waiting"))
+
+    assert len(store._items) == 3
+    assert "CI00000701" in store._items
+    assert store.get("CI00000702").state == "waiting"
+    assert store._strings == ["S", "R", "A", "O"]
+
+
+def test_6():  # Tests the secondary indexes are maintained through views
+    store, ids = make_store(2)
+    truck = Container(cid="T1", description="Truck", type="Truck", loc=(0.0, 0.0))
+
+    truck.load([store.get(ids[1])])
+
+    assert store.find(container="T1") == [ids[1]]
+    assert store.find(state="in transit") == [ids[1]]
+    assert store.find(owner="Carrier", state="accepted") == [ids[0]]
+    store.delete(ids[0])
+    assert store.find(owner="Carrier") == [ids[1]]
+
+
+def test_7():  # Tests concurrent create() calls each fill their own row in every column
+    store = CargoStore()
+    created = {}
+
+    def creator(n):
+        for k in range(1500):
+            tag = f"t{n}-{k}"
+            created[store.create(sendernam=tag, recipnam="R", recipaddr="A", owner=tag)] = tag
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=creator, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert len(store._items) == len(created) == 8 * 1500
+    for item_id, tag in created.items():
+        item = store.get(item_id)
+        assert item.trackingId() == item_id
+        assert item.sender_name == tag and item.owner == tag
@@ -3,6 +3,8 @@ import pytest
 
 from container import Container
 from cargo_item import CargoItem 
+from notify import UpdateBatch
+from spatial import LocationIndex
 
 class MockCargoItem:
     """A mock CargoItem to track calls from Container."""
@@ -136,5 +138,52 @@ class TestContainer:
         cont.load([item])
         
         cont.setlocation(1, 1)
-        
-        assert item.updated_calls == 1
\ No newline at end of file
+
+        assert item.updated_calls == 1
+
+    def test_9(self, sample_container):
+        # Test get() is cached until a mutation invalidates it
+        cont = sample_container
+        item = MockCargoItem()
+
+        first = cont.get()
+        assert cont.get() is first
+        cont.load([item])
+        assert json.loads(cont.get())["items"] == [item.id]
+        cont.setlocation(5, 6)
+        assert json.loads(cont.get())["loc"] == [5.0, 6.0]
+        cont.update(description="Annex")
+        assert json.loads(cont.get())["description"] == "Annex"
+        cont.unload([item])
+        assert json.loads(cont.get())["items"] == []
+    def test_10(self, sample_container):
+        # Test a batched setlocation defers one call per tracker to deliver()
+        cont = sample_container
+        tracker = MockTracker()
+        cont.track(tracker)
+        item = MockCargoItem()
+        cont.load([item])
+        batch = UpdateBatch()
+
+        cont.setlocation(7, 8, batch=batch)
+
+        assert tracker.updated_calls == []
+        assert item.updated_calls == 0
+        batch.deliver()
+        assert tracker.updated_calls == [cont]
+        assert len(batch) == 0
+
+    def test_11(self, sample_container):
+        # Test non-finite locations are refused and leave the container as it was
+        cont = sample_container
+        space = LocationIndex()
+        space.add(cont)
+        old_loc = cont.loc
+
+        with pytest.raises(ValueError):
+            cont.setlocation(float("inf"), 0)
+        with pytest.raises(ValueError):
+            Container(cid="X1", description="Truck", type="Truck", loc=(float("nan"), 0.0))
+
+        assert cont.loc == old_loc
+        assert space.containing(old_loc) == [cont.cid]
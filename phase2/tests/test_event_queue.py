@@ -0,0 +1,59 @@
+import pytest
+
+from event_queue import EventQueue, EventRing
+
+
+def _event(kind, obj_id, value, **extra):
+    return dict({"when": 0.0, "obj": (kind, obj_id, value)}, **extra)
+
+
+def test_1():  # Tests coalescing keeps one pending event per object with the latest value
+    queue = EventQueue(limit=10, policy="coalesce")
+    queue.push(_event("cargo", "CI1", "accepted"))
+    queue.push(_event("container", "T1", (0, 0), items=["CI1"]))
+    queue.push(_event("cargo", "CI1", "in transit"))
+    queue.push(_event("container", "T1", (1, 1), items=["CI2"]))
+
+    assert [ev["obj"] for ev in queue] == [("cargo", "CI1", "in transit"), ("container", "T1", (1, 1))]
+    assert queue[1]["items"] == ["CI1", "CI2"]
+    assert queue.coalesced == 2
+    assert queue.popleft()["obj"][1] == "CI1"
+    queue.push(_event("cargo", "CI1", "complete"))
+    assert len(queue) == 2
+
+
+def test_2():  # Tests drop_oldest bounds the queue and counts the drops
+    queue = EventQueue(limit=3, policy="drop_oldest")
+    for n in range(5):
+        assert queue.push(_event("cargo", "CI1", n))
+
+    assert [ev["obj"][2] for ev in queue] == [2, 3, 4]
+    assert queue.stats() == {"policy": "drop_oldest", "limit": 3, "queued": 3, "dropped": 2, "coalesced": 0}
+
+
+def test_3():  # Tests disconnect refuses the overflowing event and flags the queue
+    queue = EventQueue(limit=2, policy="disconnect")
+    assert queue.push(_event("cargo", "CI1", 0))
+    assert queue.push(_event("cargo", "CI2", 0))
+    assert not queue.overflowed
+
+    assert not queue.push(_event("cargo", "CI3", 0))
+    assert queue.overflowed
+    assert len(queue) == 2
+    with pytest.raises(ValueError):
+        EventQueue(policy="block")
+
+
+def test_4():  # Tests the ring replays per token and reports evicted ranges
+    ring = EventRing(size=3)
+    for token in ("a", "b"):
+        ring.register(token)
+    ring.extend("a", [dict(_event("cargo", "CI1", 0), seq=1), dict(_event("cargo", "CI1", 1), seq=2)])
+    ring.extend("b", [dict(_event("cargo", "CI2", 0), seq=3)])
+
+    assert [ev["seq"] for ev in ring.since("a", 0)] == [1, 2]
+    assert [ev["seq"] for ev in ring.since("a", 0, limit=1)] == [1]
+    ring.extend("b", [dict(_event("cargo", "CI2", 1), seq=4)])
+    assert ring.since("a", 0) is None
+    assert [ev["seq"] for ev in ring.since("a", 1)] == [2]
+    assert ring.since("unknown", 0) is None
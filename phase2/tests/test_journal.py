@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+
+import journal as journal_module
+from cargo_item import CargoDirectory
+from container import Container
+from journal import Journal, apply_record, journal_path, journal_segments, replay
+
+
+def _write_records(journal):
+    journal.append("create", id="CI00000007", sendernam="S", recipnam="R", recipaddr="A", owner="O")
+    journal.append("container", cid="T1", description="Truck", type="Truck", loc=[0.0, 0.0])
+    journal.append("load", id="CI00000007", cid="T1")
+    journal.append("setloc", cid="T1", loc=[5.0, 6.0])
+    journal.append("complete", id="CI00000007")
+
+
+def test_1(tmp_path):  # Tests a full batch is flushed as JSON lines by the flusher thread
+    journal = Journal(str(tmp_path / "state.journal"), flush_interval=60, batch_size=2)
+    journal.append("complete", id="CI00000001")
+    journal.append("complete", id="CI00000002")
+
+    deadline = time.monotonic() + 5
+    while True:
+        with open(journal.path, encoding="utf-8") as handle:
+            lines = [json.loads(line) for line in handle]
+        if len(lines) == 2 or time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+    journal.close()
+
+    assert lines == [
+        {"op": "complete", "id": "CI00000001"},
+        {"op": "complete", "id": "CI00000002"},
+    ]
+
+
+def test_2(tmp_path):  # Tests replay rebuilds items, containers and links
+    journal = Journal(str(tmp_path / "state.journal"))
+    _write_records(journal)
+    journal.close()
+    directory, containers = CargoDirectory(), {}
+
+    assert replay(journal.path, directory, containers) == 5
+
+    item = directory.get("CI00000007")
+    assert item.getContainer() == "T1"
+    assert item.state == "complete"
+    assert containers["T1"].loc == (5.0, 6.0)
+
+
+def test_3(tmp_path):  # Tests replaying a segment twice gives the same state
+    journal = Journal(str(tmp_path / "state.journal"))
+    _write_records(journal)
+    journal.append("unload", id="CI00000007")
+    journal.close()
+    directory, containers = CargoDirectory(), {}
+
+    replay(journal.path, directory, containers)
+    replay(journal.path, directory, containers)
+
+    assert list(directory._items) == ["CI00000007"]
+    assert directory.get("CI00000007").getContainer() is None
+    assert json.loads(containers["T1"].get())["items"] == []
+
+
+def test_4(tmp_path):  # Tests rotation keeps segments ordered until discarded
+    state = str(tmp_path / "state.json")
+    journal = Journal(journal_path(state))
+    journal.append("container", cid="T1", description="Truck", type="Truck", loc=[0, 0])
+    journal.rotate()
+    journal.append("setloc", cid="T1", loc=[1, 1])
+    journal.flush()
+
+    assert journal_segments(state) == [journal.path + ".old", journal.path]
+
+    journal.discard_rotated()
+    journal.close()
+    assert journal_segments(state) == [journal.path]
+
+
+def test_5(tmp_path):  # Tests a torn trailing line is ignored on replay
+    path = tmp_path / "state.journal"
+    path.write_text('{"op":"container","cid":"T1","description":"d","type":"Hub","loc":[1,2]}\n{"op":"setl')
+    containers = {}
+
+    assert replay(str(path), CargoDirectory(), containers) == 1
+    assert containers["T1"].loc == (1, 2)
+
+
+def test_6():  # Tests load moves an item out of its previous container
+    directory = CargoDirectory()
+    item_id = directory.create(sendernam="S", recipnam="R", recipaddr="A", owner="O")
+    containers = {
+        "A": Container("A", "Hub", "Hub", (0, 0)),
+        "B": Container("B", "Truck", "Truck", (0, 0)),
+    }
+
+    apply_record({"op": "load", "id": item_id, "cid": "A"}, directory, containers)
+    apply_record({"op": "load", "id": item_id, "cid": "B"}, directory, containers)
+
+    assert json.loads(containers["A"].get())["items"] == []
+    assert json.loads(containers["B"].get())["items"] == [item_id]
+    assert directory.get(item_id).state == "in transit"
+
+
+def test_7():  # Tests bulk load, move and unload records replay through the model
+    directory = CargoDirectory()
+    ids = [directory.create(sendernam="S", recipnam="R", recipaddr="A", owner="O") for _ in range(3)]
+    containers = {
+        "A": Container("A", "Hub", "Hub", (0, 0)),
+        "B": Container("B", "Truck", "Truck", (0, 0)),
+    }
+
+    for _ in range(2):
+        apply_record({"op": "load_many", "cid": "A", "ids": ids}, directory, containers)
+        apply_record({"op": "move", "source": "A", "cid": "B", "ids": ids[:2]}, directory, containers)
+        apply_record({"op": "unload_many", "ids": ids[1:]}, directory, containers)
+
+    assert json.loads(containers["A"].get())["items"] == []
+    assert json.loads(containers["B"].get())["items"] == [ids[0]]
+    assert [directory.get(i).state for i in ids] == ["in transit", "accepted", "accepted"]
+
+
+def test_8(tmp_path, monkeypatch):  # Tests append() does not wait for an fsync in progress
+    syncing, release = threading.Event(), threading.Event()
+
+    def slow_fsync(fd):
+        syncing.set()
+        release.wait(5)
+
+    monkeypatch.setattr(journal_module.os, "fsync", slow_fsync)
+    journal = Journal(str(tmp_path / "state.journal"), flush_interval=60, batch_size=1)
+    journal.append("complete", id="CI00000001")
+    assert syncing.wait(5)
+
+    start = time.monotonic()
+    journal.append("complete", id="CI00000002")
+    assert time.monotonic() - start < 1
+    release.set()
+    journal.close()
+    with open(journal.path, encoding="utf-8") as handle:
+        assert [json.loads(line)["id"] for line in handle] == ["CI00000001", "CI00000002"]
+
+
+def test_9(tmp_path):  # Tests rotating a closed journal leaves its file alone
+    journal = Journal(str(tmp_path / "state.journal"))
+    journal.append("complete", id="CI00000001")
+    journal.close()
+
+    journal.rotate()
+
+    assert journal_segments(str(tmp_path / "state.json")) == [journal.path]
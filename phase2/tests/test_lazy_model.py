@@ -0,0 +1,56 @@
+from cargo_item import CargoItem
+from lazy_model import LazyModel
+from snapshot import write_binary_snapshot
+from spatial import GridIndex, LocationIndex, point_box
+
+CONTAINERS = [("LZ-T1", "Truck", "Truck", (1.0, 2.0)), ("LZ-H1", "Hub", "Hub", (5.0, 5.0))]
+ITEMS = [
+    ("CI00000001", "S", "R", "A", "O", "in transit", "LZ-T1", False),
+    ("CI00000002", "S", "R", "A", "O", "accepted", None, False),
+    ("CI00000003", "S", "R", "A", "P", "in transit", "LZ-T1", False),
+]
+
+
+def _model(tmp_path):
+    path = tmp_path / "state.bin"
+    with open(path, "wb") as handle:
+        write_binary_snapshot(handle, CONTAINERS, ITEMS)
+    return LazyModel(str(path), LocationIndex(GridIndex()))
+
+
+def test_1(tmp_path):  # Tests objects are built on first lookup, a container together with its items
+    model = _model(tmp_path)
+    directory, containers = model.directory, model.containers
+    assert model.locations.search(point_box((5.0, 5.0))) == ["LZ-H1"]
+    assert len(directory._items) == 3 and list(containers) == ["LZ-T1", "LZ-H1"]
+    assert not directory._items._live and not containers._live
+
+    item = directory.get("CI00000003")
+    assert set(directory._items._live) == {"CI00000001", "CI00000003"}
+    truck = containers._live["LZ-T1"]
+    assert item._container is truck and truck._items == {item, directory.get("CI00000001")}
+    assert truck._space is model.locations and "LZ-H1" not in containers._live
+    assert "CI00000002" in directory._items and "CI00000009" not in directory._items
+    assert directory._items.get("CI00000009") is None
+
+    directory.remove("CI00000002")
+    directory.add(CargoItem.restore("CI00000007", "S", "R", "A", "O"))
+    assert "CI00000002" not in directory._items and len(directory._items) == 3
+    assert list(directory._items) == ["CI00000001", "CI00000003", "CI00000007"]
+    assert directory.page(limit=2) == (["CI00000001", "CI00000003"], "CI00000003")
+    assert model.newest_ids() == ["CI00000003", "CI00000007"]
+    model.snapshot.close()
+
+
+def test_2(tmp_path):  # Tests find() builds every object once and stays current afterwards
+    model = _model(tmp_path)
+    directory = model.directory
+
+    assert directory.find(owner="P") == ["CI00000003"]
+    assert model.complete and len(directory._items._live) == 3
+    assert directory.find(container="LZ-T1") == ["CI00000001", "CI00000003"]
+    model.containers["LZ-T1"].unload([directory.get("CI00000001")])
+    assert directory.find(state="accepted") == ["CI00000002", "CI00000001"]
+    assert directory.find(container="LZ-T1", state="in transit") == ["CI00000003"]
+    assert sorted(directory.find(owner="O")) == ["CI00000001", "CI00000002"]
+    model.snapshot.close()
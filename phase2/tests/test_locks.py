@@ -0,0 +1,68 @@
+import threading
+
+from locks import LockStripes
+
+
+def _keys_on_distinct_stripes(stripes):
+    first = "CONT-A"
+    for n in range(1000):
+        other = f"CONT-{n}"
+        if stripes.index(other) != stripes.index(first):
+            return first, other
+    raise AssertionError("no distinct stripe found")
+
+
+def test_1():  # Tests a key always maps to the same stripe
+    stripes = LockStripes(8)
+
+    assert stripes.index("CI00000001") == stripes.index("CI00000001")
+    assert 0 <= stripes.index("CI00000001") < len(stripes)
+
+
+def test_2():  # Tests different stripes can be held in parallel
+    stripes = LockStripes(16)
+    key_a, key_b = _keys_on_distinct_stripes(stripes)
+    done = threading.Event()
+
+    def worker():
+        with stripes.hold(key_b):
+            done.set()
+
+    with stripes.hold(key_a):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert done.wait(1.0)
+    thread.join()
+
+
+def test_3():  # Tests the same stripe blocks other threads but is re-entrant
+    stripes = LockStripes(4)
+    entered = threading.Event()
+
+    def worker():
+        with stripes.hold("CONT-A"):
+            entered.set()
+
+    with stripes.hold("CONT-A", None):
+        with stripes.hold("CONT-A"):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            assert not entered.wait(0.1)
+    assert entered.wait(1.0)
+    thread.join()
+
+
+def test_4():  # Tests hold_all excludes every other holder
+    stripes = LockStripes(4)
+    entered = threading.Event()
+
+    def worker():
+        with stripes.hold("anything"):
+            entered.set()
+
+    with stripes.hold_all():
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not entered.wait(0.1)
+    assert entered.wait(1.0)
+    thread.join()
@@ -0,0 +1,27 @@
+import pytest
+
+from protocol import decode_record, encode_record, response_lines, split_tag, tagged
+
+
+def test_1():  # Tests request ids are split off and put in front of every answer line
+    assert split_tag("#7 STATUS CI1") == ("#7", "STATUS CI1")
+    assert split_tag("STATUS CI1") == (None, "STATUS CI1")
+    assert tagged("#7", "OK 1") == "#7 OK 1"
+    assert tagged(None, "OK 1") == "OK 1"
+    assert list(tagged("#7", iter(["ITEMS []", "OK 0"]))) == ["#7 ITEMS []", "#7 OK 0"]
+
+
+def test_2():  # Tests a failing stream ends with an ERR line
+    def stream():
+        yield "ITEMS []"
+        raise KeyError("gone")
+
+    assert list(response_lines(stream())) == ["ITEMS []", "ERR 'gone'"]
+
+
+def test_3():  # Tests item records survive the trip as one whitespace-free argument
+    record = {"id": "CI1", "recipaddr": "12 Main St", "cid": None}
+    text = encode_record(record)
+    assert " " not in text and decode_record(text) == record
+    with pytest.raises(ValueError):
+        decode_record("not a record!")
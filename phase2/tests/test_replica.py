@@ -0,0 +1,153 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from replica import ReplicationHub, follow
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_listening(port):
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+@pytest.fixture
+def primary_and_replica(tmp_path):
+    port, replication_port, replica_port = _free_port(), _free_port(), _free_port()
+    server = os.path.join(HERE, "server.py")
+    procs = [subprocess.Popen(
+        [sys.executable, server, str(port), "--no-journal", "--state-file", str(tmp_path / "state.json"),
+         "--replication-port", str(replication_port)],
+        stdout=subprocess.DEVNULL,
+    )]
+    try:
+        _wait_listening(port)
+        procs.append(subprocess.Popen(
+            [sys.executable, server, str(replica_port), "--replica-of", f"127.0.0.1:{replication_port}"],
+            stdout=subprocess.DEVNULL,
+        ))
+        _wait_listening(replica_port)
+        yield port, replica_port
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+class _Client:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.reader = self.sock.makefile("rb")
+
+    def send(self, line):
+        self.sock.sendall((line + "\n").encode())
+        while True:
+            answer = self.reader.readline().decode().strip()
+            if not answer.startswith("EVENT "):
+                return answer
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def test_1():  # Tests a replica feed gets every record once and is cut off when it falls behind
+    hub = ReplicationHub(backlog=2)
+    hub.publish({"op": "create", "id": "CI1"})
+    feed = hub.subscribe()
+    hub.publish({"op": "load", "id": "CI1", "cid": "C1"})
+    hub.publish({"op": "unload", "id": "CI1"})
+    assert [record["op"] for record in feed.take()] == ["load", "unload"]
+    assert feed.take(timeout=0.01) == []
+    for _ in range(3):
+        hub.publish({"op": "unload", "id": "CI1"})
+    assert feed.overflowed
+    assert feed.take() is None
+    hub.unsubscribe(feed)
+    assert len(hub) == 0
+
+
+def test_2(primary_and_replica):  # Tests a replica mirrors the primary, serves watches and refuses writes
+    port, replica_port = primary_and_replica
+    primary = _Client(port)
+    replica = _Client(replica_port)
+    try:
+        # reaches the replica in its snapshot or as a record, depending on timing
+        item = primary.send("CREATE_ITEM S R A O")[3:]
+        assert primary.send("CREATE_CONTAINER C1 D Truck 0 0") == "OK C1"
+        deadline = time.monotonic() + 10
+        while replica.send(f"WATCH {item}") != f"OK watching {item}":
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        assert primary.send(f"LOAD {item} C1") == f"OK loaded {item} into C1"
+        event = json.loads(replica.reader.readline().decode()[6:])
+        assert event["obj"][:2] == ["cargo", item]
+        assert json.loads(replica.send(f"STATUS {item}")[3:])["container"] == "C1"
+
+        assert replica.send("CREATE_ITEM S R A O").startswith("ERR read-only replica")
+        assert replica.send(f"UNLOAD {item}").startswith("ERR read-only replica")
+        assert primary.send("CREATE_CONTAINER C2 D Ship 5 5") == "OK C2"
+        while "C2" not in replica.send("LIST_CONTAINERS"):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        in_view = json.loads(replica.send("CONTAINERS_IN_VIEW 6 4 4 6")[3:])
+        assert [cont["cid"] for cont in in_view] == ["C2"]
+    finally:
+        primary.close()
+        replica.close()
+
+
+def test_3():  # Tests a follower that cannot apply a stream reconnects and installs a fresh snapshot
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(2)
+    streams = [b'{"op": "synced"}\n{"op": "load", "id": "CI1"}\n', b'["container", ["C1", "D", "Truck", [0, 0]]]\n{"op": "synced"}\n']
+
+    def primary():
+        for stream in streams:
+            conn, _ = listener.accept()
+            conn.sendall(stream)
+            conn.close()
+
+    installed, applied = [], []
+    stop = threading.Event()
+
+    def install(records):
+        installed.append(records)
+        if len(installed) == 2:
+            stop.set()
+
+    def apply(records):
+        applied.append(records)
+        raise KeyError("Unknown item CI1")
+
+    threading.Thread(target=primary, daemon=True).start()
+    follower = threading.Thread(
+        target=follow, args=(listener.getsockname(), install, apply, stop), kwargs={"retry_delay": 0.01}, daemon=True)
+    follower.start()
+    follower.join(5)
+    listener.close()
+
+    assert not follower.is_alive()
+    assert installed == [[], [("container", ("C1", "D", "Truck", (0, 0)))]]
+    assert len(applied) == 1
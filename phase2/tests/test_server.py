@@ -0,0 +1,971 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import server
+from cargo_item import CargoItem
+
+
+async def _open_client():
+    srv = await asyncio.start_server(server._serve_connection, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    return srv, reader, writer
+
+
+async def _send(reader, writer, line):
+    writer.write((line + "\n").encode("utf-8"))
+    await writer.drain()
+    return (await reader.readline()).decode("utf-8").strip()
+
+
+def test_1():  # Tests asyncio session serves the same line protocol
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        try:
+            assert await _send(reader, writer, "USER alice") == "OK hello alice"
+            item_id = (await _send(reader, writer, "CREATE_ITEM S R A O"))[3:]
+            status = await _send(reader, writer, f"STATUS {item_id}")
+            assert json.loads(status[3:])["id"] == item_id
+            assert (await _send(reader, writer, "BOGUS")).startswith("ERR")
+            assert await _send(reader, writer, "QUIT") == "OK bye"
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_2():  # Tests asyncio session pushes events and wakes WAIT_EVENTS
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        port = srv.sockets[0].getsockname()[1]
+        r2, w2 = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            item_id = (await _send(reader, writer, "CREATE_ITEM S R A O"))[3:]
+            assert (await _send(r2, w2, f"WATCH {item_id}")).startswith("OK watching")
+
+            w2.write(b"WAIT_EVENTS\n")
+            await w2.drain()
+            await asyncio.sleep(0.05)
+            assert (await _send(reader, writer, f"COMPLETE {item_id}")).startswith("OK")
+
+            lines = [
+                (await asyncio.wait_for(r2.readline(), 2)).decode().strip()
+                for _ in range(2)
+            ]
+            assert "OK event available" in lines
+            event = json.loads(next(l for l in lines if l.startswith("EVENT"))[6:])
+            assert event["obj"] == ["cargo", item_id, "complete"]
+        finally:
+            writer.close()
+            w2.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize(
+    "argv, port, mode",
+    [([], 5000, "thread"), (["6000", "--mode", "asyncio"], 6000, "asyncio"), (["abc"], 5000, "thread")],
+)
+def test_3(argv, port, mode):  # Tests startup options select the server mode
+    args = server.parse_args(argv)
+
+    assert args.port == port
+    assert args.mode == mode
+
+
+def _distinct_stripe_cids():
+    first = "LOCK-A"
+    for n in range(1000):
+        other = f"LOCK-{n}"
+        if server._locks.index(other) != server._locks.index(first):
+            return first, other
+    raise AssertionError("no distinct stripe found")
+
+
+def test_4():  # Tests writes to different containers do not block each other
+    session = server.CommandSession()
+    cid_a, cid_b = _distinct_stripe_cids()
+    for cid in (cid_a, cid_b):
+        if cid not in server._containers:
+            session.handle(f"CREATE_CONTAINER {cid} Truck Truck 0 0")
+    done = threading.Event()
+
+    def worker():
+        session.handle(f"SETLOC {cid_b} 1 2")
+        done.set()
+
+    with server._locks.hold(cid_a):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert done.wait(1.0)
+    thread.join()
+    assert server._containers[cid_b].loc == (1.0, 2.0)
+
+
+def test_5():  # Tests LOAD and UNLOAD keep item and container in sync
+    session = server.CommandSession()
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    for cid in ("LOAD-T1", "LOAD-T2"):
+        if cid not in server._containers:
+            session.handle(f"CREATE_CONTAINER {cid} Truck Truck 0 0")
+
+    assert session.handle(f"LOAD {item_id} LOAD-T1")[0] == f"OK loaded {item_id} into LOAD-T1"
+    assert server._directory.get(item_id).getContainer() == "LOAD-T1"
+    with pytest.raises(RuntimeError):
+        session.handle(f"LOAD {item_id} LOAD-T2")
+
+    assert session.handle(f"UNLOAD {item_id}")[0] == f"OK unloaded {item_id}"
+    assert server._directory.get(item_id).getContainer() is None
+
+
+def test_6(tmp_path):  # Tests journaled mutations survive a crash without SAVE
+    state = str(tmp_path / "state.json")
+    server.enable_journal(state, compact_interval=3600)
+    try:
+        session = server.CommandSession()
+        item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+        session.handle("CREATE_CONTAINER WAL-T1 Truck Truck 0 0")
+        session.handle(f"LOAD {item_id} WAL-T1")
+        session.handle("SETLOC WAL-T1 3 4")
+        session.handle(f"COMPLETE {item_id}")
+    finally:
+        # simulate a crash: the journal is flushed but no snapshot is written
+        server.close_journal()
+    assert not (tmp_path / "state.json").exists()
+
+    server.load_state(state)
+
+    item = json.loads(server._directory.get(item_id).get())
+    assert item["container"] == "WAL-T1"
+    assert item["state"] == "complete"
+    assert server._containers["WAL-T1"].loc == (3.0, 4.0)
+
+
+def test_7(tmp_path):  # Tests SAVE compacts the journal into the snapshot
+    state = str(tmp_path / "state.json")
+    server.enable_journal(state, compact_interval=3600)
+    try:
+        session = server.CommandSession()
+        item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+        server.save_state(state)
+        session.handle(f"COMPLETE {item_id}")
+    finally:
+        server.close_journal()
+
+    with open(state, encoding="utf-8") as handle:
+        saved = {item["id"]: item for item in json.load(handle)["items"]}
+    with open(tmp_path / "state.journal", encoding="utf-8") as handle:
+        tail = [json.loads(line) for line in handle]
+    assert saved[item_id]["state"] == "accepted"
+    assert tail == [{"op": "complete", "id": item_id}]
+
+    server.load_state(state)
+    assert server._directory.get(item_id).state == "complete"
+
+
+def test_8(tmp_path):  # Tests legacy and streamed snapshots restore links in one pass
+    legacy = {
+        "items": [
+            {"id": "CI00000900", "sendernam": "S", "recipnam": "R", "recipaddr": "A",
+             "owner": "O", "state": "waiting", "container": "SNAP-H1", "deleted": False},
+            {"id": "CI00000901", "sendernam": "S", "recipnam": "R", "recipaddr": "A",
+             "owner": "O", "state": "accepted", "container": None, "deleted": False},
+        ],
+        "containers": [
+            {"cid": "SNAP-H1", "description": "Hub", "type": "Hub", "loc": [1, 2],
+             "items": ["CI00000900"], "deleted": False},
+        ],
+    }
+    state = tmp_path / "state.json"
+    state.write_text(json.dumps(legacy, indent=2))
+
+    server.load_state(str(state))
+    server.save_state(str(state))
+    server.load_state(str(state))
+
+    assert server._directory.get("CI00000900").getContainer() == "SNAP-H1"
+    assert server._directory.get("CI00000900").state == "waiting"
+    assert json.loads(server._containers["SNAP-H1"].get())["items"] == ["CI00000900"]
+    assert server._directory.get("CI00000901").getContainer() is None
+    new_id = server.CommandSession().handle("CREATE_ITEM S R A O")[0][3:]
+    assert new_id == "CI00000902"
+
+
+def test_9(tmp_path):  # Tests the .bin extension selects the binary snapshot format
+    session = server.CommandSession()
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    if "BIN-T1" not in server._containers:
+        session.handle("CREATE_CONTAINER BIN-T1 Truck Truck 7 8")
+    session.handle(f"LOAD {item_id} BIN-T1")
+    state = tmp_path / "state.bin"
+
+    server.save_state(str(state))
+    assert state.read_bytes().startswith(b"CARGOSNP")
+    server.load_state(str(state))
+
+    assert server._directory.get(item_id).getContainer() == "BIN-T1"
+    assert server._directory.get(item_id).state == "in transit"
+    assert server._containers["BIN-T1"].loc == (7.0, 8.0)
+
+
+def test_10(tmp_path, monkeypatch):  # Tests the columnar store serves commands and round-trips a snapshot
+    monkeypatch.setattr(server, "_directory_class", server.CargoStore)
+    monkeypatch.setattr(server, "_directory", server.CargoStore())
+    session = server.CommandSession()
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    if "COL-H1" not in server._containers:
+        session.handle("CREATE_CONTAINER COL-H1 Hub Hub 3 4")
+    assert session.handle(f"LOAD {item_id} COL-H1")[0].startswith("OK")
+    state = tmp_path / "state.bin"
+
+    server.save_state(str(state))
+    server.load_state(str(state))
+
+    assert isinstance(server._directory, server.CargoStore)
+    assert server._directory.get(item_id).getContainer() == "COL-H1"
+    assert server._directory.state_counts() == {"waiting": 1}
+    status = json.loads(session.handle(f"STATUS {item_id}")[0][3:])
+    assert status["state"] == "waiting"
+
+
+def test_11():  # Tests FIND_ITEMS answers from the secondary indexes
+    session = server.CommandSession()
+    item_id = session.handle("CREATE_ITEM S R A FIND-OWNER")[0][3:]
+    if "FIND-T1" not in server._containers:
+        session.handle("CREATE_CONTAINER FIND-T1 Truck Truck 1 1")
+    session.handle(f"LOAD {item_id} FIND-T1")
+
+    by_owner = json.loads(session.handle("FIND_ITEMS owner FIND-OWNER")[0][3:])
+    by_container = json.loads(session.handle("FIND_ITEMS container FIND-T1")[0][3:])
+    in_transit = json.loads(session.handle("FIND_ITEMS STATE in transit")[0][3:])
+
+    assert [item["id"] for item in by_owner] == [item_id]
+    assert [item["id"] for item in by_container] == [item_id]
+    assert item_id in [item["id"] for item in in_transit]
+    with pytest.raises(ValueError):
+        session.handle("FIND_ITEMS colour red")
+
+
+def test_12(monkeypatch):  # Tests LIST_ITEMS pages with a cursor and streams in chunks
+    monkeypatch.setattr(server, "_directory", server.CargoDirectory())
+    session = server.CommandSession()
+    ids = [session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(5)]
+
+    first = json.loads(session.handle("LIST_ITEMS - 2")[0][3:])
+    assert [item["id"] for item in first["items"]] == ids[:2]
+    rest = json.loads(session.handle(f"LIST_ITEMS {first['next']} 10")[0][3:])
+    assert [item["id"] for item in rest["items"]] == ids[2:]
+    assert rest["next"] is None
+
+    stream, keep = session.handle("LIST_ITEMS STREAM 2")
+    lines = list(server.response_lines(stream))
+    assert keep and lines[-1] == "OK 5"
+    chunks = [json.loads(line[len("ITEMS "):]) for line in lines[:-1]]
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [item["id"] for chunk in chunks for item in chunk] == ids
+    with pytest.raises(ValueError):
+        session.handle("LIST_ITEMS - 0")
+
+
+def test_13():  # Tests streamed LIST_CONTAINERS over a connection ends with the count
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        try:
+            for n in range(3):
+                await _send(reader, writer, f"CREATE_CONTAINER STREAM-{n} D Truck 0 0")
+            writer.write(b"LIST_CONTAINERS STREAM 1000\n")
+            await writer.drain()
+            chunk = (await reader.readline()).decode().strip()
+            done = (await reader.readline()).decode().strip()
+            assert chunk.startswith("CONTAINERS [")
+            cids = [c["cid"] for c in json.loads(chunk[len("CONTAINERS "):])]
+            assert {"STREAM-0", "STREAM-1", "STREAM-2"} <= set(cids)
+            assert done == f"OK {len(cids)}"
+            page = json.loads((await _send(reader, writer, "LIST_CONTAINERS STREAM-0 1"))[3:])
+            assert [c["cid"] for c in page["containers"]] == ["STREAM-1"]
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_14():  # Tests CONTAINERS_IN_VIEW answers from the location index
+    session = server.CommandSession()
+    for cid, lon, lat in (("VIEW-A", 101, 51), ("VIEW-B", 102, 52), ("VIEW-C", 140, 10)):
+        if cid not in server._containers:
+            session.handle(f"CREATE_CONTAINER {cid} D Truck {lon} {lat}")
+    session.handle("SETLOC VIEW-C 103 53")
+
+    found = json.loads(session.handle("CONTAINERS_IN_VIEW 60 100 50 110")[0][3:])
+    assert [c["cid"] for c in found] == ["VIEW-A", "VIEW-B", "VIEW-C"]
+
+    session.handle("SETVIEW 52.5 100 50 110")
+    found = json.loads(session.handle("CONTAINERS_IN_VIEW")[0][3:])
+    assert [c["cid"] for c in found] == ["VIEW-A", "VIEW-B"]
+    with pytest.raises(RuntimeError):
+        server.CommandSession().handle("CONTAINERS_IN_VIEW")
+
+
+def test_15():  # Tests SETLOC sends one aggregated event per tracker after the stripe is released
+    session = server.CommandSession()
+    if "FAN-T1" not in server._containers:
+        session.handle("CREATE_CONTAINER FAN-T1 Ship Ship 0 0")
+    item_ids = [session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(3)]
+    for item_id in item_ids:
+        session.handle(f"LOAD {item_id} FAN-T1")
+    session.handle("WATCH_CONTAINER FAN-T1")
+    for item_id in item_ids[:2]:
+        session.handle(f"WATCH {item_id}")
+    session.events.clear()
+    stripe_free = []
+
+    def take_stripe():
+        with server._locks.hold("FAN-T1"):
+            pass
+
+    def on_update(*args):
+        # another thread can take the container's stripe during delivery
+        worker = threading.Thread(target=take_stripe)
+        worker.start()
+        worker.join(1.0)
+        stripe_free.append(not worker.is_alive())
+        session._on_tracker_update(*args)
+
+    session.tracker._on_update = on_update
+    session.handle("SETLOC FAN-T1 5 6")
+
+    assert stripe_free == [True]
+    assert len(session.events) == 1
+    event = session.events[0]
+    assert event["obj"] == ("container", "FAN-T1", (5.0, 6.0))
+    assert sorted(event["items"]) == sorted(item_ids[:2])
+
+
+def test_16():  # Tests LOAD_MANY, MOVE and UNLOAD_MANY with one event per tracker each
+    session = server.CommandSession()
+    for cid in ("BULK-HUB", "BULK-TRUCK"):
+        if cid not in server._containers:
+            session.handle(f"CREATE_CONTAINER {cid} D Truck 0 0")
+    item_ids = [session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(4)]
+    for item_id in item_ids:
+        session.handle(f"WATCH {item_id}")
+    session.events.clear()
+    ids = " ".join(item_ids)
+    events = []
+
+    def handle(line):
+        resp = session.handle(line)[0]
+        # collect per command: still-queued events for one object coalesce
+        events.extend(session.events.drain())
+        return resp
+
+    assert handle(f"LOAD_MANY BULK-HUB {ids}") == "OK loaded 4 into BULK-HUB"
+    assert handle(f"MOVE BULK-HUB BULK-TRUCK {' '.join(item_ids[:3])}") == "OK moved 3 from BULK-HUB to BULK-TRUCK"
+    assert handle(f"UNLOAD_MANY {ids}") == "OK unloaded 4"
+
+    assert [ev["obj"][1] for ev in events] == ["BULK-HUB", "BULK-TRUCK", "BULK-TRUCK", "BULK-HUB"]
+    assert [len(ev["items"]) for ev in events] == [4, 3, 3, 1]
+    assert all(server._directory.get(i).getContainer() is None for i in item_ids)
+
+
+def test_17():  # Tests bulk commands check every item before changing any
+    session = server.CommandSession()
+    for cid in ("BULK-A", "BULK-B"):
+        if cid not in server._containers:
+            session.handle(f"CREATE_CONTAINER {cid} D Truck 0 0")
+    first, second = (session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(2))
+    session.handle(f"LOAD {first} BULK-B")
+
+    with pytest.raises(RuntimeError):
+        session.handle(f"LOAD_MANY BULK-A {second} {first}")
+    with pytest.raises(KeyError):
+        session.handle(f"UNLOAD_MANY {first} NOPE")
+    with pytest.raises(RuntimeError):
+        session.handle(f"MOVE BULK-B BULK-A {first} {second}")
+
+    assert server._directory.get(first).getContainer() == "BULK-B"
+    assert server._directory.get(second).getContainer() is None
+
+
+def test_18(monkeypatch):  # Tests a full queue under the disconnect policy closes the session
+    monkeypatch.setattr(server, "EVENT_QUEUE_LIMIT", 2)
+    monkeypatch.setattr(server, "EVENT_QUEUE_POLICY", "disconnect")
+    session = server.CommandSession()
+    item_ids = [session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(3)]
+    for item_id in item_ids:
+        session.handle(f"WATCH {item_id}")
+
+    for item_id in item_ids:
+        session.handle(f"COMPLETE {item_id}")
+
+    assert not session._running
+    stats = json.loads(session.handle("EVENT_STATS")[0][3:])
+    assert stats["queued"] == 2
+    assert stats["dropped"] == 1
+    assert session.pending_events == 2
+
+
+def test_19():  # Tests _disconnect ends a threaded session blocked in recv
+    import socket
+
+    ours, theirs = socket.socketpair()
+    session = server.Session(ours)
+    session.start()
+    try:
+        session._disconnect()
+        session.join(2.0)
+        assert not session.is_alive()
+    finally:
+        theirs.close()
+
+
+def test_20():  # Tests the notification agent writes a queued burst with one sendall
+    import socket
+
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5.0)
+    session = server.Session(ours)
+    writes = []
+    send_events = session.send_events
+    session.send_events = lambda events: (writes.append(len(events)), send_events(events))
+    session.start()
+    try:
+        with session.cond:
+            for n in range(3):
+                item = CargoItem.restore(f"BURST{n}", "S", "R", "A", "O")
+                session._on_tracker_update(session.tracker, item, item.trackingId())
+        reader = theirs.makefile("rb")
+        lines = [reader.readline() for _ in range(3)]
+        assert all(line.startswith(b"EVENT ") for line in lines)
+        assert writes == [3]
+    finally:
+        session._disconnect()
+        session.join(2.0)
+        theirs.close()
+
+
+def test_21(monkeypatch):  # Tests WAIT_EVENTS <timeout> <max> returns the events and SINCE replays them
+    monkeypatch.setattr(server, "_ring", server.EventRing(2))
+    session = server.CommandSession()
+    item_ids = [session.handle("CREATE_ITEM S R A O")[0][3:] for _ in range(3)]
+    for item_id in item_ids:
+        session.handle(f"WATCH {item_id}")
+        session.handle(f"COMPLETE {item_id}")
+
+    first = json.loads(session.handle("WAIT_EVENTS 0 2")[0][3:])
+    assert [ev["obj"][1] for ev in first["events"]] == item_ids[:2]
+    seq1, seq2 = (ev["seq"] for ev in first["events"])
+    assert seq1 < seq2 == first["seq"]
+    rest = json.loads(session.handle("WAIT_EVENTS 0.01 10")[0][3:])
+    seq3 = rest["seq"]
+    assert [ev["seq"] for ev in rest["events"]] == [seq3]
+    assert json.loads(session.handle("WAIT_EVENTS 0")[0][3:]) == {"events": [], "seq": seq3}
+
+    replay = json.loads(session.handle(f"SINCE {seq1}")[0][3:])
+    assert [ev["seq"] for ev in replay["events"]] == [seq2, seq3]
+    with pytest.raises(RuntimeError):
+        session.handle(f"SINCE {seq1 - 1}")
+    with pytest.raises(ValueError):
+        session.handle("WAIT_EVENTS 1000 1")
+
+
+def test_22():  # Tests an asyncio long poll returns the event in the reply instead of pushing it
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        port = srv.sockets[0].getsockname()[1]
+        r2, w2 = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            item_id = (await _send(reader, writer, "CREATE_ITEM S R A O"))[3:]
+            assert (await _send(r2, w2, f"WATCH {item_id}")).startswith("OK watching")
+
+            w2.write(b"WAIT_EVENTS 2 10\n")
+            await w2.drain()
+            await asyncio.sleep(0.05)
+            assert (await _send(reader, writer, f"COMPLETE {item_id}")).startswith("OK")
+
+            reply = (await asyncio.wait_for(r2.readline(), 2)).decode().strip()
+            batch = json.loads(reply[3:])
+            assert [ev["obj"] for ev in batch["events"]] == [["cargo", item_id, "complete"]]
+            assert batch["seq"] == batch["events"][0]["seq"]
+            assert await _send(r2, w2, "QUIT") == "OK bye"
+        finally:
+            writer.close()
+            w2.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_23():  # Tests RESUME replays what a closed session missed and takes over its tracker
+    import socket
+
+    ours, theirs = socket.socketpair()
+    old = server.Session(ours)  # never started: its events stay queued
+    item_id = old.handle("CREATE_ITEM S R A O")[0][3:]
+    old.handle(f"WATCH {item_id}")
+    old.handle(f"COMPLETE {item_id}")
+    token = old.handle("TOKEN")[0][3:]
+    old.close()
+    theirs.close()
+    # the parked tracker keeps recording while nobody is connected
+    updater = server.CommandSession()
+    if "RESUME-T1" not in server._containers:
+        updater.handle("CREATE_CONTAINER RESUME-T1 D Truck 0 0")
+    updater.handle(f"LOAD {item_id} RESUME-T1")
+
+    new = server.CommandSession()
+    first = json.loads(new.handle(f"RESUME {token} 0 1")[0][3:])
+    assert [ev["obj"][:2] for ev in first["events"]] == [["cargo", item_id]]
+    rest = json.loads(new.handle(f"SINCE {first['seq']}")[0][3:])
+    assert [ev["obj"][2] for ev in rest["events"]] == ["in transit"]
+    assert rest["seq"] > first["seq"]
+
+    updater.handle(f"UNLOAD {item_id}")
+    assert [ev["obj"][2] for ev in new.events] == ["accepted"]
+    with pytest.raises(KeyError):
+        server.CommandSession().handle(f"RESUME {token} 0")
+
+
+def test_24(monkeypatch):  # Tests a closed session cannot be resumed without a grace period
+    import socket
+
+    monkeypatch.setattr(server, "RESUME_GRACE", 0.0)
+    ours, theirs = socket.socketpair()
+    old = server.Session(ours)
+    item_id = old.handle("CREATE_ITEM S R A O")[0][3:]
+    old.handle(f"WATCH {item_id}")
+    token = old.handle("TOKEN")[0][3:]
+    old.close()
+    theirs.close()
+
+    assert old.tracker._deleted
+    with pytest.raises(KeyError):
+        server.CommandSession().handle(f"RESUME {token} 0")
+
+
+def test_25():  # Tests pipelined requests get tagged answers in one write
+    import socket
+
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5.0)
+    session = server.Session(ours)
+    writes = []
+    send_lines = session.send_lines
+    session.send_lines = lambda lines: (writes.append(list(lines)), send_lines(lines))
+    session.start()
+    try:
+        theirs.sendall(b"#1 USER pipe\n#2 BOGUS\nHELP\n#3\n#4 QUIT\n")
+        reader = theirs.makefile("rb")
+        lines = [reader.readline().decode().rstrip("\n") for _ in range(5)]
+        session.join(2.0)
+    finally:
+        theirs.close()
+
+    assert lines[0] == "#1 OK hello pipe"
+    assert lines[1] == "#2 ERR Unknown command"
+    assert lines[2].startswith("Commands:")
+    assert lines[3] == "#3 ERR Empty request"
+    assert lines[4] == "#4 OK bye"
+    assert len(writes) == 1
+
+
+def test_26():  # Tests asyncio answers tag every line of a streamed listing
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        try:
+            await _send(reader, writer, "CREATE_CONTAINER TAG-C1 D Truck 0 0")
+            writer.write(b"#7 LIST_CONTAINERS STREAM 1000\n#8 TOKEN\n")
+            await writer.drain()
+            chunk = (await reader.readline()).decode().strip()
+            done = (await reader.readline()).decode().strip()
+            token = (await reader.readline()).decode().strip()
+            assert chunk.startswith("#7 CONTAINERS [")
+            assert done.startswith("#7 OK ")
+            assert token.startswith("#8 OK ")
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_27(monkeypatch):  # Tests the receive buffer splits lines across reads and bounds their length
+    monkeypatch.setattr(server, "MAX_LINE", 16)
+    session = server.CommandSession()
+    word = "é".encode()
+    assert session._feed(b"STATUS A" + word[:1]) == []
+    assert session._feed(word[1:] + b"\r\n\n#2 TOKEN\nQU") == ["STATUS Aé", "#2 TOKEN"]
+    assert session._feed(b"IT\n") == ["QUIT"]
+    assert bytes(session._buffer) == b""
+    with pytest.raises(ValueError):
+        session._feed(b"x" * 17)
+    with pytest.raises(ValueError):
+        server.CommandSession()._feed(b"HELP\n" + b"y" * 17 + b"\nQUIT\n")
+
+
+def _read_frame(reader):
+    from wire import HEADER
+
+    (size,) = HEADER.unpack(reader.read(HEADER.size))
+    return json.loads(reader.read(size))
+
+
+def test_28():  # Tests PROTO BIN switches a connection to typed frames and back, mid-batch
+    import socket
+    from wire import encode_frames
+
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5.0)
+    session = server.Session(ours)
+    session.start()
+    try:
+        frames = encode_frames([
+            '[1, "CREATE_ITEM", "S", "R", "12 Main St", "O"]',
+            '[2, "BOGUS"]',
+            'not json',
+            '[3, "PROTO", "TEXT"]',
+        ])
+        theirs.sendall(b"#0 PROTO BIN\n" + frames + b"#4 USER back\n")
+        reader = theirs.makefile("rb")
+        assert reader.readline() == b"#0 OK BIN\n"
+        created = _read_frame(reader)
+        assert created[:2] == [1, "OK"]
+        assert _read_frame(reader) == [2, "ERR", "Unknown command"]
+        assert _read_frame(reader) == [None, "ERR", "Malformed frame"]
+        assert _read_frame(reader) == [3, "OK", "TEXT"]
+        assert reader.readline() == b"#4 OK hello back\n"
+        item = server._directory.get(created[2])
+        assert item.recipient_address == "12 Main St"
+    finally:
+        session._disconnect()
+        session.join(2.0)
+        theirs.close()
+
+
+def test_29():  # Tests asyncio sessions send events and long-poll answers as frames
+    from wire import HEADER, encode_frames
+
+    async def read_frame(reader):
+        (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+        return json.loads(await reader.readexactly(size))
+
+    async def scenario():
+        srv, reader, writer = await _open_client()
+        try:
+            item_id = (await _send(reader, writer, "CREATE_ITEM S R A O"))[3:]
+            assert await _send(reader, writer, "PROTO BIN") == "OK BIN"
+            writer.write(encode_frames([json.dumps([1, "WATCH", item_id]), json.dumps(["c", "COMPLETE", item_id])]))
+            await writer.drain()
+            frames = [await read_frame(reader) for _ in range(3)]
+            assert frames[0] == [1, "OK", f"watching {item_id}"]
+            assert frames[1] == ["c", "OK", f"completed {item_id}"]
+            assert frames[2][:2] == [None, "EVENT"] and frames[2][2]["obj"][1] == item_id
+
+            writer.write(encode_frames([json.dumps([2, "WAIT_EVENTS", 0, 10])]))
+            await writer.drain()
+            assert (await read_frame(reader))[:2] == [2, "OK"]
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_30(monkeypatch):  # Tests HANDOFF_OUT takes an item out with its record and HANDOFF_IN restores it
+    session = server.CommandSession()
+    watcher = server.CommandSession()
+    session.handle("CREATE_CONTAINER HANDOFF-C1 D Truck 0 0")
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    session.handle(f"LOAD {item_id} HANDOFF-C1")
+    watcher.handle(f"WATCH {item_id}")
+
+    record = session.handle(f"HANDOFF_OUT {item_id}")[0][3:]
+    assert item_id not in server._directory._items
+    assert item_id not in json.loads(server._containers["HANDOFF-C1"].get())["items"]
+    assert not watcher.tracker._items
+    assert server.decode_record(record)["cid"] == "HANDOFF-C1"
+
+    with pytest.raises(KeyError):
+        session.handle(f"HANDOFF_IN {record} NO-SUCH-C")
+    assert session.handle(f"HANDOFF_IN {record} HANDOFF-C1") == (f"OK {item_id}", True)
+    assert json.loads(session.handle(f"STATUS {item_id}")[0][3:])["state"] == "in transit"
+    with pytest.raises(RuntimeError):
+        session.handle(f"HANDOFF_IN {record}")
+
+    monkeypatch.setattr(server, "_shard", (2, 4))
+    assert next(server._id_sequence_after(0)) == 3
+    assert next(server._id_sequence_after(3)) == 7
+
+
+def test_31(monkeypatch):  # Tests a replica installs the primary's snapshot and applies its later records
+    monkeypatch.setattr(server, "_replication", server.ReplicationHub())
+    session = server.CommandSession()
+    session.handle("CREATE_CONTAINER REPL-C1 D Truck 0 0")
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    feed, records = server._replication_snapshot()
+    session.handle("CREATE_CONTAINER REPL-C2 D Ship 3 3")
+    session.handle(f"LOAD {item_id} REPL-C2")
+    later = feed.take()
+    assert [record["op"] for record in later] == ["container", "load"]
+
+    for name in ("_directory", "_containers", "_locations", "_read_only"):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    monkeypatch.setattr(CargoItem, "_id_sequence", CargoItem._id_sequence)
+    server._install_replica(json.loads(json.dumps(records)))
+    assert "REPL-C2" not in server._containers
+    server._apply_replicated(later)
+    assert json.loads(session.handle(f"STATUS {item_id}")[0][3:])["container"] == "REPL-C2"
+    assert "REPL-C2" in server._locations.search(server.view_box((4, 2, 2, 4)))
+
+    server._read_only = True
+    with pytest.raises(RuntimeError):
+        session.handle("SETLOC REPL-C2 1 1")
+
+
+def test_32():  # Tests a streamed listing shows the items as they were when the stream started
+    session = server.CommandSession()
+    writer = server.CommandSession()
+    writer.handle("CREATE_CONTAINER MVCC-C1 D Truck 0 0")
+    last_id = writer.handle("CREATE_ITEM S R A O")[0][3:]
+    stream, _ = session.handle("LIST_ITEMS STREAM 1")
+    first = next(stream)
+    total = len(server._directory._items)
+    writer.handle("CREATE_ITEM S R A O")
+    writer.handle(f"LOAD {last_id} MVCC-C1")
+    lines = list(stream)
+    assert lines[-1] == f"OK {total}"
+    listed = [entry for line in [first] + lines[:-1] for entry in json.loads(line[6:])]
+    assert [entry["id"] for entry in listed] == sorted(entry["id"] for entry in listed)
+    assert next(entry for entry in listed if entry["id"] == last_id)["container"] != "MVCC-C1"
+    assert json.loads(writer.handle(f"STATUS {last_id}")[0][3:])["container"] == "MVCC-C1"
+
+
+def test_33(tmp_path, monkeypatch):  # Tests saves never overlap and SAVE_STATS reports the last one
+    writing = []
+    overlaps = []
+    write_state = server._write_state
+
+    def tracked(path):
+        if writing:
+            overlaps.append(path)
+        writing.append(path)
+        try:
+            time.sleep(0.05)
+            return write_state(path)
+        finally:
+            writing.pop()
+
+    monkeypatch.setattr(server, "_write_state", tracked)
+    paths = [str(tmp_path / f"state{n}.json") for n in range(3)]
+    threads = [threading.Thread(target=server.save_state, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps
+    assert not any(path.name.endswith(".tmp") for path in tmp_path.iterdir())
+
+    stats = json.loads(server.CommandSession().handle("SAVE_STATS")[0][3:])
+    assert stats["last_bytes"] in {os.path.getsize(path) for path in paths}
+    assert stats["last_seconds"] >= 0.05 and stats["autosave"] is None
+
+
+def test_34(tmp_path, monkeypatch):  # Tests --lazy-load maps the snapshot, replays the journal and saves in full
+    for name in ("_directory", "_containers", "_locations"):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    state = str(tmp_path / "state.bin")
+    monkeypatch.setattr(server, "_state_path", state)
+    session = server.CommandSession()
+    loaded = session.handle("CREATE_ITEM S R A O")[0][3:]
+    alone = session.handle("CREATE_ITEM S R A O")[0][3:]
+    if "LAZY-T1" not in server._containers:
+        session.handle("CREATE_CONTAINER LAZY-T1 Truck Truck 1 2")
+    session.handle(f"LOAD {loaded} LAZY-T1")
+    server.save_state(state)
+    server.enable_journal(state, compact_interval=3600)
+    try:
+        session.handle(f"COMPLETE {alone}")
+    finally:
+        server.close_journal()
+    monkeypatch.setattr(server, "_lazy_load", True)
+
+    server.load_state(state)
+
+    assert isinstance(server._directory, server.LazyDirectory)
+    assert server._directory._items._live.keys() == {alone}
+    assert json.loads(session.handle(f"STATUS {loaded}")[0][3:])["container"] == "LAZY-T1"
+    assert server._directory.get(alone).state == "complete"
+    in_view = json.loads(session.handle("CONTAINERS_IN_VIEW 3 0 0 3")[0][3:])
+    assert "LAZY-T1" in [cont["cid"] for cont in in_view]
+    new_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    assert new_id > alone and new_id in session.handle("LIST_ITEMS")[0]
+
+    assert session.handle("SAVE")[0].startswith("OK")
+    monkeypatch.setattr(server, "_lazy_load", False)
+    server.load_state(state)
+    assert server._directory.get(new_id).state == "accepted"
+    assert server._directory.get(loaded).getContainer() == "LAZY-T1"
+
+
+def test_35():  # Tests non-finite coordinates are refused without changing the model
+    session = server.CommandSession()
+    if "NF-T1" not in server._containers:
+        session.handle("CREATE_CONTAINER NF-T1 Truck Truck 1 2")
+    loc = server._containers["NF-T1"].loc
+
+    for line in ("CREATE_CONTAINER NF-T2 d Truck nan 0", "SETLOC NF-T1 inf 0",
+                 "SETVIEW inf 0 0 1", "CONTAINERS_IN_VIEW 1 0 -inf 1"):
+        with pytest.raises(ValueError):
+            session.handle(line)
+    assert "NF-T2" not in server._containers and "NF-T2" not in server._locations
+    assert server._containers["NF-T1"].loc == loc
+    assert session.tracker._view_rect is None
+    in_view = json.loads(session.handle(f"CONTAINERS_IN_VIEW {loc[1] + 1} {loc[0] - 1} {loc[1] - 1} {loc[0] + 1}")[0][3:])
+    assert "NF-T1" in [cont["cid"] for cont in in_view]
+
+
+def test_36():  # Tests only JSON answers are framed as JSON, whatever the text of the others
+    session = server.CommandSession()
+    session.binary = True
+    assert json.loads(session.execute((1, "CREATE_CONTAINER", ["[WIRE-C1", "D", "Truck", "0", "0"]))[0]) == [
+        1, "OK", "[WIRE-C1"]
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    status = json.loads(session.execute((2, "STATUS", [item_id]))[0])
+    assert status[:2] == [2, "OK"] and status[2]["id"] == item_id
+    chunks = [json.loads(payload) for payload in session.execute((3, "LIST_CONTAINERS", ["STREAM", "10"]))[0]]
+    assert chunks[0][1] == "CONTAINERS" and isinstance(chunks[0][2], list)
+    assert chunks[-1][1] == "OK" and chunks[-1][2] == str(sum(len(chunk[2]) for chunk in chunks[:-1]))
+
+
+def test_37():  # Tests watches keep firing after a replica resync swaps in a new model
+    from snapshot import container_record, item_record
+
+    session = server.CommandSession()
+    session.handle("CREATE_CONTAINER RESYNC-C1 D Truck 0 0")
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    session.handle(f"WATCH {item_id}")
+    session.handle("WATCH_CONTAINER RESYNC-C1")
+    old_item = server._directory.get(item_id)
+
+    records = [("container", container_record(cont)) for cont in server._containers.values()]
+    records.extend(("item", item_record(item)) for item in list(server._directory._items.values()))
+    server._install_replica(records)
+
+    item = server._directory.get(item_id)
+    assert item is not old_item and session.tracker._items == {item}
+    assert session.tracker._containers == {server._containers["RESYNC-C1"]}
+    before = session.pending_events
+    session.handle(f"LOAD {item_id} RESYNC-C1")
+    session.handle("SETLOC RESYNC-C1 1 1")
+    assert session.pending_events >= before + 2
+
+
+def test_38(tmp_path, monkeypatch):  # Tests a failed save is reported to the caller and to SAVE
+    missing = str(tmp_path / "no-such-dir" / "state.json")
+    monkeypatch.setattr(server, "_state_path", missing)
+    monkeypatch.setattr(server, "_save_stats", dict(server._save_stats))
+
+    assert server.save_state(missing) is False
+    with pytest.raises(RuntimeError, match="save failed"):
+        server.CommandSession().handle("SAVE")
+    assert server._save_stats["last_error"]
+    assert server.save_state(str(tmp_path / "state.json")) is True
+
+
+def test_39(tmp_path, monkeypatch):  # Tests a corrupt binary snapshot is reported instead of killing the load
+    for name in ("_directory", "_containers", "_locations"):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    state = tmp_path / "state.bin"
+    with open(state, "wb") as handle:
+        server.write_binary_snapshot(handle, [("BAD-T1", "D", "Truck", (0.0, 0.0))], [])
+    data = bytearray(state.read_bytes())
+    data[28 + 4] = 3  # the string "BAD-T1" now claims to be an item record
+    state.write_bytes(bytes(data))
+    directory = server._directory
+
+    server.load_state(str(state))
+    assert server._directory is directory
+
+
+def test_40(monkeypatch):  # Tests a parked tracker is released when its grace period ends, with no further close or RESUME
+    import socket
+
+    monkeypatch.setattr(server, "RESUME_GRACE", 0.1)
+    ours, theirs = socket.socketpair()
+    old = server.Session(ours)
+    item_id = old.handle("CREATE_ITEM S R A O")[0][3:]
+    old.handle(f"WATCH {item_id}")
+    token = old.handle("TOKEN")[0][3:]
+    old.close()
+    theirs.close()
+    assert token in server._parked
+
+    deadline = time.monotonic() + 5
+    while not old.tracker._deleted and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert old.tracker._deleted and token not in server._parked
+    assert not server._directory.get(item_id)._trackers
+
+
+def test_41():  # Tests a session without a transport can be closed
+    session = server.CommandSession()
+    item_id = session.handle("CREATE_ITEM S R A O")[0][3:]
+    session.handle(f"WATCH {item_id}")
+
+    session.close()
+
+    assert not session._running
+
+
+def test_42(monkeypatch):  # Tests a replica snapshot is read after the stripes are released, as of its opening
+    monkeypatch.setattr(server, "_replication", server.ReplicationHub())
+    session = server.CommandSession()
+    if "REPL-COW" not in server._containers:
+        session.handle("CREATE_CONTAINER REPL-COW D Truck 0 0")
+    session.handle("SETLOC REPL-COW 0 0")
+    read_containers = server._read_containers
+
+    def write_then_read(*args, **kwargs):
+        # a writer on another thread would block here if the stripes were held
+        writer = threading.Thread(target=session.handle, args=("SETLOC REPL-COW 7 7",))
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        return read_containers(*args, **kwargs)
+
+    monkeypatch.setattr(server, "_read_containers", write_then_read)
+    feed, records = server._replication_snapshot()
+
+    record = next(fields for kind, fields in records if kind == "container" and fields[0] == "REPL-COW")
+    assert record[3] == (0.0, 0.0)
+    assert [(r["op"], r["loc"]) for r in feed.take()] == [("setloc", [7.0, 7.0])]
+
+
+@pytest.mark.parametrize(
+    "argv, interval, every",
+    [
+        ([], 0.0, 0),
+        (["--no-journal"], 30.0, 10000),
+        (["--autosave-interval", "5"], 5.0, 0),
+        (["--no-journal", "--autosave-every", "0"], 30.0, 0),
+    ],
+)
+def test_43(argv, interval, every):  # Tests autosave is off by default while the journal compacts
+    args = server.parse_args(argv)
+
+    assert args.autosave_interval == interval
+    assert args.autosave_every == every
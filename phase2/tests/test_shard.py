@@ -0,0 +1,222 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import shard
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def shards(tmp_path):
+    ports = [_free_port() for _ in range(2)]
+    procs = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "server.py"), str(port), "--shard", f"{index}/2",
+             "--no-journal", "--state-file", str(tmp_path / f"shard{index}.json")],
+            stdout=subprocess.DEVNULL,
+        )
+        for index, port in enumerate(ports)
+    ]
+    try:
+        for port in ports:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.05)
+        yield [("127.0.0.1", port) for port in ports]
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+def _cid_on(index, prefix):
+    return next(f"{prefix}{n}" for n in range(100) if shard.container_shard(f"{prefix}{n}", 2) == index)
+
+
+def test_1():  # Tests item ids name their home shard and containers hash to a fixed shard
+    assert [shard.home_shard(f"CI{n:08d}", 3) for n in (1, 2, 3, 4)] == [0, 1, 2, 0]
+    assert shard.home_shard("bogus", 3) == 0
+    assert shard.container_shard("T1", 4) == shard.container_shard("T1", 4) < 4
+
+
+def test_2(shards):  # Tests the router hands an item off to another shard and keeps it watched
+    async def scenario():
+        router = shard.Router(shards)
+        srv = await asyncio.start_server(router.serve, "127.0.0.1", 0)
+        port = srv.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        w_reader, w_writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def send(line, r=reader, w=writer):
+            w.write((line + "\n").encode())
+            await w.drain()
+            return (await r.readline()).decode().strip()
+
+        try:
+            c0, c1 = _cid_on(0, "SH-A"), _cid_on(1, "SH-B")
+            assert await send(f"CREATE_CONTAINER {c0} D Truck 0 0") == f"OK {c0}"
+            assert await send(f"CREATE_CONTAINER {c1} D Truck 5 5") == f"OK {c1}"
+            first = (await send("CREATE_ITEM S R A O"))[3:]
+            second = (await send("CREATE_ITEM S R A O"))[3:]
+            assert {shard.home_shard(first, 2), shard.home_shard(second, 2)} == {0, 1}
+            item = first if shard.home_shard(first, 2) == 0 else second
+
+            assert (await send(f"WATCH {item}", w_reader, w_writer)).startswith("OK watching")
+            assert await send(f"#5 LOAD {item} {c0}") == f"#5 OK loaded {item} into {c0}"
+            assert (await w_reader.readline()).startswith(b"EVENT ")
+            # container of shard 1: the item moves there
+            assert (await send(f"MOVE {c0} {c1} {item}")) == f"OK moved 1 from {c0} to {c1}"
+            assert json.loads((await send(f"STATUS {item}"))[3:])["container"] == c1
+            assert router.item_shard(item) == 1
+            assert (await send(f"LOAD {item} NO-SUCH")).startswith("ERR")
+            assert json.loads((await send(f"STATUS {item}"))[3:])["container"] == c1
+            # the watch followed the item to shard 1
+            while True:
+                event = json.loads((await asyncio.wait_for(w_reader.readline(), 5))[6:])
+                if event["obj"][:2] == ["container", c1]:
+                    assert event["items"] == [item]
+                    break
+            assert await send(f"UNLOAD {item}") == f"OK unloaded {item}"
+            # pipelined requests to both shards, then a merged one, answered in order
+            writer.write(f"#1 STATUS {first}\n#2 STATUS {second}\n#3 STATUS {first}\n#4 LIST_ITEMS - 1\n".encode())
+            tags = [(await reader.readline()).split()[0] for _ in range(4)]
+            assert tags == [b"#1", b"#2", b"#3", b"#4"]
+
+            page = json.loads((await send("LIST_ITEMS - 1"))[3:])
+            assert [entry["id"] for entry in page["items"]] == [min(first, second)]
+            rest = json.loads((await send(f"LIST_ITEMS {page['next']} 5"))[3:])
+            assert [entry["id"] for entry in rest["items"]] == [max(first, second)]
+            assert rest["next"] is None
+            assert (await send("LIST_CONTAINERS STREAM 10")).startswith("CONTAINERS [")
+            assert (await reader.readline()).startswith(b"CONTAINERS [")
+            assert await reader.readline() == b"OK 2\n"
+            assert (await send("WAIT_EVENTS 1 1")).startswith("ERR")
+            assert await send("QUIT") == "OK bye"
+        finally:
+            writer.close()
+            w_writer.close()
+            srv.close()
+            await srv.wait_closed()
+            # let the router sessions see the end of input and close
+            await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+
+
+def test_3(shards):  # Tests cross-shard LOAD and MOVE check the item's container, and UNLOAD_MANY finds moved items
+    async def scenario():
+        router = shard.Router(shards)
+        srv = await asyncio.start_server(router.serve, "127.0.0.1", 0)
+        port = srv.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def send(line):
+            writer.write((line + "\n").encode())
+            await writer.drain()
+            return (await reader.readline()).decode().strip()
+
+        try:
+            c0, other, c1 = _cid_on(0, "SH-A"), _cid_on(0, "SH-C"), _cid_on(1, "SH-B")
+            for cid in (c0, other, c1):
+                assert await send(f"CREATE_CONTAINER {cid} D Truck 0 0") == f"OK {cid}"
+            items = [(await send("CREATE_ITEM S R A O"))[3:] for _ in range(2)]
+            item = next(item_id for item_id in items if shard.home_shard(item_id, 2) == 0)
+            assert await send(f"LOAD {item} {other}") == f"OK loaded {item} into {other}"
+
+            assert await send(f"LOAD {item} {c1}") == f"ERR Item {item} already in container {other}"
+            assert await send(f"MOVE {c0} {c1} {item}") == f"ERR Item {item} not in container {c0}"
+            assert json.loads((await send(f"STATUS {item}"))[3:])["container"] == other
+            assert router.item_shard(item) == 0
+            assert await send(f"MOVE {other} {c1} {item}") == f"OK moved 1 from {other} to {c1}"
+            # now on shard 1, where no container of shard 0 can hold it
+            assert await send(f"MOVE {c0} {c1} {item}") == f"ERR Item {item} not in container {c0}"
+            assert json.loads((await send(f"STATUS {item}"))[3:])["container"] == c1
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+            await asyncio.sleep(0.2)
+
+        # a new router does not know the item left its home shard
+        router = shard.Router(shards)
+        srv = await asyncio.start_server(router.serve, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", srv.sockets[0].getsockname()[1])
+        try:
+            assert router.item_shard(item) == 0
+            assert await send(f"UNLOAD_MANY {item}") == "OK unloaded 1"
+            assert router.item_shard(item) == 1
+        finally:
+            writer.close()
+            srv.close()
+            await srv.wait_closed()
+            await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+
+
+def test_4(monkeypatch):  # Tests each shard gets its own snapshot named after --state-file
+    started = {}
+
+    def fake_start(shards, base_port, server_args, state_file):
+        started.update(shards=shards, server_args=server_args, state_file=state_file)
+        return []
+
+    async def fake_serve(port, addresses):
+        started["addresses"] = addresses
+
+    monkeypatch.setattr(shard, "start_shards", fake_start)
+    monkeypatch.setattr(shard, "wait_for_shards", lambda addresses, procs: None)
+    monkeypatch.setattr(shard, "serve_router", fake_serve)
+    shard.main(["5000", "--shards", "2", "--state-file", "/data/cargo.bin", "--no-journal"])
+
+    assert started["state_file"] == "/data/cargo.bin" and started["server_args"] == ["--no-journal"]
+    assert [shard.shard_state_file("/data/cargo.bin", k) for k in (0, 1)] == [
+        "/data/cargo.shard0.bin", "/data/cargo.shard1.bin"]
+    assert shard.shard_state_file("server_state.json", 3) == "server_state.shard3.json"
+
+
+def test_5():  # Tests the router waits for its shards to listen and gives up on a dead one
+    port = _free_port()
+    listener = socket.socket()
+
+    def listen_later():
+        time.sleep(0.2)
+        listener.bind(("127.0.0.1", port))
+        listener.listen(1)
+
+    threading.Thread(target=listen_later).start()
+    start = time.monotonic()
+    shard.wait_for_shards([("127.0.0.1", port)], timeout=5)
+    assert time.monotonic() - start >= 0.2
+    listener.close()
+
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with pytest.raises(RuntimeError, match="exited"):
+        shard.wait_for_shards([("127.0.0.1", _free_port())], [dead], timeout=5)
+    with pytest.raises(RuntimeError, match="did not start"):
+        shard.wait_for_shards([("127.0.0.1", _free_port())], timeout=0.2)
+
+
+def test_6():  # Tests the router does not load the server module and its model
+    code = "import sys, shard; assert 'server' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], cwd=HERE, check=True)
@@ -0,0 +1,174 @@
+import io
+import json
+import struct
+
+import pytest
+
+from snapshot import (
+    MappedSnapshot,
+    is_binary_snapshot,
+    iter_binary_records,
+    iter_json_records,
+    iter_json_snapshot,
+    write_binary_snapshot,
+    write_json_snapshot,
+)
+
+
+LEGACY = """{
+  "items": [
+    {"id": "CI00000001", "owner": "O", "container": "T1", "loc": [1.5, -20]},
+    {"id": "CI00000002", "owner": "O", "container": null}
+  ],
+  "version": 12345,
+  "containers": [
+    {"cid": "T1", "items": ["CI00000001"]}
+  ]
+}"""
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+def test_1(chunk_size):  # Tests records stream out in file order at any chunk size
+    records = list(iter_json_snapshot(io.StringIO(LEGACY), chunk_size=chunk_size))
+
+    assert records == [
+        ("items", {"id": "CI00000001", "owner": "O", "container": "T1", "loc": [1.5, -20]}),
+        ("items", {"id": "CI00000002", "owner": "O", "container": None}),
+        ("containers", {"cid": "T1", "items": ["CI00000001"]}),
+    ]
+
+
+def test_2():  # Tests the writer emits containers first and valid JSON
+    handle = io.StringIO()
+    write_json_snapshot(handle, ['{"cid": "T1"}'], ['{"id": "CI1"}', '{"id": "CI2"}'])
+
+    assert json.loads(handle.getvalue()) == {
+        "containers": [{"cid": "T1"}],
+        "items": [{"id": "CI1"}, {"id": "CI2"}],
+    }
+    assert [section for section, _ in iter_json_snapshot(io.StringIO(handle.getvalue()))] == [
+        "containers",
+        "items",
+        "items",
+    ]
+
+
+def test_3():  # Tests empty sections and an empty snapshot
+    handle = io.StringIO()
+    write_json_snapshot(handle, [], [])
+
+    assert list(iter_json_snapshot(io.StringIO(handle.getvalue()))) == []
+    assert list(iter_json_snapshot(io.StringIO("{}"))) == []
+
+
+@pytest.mark.parametrize("broken", ['{"items": [{"id": 1}, {"id"', '{"items": [1 2]}', "[]"])
+def test_4(broken):  # Tests truncated or malformed snapshots raise ValueError
+    with pytest.raises(ValueError):
+        list(iter_json_snapshot(io.StringIO(broken), chunk_size=4))
+
+
+CONTAINERS = [("T1", "Truck", "Truck", (1.25, -3.5)), ("H1", "Hub", "Hub", (0.0, 0.0))]
+ITEMS = [
+    ("CI00000001", "Nehir", "Aybeniz", "Ankara", "Carrier", "in transit", "T1", False),
+    ("CI00000002", "Nehir", "Aybeniz", "Ankara", "Carrier", "accepted", None, False),
+    ("CI00000003", "Nehir", "Ömer", "İzmir", "Carrier", "deleted", None, True),
+]
+
+
+def _binary(containers=CONTAINERS, items=ITEMS):
+    handle = io.BytesIO()
+    write_binary_snapshot(handle, containers, items)
+    return handle.getvalue()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 64, 1 << 20])
+def test_5(chunk_size):  # Tests binary records round-trip at any chunk size
+    records = list(iter_binary_records(io.BytesIO(_binary()), chunk_size=chunk_size))
+
+    assert records == [("container", c) for c in CONTAINERS] + [("item", i) for i in ITEMS]
+
+
+def test_6():  # Tests repeated strings are stored once
+    twin = ("CI00000009",) + ITEMS[0][1:]
+    one = len(_binary(items=ITEMS[:1]))
+    two = len(_binary(items=[ITEMS[0], twin]))
+
+    # the twin only adds its own fixed-size record plus its id, and its
+    # index entries: an offset and a place in its container's member list
+    assert two - one == 4 + 26 + len("CI00000009") + 8 + 4
+
+
+def test_7():  # Tests header validation and truncation detection
+    data = _binary()
+
+    with pytest.raises(ValueError):
+        list(iter_binary_records(io.BytesIO(b"NOTASNAP" + data[8:])))
+    index = struct.unpack_from("<Q", data, len(data) - 20)[0]
+    with pytest.raises(ValueError):
+        list(iter_binary_records(io.BytesIO(data[:index - 3])))
+    with pytest.raises(ValueError):
+        list(iter_binary_records(io.BytesIO(data[:10])))
+
+
+def test_8():  # Tests JSON snapshots normalize to the same records
+    handle = io.StringIO()
+    write_json_snapshot(
+        handle,
+        ['{"cid": "T1", "description": "Truck", "type": "Truck", "loc": [1.25, -3.5], "items": []}'],
+        ['{"id": "CI00000001", "sendernam": "Nehir", "recipnam": "Aybeniz", "recipaddr": "Ankara", '
+         '"owner": "Carrier", "state": "in transit", "container": "T1", "deleted": false}',
+         '{"id": "CI00000002"}'],
+    )
+
+    records = list(iter_json_records(io.StringIO(handle.getvalue())))
+
+    assert records == [("container", CONTAINERS[0]), ("item", ITEMS[0])]
+    assert is_binary_snapshot("state.BIN") and not is_binary_snapshot("state.json")
+
+
+def test_9(tmp_path):  # Tests a mapped snapshot finds items by id and lists container members
+    items = [ITEMS[2], ITEMS[0], ("CI00000010",) + ITEMS[0][1:], ITEMS[1]]
+    path = tmp_path / "state.bin"
+    path.write_bytes(_binary(items=items))
+
+    snapshot = MappedSnapshot(str(path))
+    try:
+        assert [snapshot.item_id(n) for n in range(4)] == ["CI00000001", "CI00000002", "CI00000003", "CI00000010"]
+        assert snapshot.item(snapshot.find("CI00000003")) == ITEMS[2]
+        assert snapshot.find("CI00000004") is None and snapshot.find("CI0") is None
+        assert [snapshot.container(n) for n in range(2)] == CONTAINERS
+        assert snapshot.members(0) == (0, 3) and snapshot.members(1) == ()
+        assert snapshot.top_id() == "CI00000010"
+    finally:
+        snapshot.close()
+
+
+def test_10(tmp_path):  # Tests version 1 snapshots still stream but cannot be mapped
+    data = _binary()
+    index = struct.unpack_from("<Q", data, len(data) - 20)[0]
+    old = data[:8] + struct.pack("<H", 1) + data[10:index]
+    path = tmp_path / "old.bin"
+    path.write_bytes(old)
+
+    assert list(iter_binary_records(io.BytesIO(old))) == list(iter_binary_records(io.BytesIO(data)))
+    with pytest.raises(ValueError):
+        MappedSnapshot(str(path))
+
+
+def test_11():  # Tests a corrupt binary snapshot raises ValueError, not an IndexError or struct.error
+    data = _binary()
+    first = 28  # after the header, the string "T1"
+    container = first + (4 + 1 + 2) + (4 + 1 + 5)  # after "T1" and "Truck"
+    assert data[container + 4] == 2
+
+    bad_ref = bytearray(data)
+    struct.pack_into("<I", bad_ref, container + 5, 999)
+    empty = bytearray(data)
+    struct.pack_into("<I", empty, first, 0)
+    bad_text = bytearray(data)
+    bad_text[first + 5] = 0xFF
+    short = bytearray(data)
+    struct.pack_into("<I", short, container, 5)
+    for broken in (bad_ref, empty, bad_text, short):
+        with pytest.raises(ValueError, match="corrupt binary snapshot"):
+            list(iter_binary_records(io.BytesIO(bytes(broken))))
@@ -0,0 +1,88 @@
+import pytest
+
+from container import Container
+from spatial import GridIndex, LocationIndex, point_box, view_box
+from tracker import Tracker
+
+
+class RecordingTracker:
+    def __init__(self):
+        self.calls = []
+
+    def updated(self, obj=None):
+        self.calls.append(obj)
+
+
+def test_1():  # Tests rectangle search returns only overlapping keys
+    grid = GridIndex(cell_size=10.0)
+    grid.insert("A", point_box((5.0, 5.0)))
+    grid.insert("B", point_box((25.0, -5.0)))
+    grid.insert("C", (-50.0, -50.0, 50.0, 50.0))
+
+    assert sorted(grid.search((0.0, 0.0, 10.0, 10.0))) == ["A", "C"]
+    assert sorted(grid.search((20.0, -10.0, 30.0, 0.0))) == ["B", "C"]
+    assert grid.search((100.0, 100.0, 110.0, 110.0)) == []
+
+
+def test_2():  # Tests moving and removing keys updates the cells
+    grid = GridIndex(cell_size=1.0)
+    grid.insert("A", point_box((0.5, 0.5)))
+    grid.insert("A", point_box((7.5, 7.5)))
+
+    assert grid.containing((0.5, 0.5)) == []
+    assert grid.containing((7.5, 7.5)) == ["A"]
+    grid.remove("A")
+    assert len(grid) == 0
+    assert grid._cells == {}
+
+
+def test_3():  # Tests boxes spanning many cells and whole-map queries
+    grid = GridIndex(cell_size=1.0, max_cells=16)
+    grid.insert("world", (-180.0, -90.0, 180.0, 90.0))
+    grid.insert("inverted", view_box((0.0, 10.0, 5.0, -10.0)))
+    grid.insert("P", point_box((3.0, 4.0)))
+
+    assert "world" in grid._large
+    assert sorted(grid.containing((3.0, 4.0))) == ["P", "world"]
+    assert sorted(grid.search((-180.0, -90.0, 180.0, 90.0))) == ["P", "world"]
+    with pytest.raises(ValueError):
+        GridIndex(cell_size=0)
+
+
+def test_4():  # Tests setlocation re-files the container and skips out-of-view trackers
+    space = LocationIndex(cell_size=1.0)
+    cont = Container(cid="T1", description="Truck", type="Truck", loc=(0.5, 0.5))
+    space.add(cont)
+    near = Tracker(tid="N", description="near", owner="o", views=space.views)
+    far = Tracker(tid="F", description="far", owner="o", views=space.views)
+    blind = RecordingTracker()
+    near.setView(10.0, 0.0, 0.0, 10.0)
+    far.setView(60.0, 50.0, 50.0, 60.0)
+    events = []
+    for tracker in (near, far):
+        tracker._on_update = lambda t, obj, obj_id: events.append(t.tid)
+        tracker.addContainer([cont])
+    cont.track(blind)
+
+    cont.setlocation(2.5, 3.5)
+
+    assert space.containing((2.5, 3.5)) == ["T1"]
+    assert space.containing((0.5, 0.5)) == []
+    assert events == ["N"]
+    assert blind.calls == [cont]
+    far.delete()
+    assert far not in space.views
+
+
+def test_5():  # Tests non-finite boxes are refused before the index changes
+    grid = GridIndex()
+    grid.insert("A", point_box((1.0, 1.0)))
+
+    for bad in ((float("inf"), 0.0), (float("nan"), 0.0)):
+        with pytest.raises(ValueError):
+            grid.insert("A", point_box(bad))
+        with pytest.raises(ValueError):
+            grid.search(point_box(bad))
+    assert grid.search(point_box((1.0, 1.0))) == ["A"]
+    grid.remove("A")
+    assert len(grid) == 0
@@ -4,6 +4,7 @@ import pytest
 from tracker import Tracker
 from container import Container
 from cargo_item import CargoItem
+from notify import UpdateBatch
 
 class MockCargoItem:
    
@@ -193,3 +194,43 @@ class TestTracker:
         captured = capsys.readouterr()
         assert f"Received update from {item.trackingId()}" in captured.out
 
+
+    def test_9(self, sample_tracker, sample_item, sample_container):
+        # Test a batched container update reaches the tracker once with its items
+        trk = sample_tracker
+        item = sample_item
+        cont = sample_container
+        other = CargoItem(sendernam="S", recipnam="R", recipaddr="A", owner="O")
+        cont.load([item, other])
+        trk.addItem([item])
+        trk.addContainer([cont])
+        calls = []
+        trk._on_update = lambda *args: calls.append(args)
+        batch = UpdateBatch()
+
+        cont.setlocation(21.0, 11.0, batch=batch)
+        assert calls == []
+        batch.deliver()
+
+        assert calls == [(trk, cont, cont.cid, [item.trackingId()], (21.0, 11.0))]
+        trk.setView(top=5, left=0, bottom=0, right=5)
+        cont.setlocation(22.0, 12.0, batch=batch)
+        batch.deliver()
+        assert len(calls) == 1
+
+    def test_10(self, sample_tracker, sample_item, sample_container):
+        # Test a batched update uses the location recorded, not the current one
+        trk = sample_tracker
+        cont = sample_container
+        cont.load([sample_item])
+        trk.addContainer([cont])
+        trk.setView(top=5, left=0, bottom=0, right=5)
+        calls = []
+        trk._on_update = lambda *args: calls.append(args)
+        batch = UpdateBatch()
+
+        cont.setlocation(3.0, 3.0, batch=batch)
+        cont.setlocation(50.0, 50.0, batch=UpdateBatch())
+        batch.deliver()
+
+        assert calls == [(trk, cont, cont.cid, [], (3.0, 3.0))]
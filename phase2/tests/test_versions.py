@@ -0,0 +1,55 @@
+import json
+
+import versions
+from cargo_item import CargoDirectory, CargoItem
+from cargo_store import CargoStore
+from container import Container
+from tracker import Tracker
+
+
+def _model(directory):
+    containers = {cid: Container(cid, "D", "Truck", (0.0, 0.0)) for cid in ("V1", "V2")}
+    items = [directory.add(CargoItem.restore(f"CI{n:08d}", "S", "R", "A", "O")) for n in (1, 2, 3)]
+    containers["V1"].load([items[0]])
+    return containers, items
+
+
+def test_1():  # Tests a snapshot keeps the state of objects changed or removed after it was opened
+    directory = CargoDirectory()
+    containers, items = _model(directory)
+    snapshot = versions.open_snapshot(directory, containers)
+    before = {item_id: snapshot.item(item_id).get() for item_id in snapshot.item_ids}
+
+    containers["V1"].move([items[0]], containers["V2"])
+    containers["V2"].setlocation(5, 5)
+    items[1].complete()
+    directory.remove(items[2].trackingId())
+    directory.add(CargoItem.restore("CI00000009", "S", "R", "A", "O"))
+
+    assert snapshot.item_ids == ["CI00000001", "CI00000002", "CI00000003"]
+    assert {item_id: snapshot.item(item_id).get() for item_id in snapshot.item_ids} == before
+    assert json.loads(snapshot.container("V1").get())["items"] == ["CI00000001"]
+    assert snapshot.container("V2").loc == (0.0, 0.0)
+    assert json.loads(items[0].get())["container"] == "V2"
+    assert snapshot.page_items("CI00000001", 1) == (["CI00000002"], "CI00000002")
+
+    snapshot.close()
+    assert versions._open == ()
+    items[0].complete()
+    assert snapshot.item("CI00000001") is items[0]
+
+
+def test_2():  # Tests snapshots of the columnar store and tracker status lists read the old state
+    directory = CargoStore()
+    containers, items = _model(directory)
+    tracker = Tracker(tid="TRK-V", description="d", owner="o")
+    tracker.addItem(items[:1])
+    with versions.open_snapshot(directory, containers) as snapshot:
+        containers["V1"].setlocation(3, 4)
+        containers["V1"].unload([items[0]])
+        frozen = snapshot.item("CI00000001")
+        assert type(frozen) is CargoItem
+        assert frozen.getContainer() == "V1" and frozen.state == "in transit"
+        assert tracker.getStatlist(snapshot)[0]["location"] == (0.0, 0.0)
+        assert tracker.getStatlist()[0]["location"] is None
+    assert versions._open == ()
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import wire
+
+
+def _frame(*payload):
+    data = json.dumps(list(payload)).encode()
+    return wire.HEADER.pack(len(data)) + data
+
+
+def test_1():  # Tests frames split across reads decode to typed requests and stop after PROTO
+    buffer = bytearray()
+    data = _frame(1, "create_item", "S", "R", "12 Main St", "O") + _frame(2, 18, ["CI1", 3.5]) + b"{}"
+    buffer += data[:7]
+    assert wire.split_frames(buffer, 1024) == []
+    buffer += data[7:]
+    assert wire.split_frames(buffer, 1024) == [
+        (1, "CREATE_ITEM", ["S", "R", "12 Main St", "O"]),
+        (2, "STATUS", ["CI1", "3.5"]),
+    ]
+    assert bytes(buffer) == b"{}"
+
+    buffer = bytearray(_frame(None, "PROTO", "TEXT") + b"QUIT\n")
+    assert wire.split_frames(buffer, 1024) == [(None, "PROTO", ["TEXT"])]
+    assert bytes(buffer) == b"QUIT\n"
+    assert wire.decode_request(b"[1]") == (None, None, [])
+    with pytest.raises(ValueError):
+        wire.split_frames(bytearray(_frame(0, "HELP", "x" * 50)), 16)
+
+
+def test_2():  # Tests answer lines become [id, status, body] frames with JSON bodies left as is
+    assert json.loads(wire.response_payload(7, wire.JsonLine('OK {"id": "CI1"}'))) == [7, "OK", {"id": "CI1"}]
+    # a text answer is a string however it starts
+    assert json.loads(wire.response_payload(7, "OK [C1")) == [7, "OK", "[C1"]
+    assert json.loads(wire.response_payload("a", "OK watching CI1")) == ["a", "OK", "watching CI1"]
+    assert json.loads(wire.response_payload(None, "ERR [bad")) == [None, "ERR", "[bad"]
+    assert json.loads(wire.response_payload(1, "Commands: HELP")) == [1, "OK", "Commands: HELP"]
+    assert json.loads(wire.response_payload(1, wire.JsonLine("ITEMS [1, 2]"))) == [1, "ITEMS", [1, 2]]
+    assert json.loads(wire.event_payload({"seq": 3})) == [None, "EVENT", {"seq": 3}]
+    data = wire.encode_frames(["[1]", "[2]"])
+    assert data == b"\x00\x00\x00\x03[1]\x00\x00\x00\x03[2]"
@@ -3,10 +3,12 @@
 from __future__ import annotations
 
 import json
+import math
 from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 from cargo_item import CargoItem
 from container import Container
+from spatial import GridIndex, view_box
 
 
 class Tracker:
@@ -14,6 +16,19 @@ class Tracker:
     Tracks a set of CargoItems and Containers, notifying of state changes.
     """
 
+    __slots__ = (
+        "tid",
+        "description",
+        "owner",
+        "_items",
+        "_containers",
+        "_view_rect",
+        "_deleted",
+        "_on_update",
+        "_views",
+        "__weakref__",
+    )
+
     _allowed_update_fields = {
         "description": "description",
         "owner": "owner",
@@ -24,7 +39,8 @@ class Tracker:
         tid: str,
         description: str,
         owner: str,
-        on_update: Optional[Callable[["Tracker", Optional[Any], str], None]] = None,
+        on_update: Optional[Callable[..., None]] = None,
+        views: Optional[GridIndex] = None,
     ) -> None:
 
         if not tid:
@@ -43,6 +59,8 @@ class Tracker:
         self._view_rect: Optional[Tuple[float, float, float, float]] = None
         self._deleted = False
         self._on_update = on_update
+        # spatial index of tracker views; setView() files this tracker there
+        self._views = views
 
     def get(self) -> str:
         """Return a JSON representation of the tracker."""
@@ -78,6 +96,8 @@ class Tracker:
         if self._deleted:
             return
         self._deleted = True
+        if self._views is not None:
+            self._views.remove(self)
 
         # Untrack all items
         for item in list(self._items):
@@ -98,6 +118,13 @@ class Tracker:
                 self._items.add(item)
                 item.track(self)
 
+    def removeItem(self, itemlist: List[CargoItem]) -> None:
+        """Stops tracking a list of cargo items."""
+        for item in itemlist:
+            if item in self._items:
+                self._items.remove(item)
+                item.untrack(self)
+
     def addContainer(self, contlist: List[Container]) -> None:
         """Adds a list of containers to track."""
         if self._deleted:
@@ -108,6 +135,31 @@ class Tracker:
                 self._containers.add(cont)
                 cont.track(self)
 
+    def rebind(
+        self,
+        find_item: Callable[[str], Optional[CargoItem]],
+        find_container: Callable[[str], Optional[Container]],
+    ) -> None:
+        """
+        Track the objects of a reloaded model instead of the ones they
+        replace, looked up by id; objects the new model lacks are dropped.
+        """
+        if self._deleted:
+            return
+
+        items, self._items = self._items, set()
+        for old in items:
+            item = find_item(old.trackingId())
+            if item is not None and not item._deleted:
+                self._items.add(item)
+                item.track(self)
+        containers, self._containers = self._containers, set()
+        for old in containers:
+            cont = find_container(old.cid)
+            if cont is not None and not cont._deleted:
+                self._containers.add(cont)
+                cont.track(self)
+
     def updated(self, updated_object: Optional[Any] = None) -> None:
         """
         Callback method called by tracked objects to inform of changes.
@@ -139,9 +191,36 @@ class Tracker:
         print(f"Tracker {self.tid}: Received update from {obj_id}.")
         self._emit_update(updated_object, obj_id)
 
-    def getStatlist(self) -> List[Dict[str, Any]]:
+    def batch_updated(
+        self, container: Container, items: List[CargoItem], loc: Optional[Tuple[float, float]] = None
+    ) -> None:
+        """
+        Aggregated callback for a container update or a bulk load, unload
+        or move (see ``notify.py``): ``items`` are the tracked items
+        concerned, ``container`` the container acted on and ``loc`` its
+        location at the time (default: its location now).  Delivery
+        happens after the model locks are released, so a tracker deleted
+        meanwhile just ignores it.
+        """
+        if self._deleted:
+            return
+        if loc is None:
+            loc = container.loc
+
+        # the items are (or just were) in the container: one view check covers them
+        if self._view_rect and not self._loc_in_view(loc):
+            print(f"Tracker {self.tid}: Ignoring update from {container.cid} (outside view).")
+            return
+
+        print(f"Tracker {self.tid}: Received update from {container.cid} ({len(items)} items).")
+        self._emit_update(container, container.cid, [item.trackingId() for item in items], loc)
+
+    def getStatlist(self, snapshot: Any = None) -> List[Dict[str, Any]]:
         """
         Returns a list of states for the tracked items, including locations.
+
+        With a ``versions.Snapshot``, items and their containers are read
+        as they were when it was opened (items created since are left out).
         """
         if self._deleted:
             raise RuntimeError(f"Tracker '{self.tid}' has been deleted")
@@ -149,9 +228,15 @@ class Tracker:
         results: List[Dict[str, Any]] = []
 
         for item in self._items:
+            if snapshot is not None:
+                item = snapshot.item(item.trackingId())
+                if item is None:
+                    continue
             loc = None
             if hasattr(item, "_container") and item._container:
                 container_obj = item._container
+                if snapshot is not None:
+                    container_obj = snapshot.container(item.getContainer()) or container_obj
                 if hasattr(container_obj, "loc"):
                     loc = container_obj.loc
 
@@ -185,7 +270,7 @@ class Tracker:
             raise RuntimeError(f"Tracker '{self.tid}' has been deleted")
 
         try:
-            self._view_rect = (
+            rect = (
                 float(top),
                 float(left),
                 float(bottom),
@@ -193,6 +278,11 @@ class Tracker:
             )
         except (ValueError, TypeError) as exc:
             raise ValueError("Invalid view coordinates") from exc
+        if not all(math.isfinite(value) for value in rect):
+            raise ValueError("Invalid view coordinates")
+        self._view_rect = rect
+        if self._views is not None:
+            self._views.insert(self, view_box(self._view_rect))
 
     def inView(self, obj: Any) -> bool:
         """Return True if the object's location falls within the current view."""
@@ -221,11 +311,21 @@ class Tracker:
         lon, lat = loc
         return left <= lon <= right and bottom <= lat <= top
 
-    def _emit_update(self, updated_object: Optional[Any], obj_id: str) -> None:
+    def _emit_update(
+        self,
+        updated_object: Optional[Any],
+        obj_id: str,
+        item_ids: Optional[List[str]] = None,
+        loc: Optional[Tuple[float, float]] = None,
+    ) -> None:
         if not self._on_update:
             return
         try:
-            self._on_update(self, updated_object, obj_id)
+            if item_ids is None:
+                self._on_update(self, updated_object, obj_id)
+            else:
+                # aggregated container update, see batch_updated()
+                self._on_update(self, updated_object, obj_id, item_ids, loc)
         except Exception as exc:
             print(f"Tracker {self.tid}: update callback failed: {exc}")
 
@@ -0,0 +1,109 @@
+"""Copy-on-write point-in-time views of the model.
+
+``open_snapshot(directory, containers)`` returns a ``Snapshot``: the ids of
+the items and containers at that moment, plus a copy of every object that
+has changed since.  While a snapshot is open, the ``CargoItem`` and
+``Container`` mutators call ``preserve_item`` / ``preserve_container``
+*before* changing anything; the first call per object and snapshot keeps a
+frozen copy of it (``_freeze()``).  ``Snapshot.item()`` and
+``Snapshot.container()`` return that copy if there is one and the live
+object otherwise, so a reader sees every object as it was when the
+snapshot was opened without stopping the writers.
+
+A snapshot must be opened while no mutation is half done: callers hold
+every lock stripe for the (short) duration of ``open_snapshot``.  Reading
+a live object still takes its stripe, as any read does; a frozen copy is
+private to the snapshot.  Only the objects written while a snapshot is
+open are copied, once per snapshot, and the copies go with ``close()``.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from threading import Lock
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+# replaced, never changed in place, so mutators iterate it without a lock
+_open: Tuple["Snapshot", ...] = ()
+_open_lock = Lock()
+
+
+class Snapshot:
+    """The model as it was when ``open_snapshot`` returned it."""
+
+    def __init__(self, directory: Any, containers: Mapping[str, Any]) -> None:
+        self.directory = directory
+        self.containers = containers
+        with directory._index_lock:
+            # sorted, like the directory's own order
+            self.item_ids: List[str] = list(directory._order)
+        self.cids: List[str] = sorted(containers)
+        self._items: Dict[str, Any] = {}
+        self._containers: Dict[str, Any] = {}
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def item(self, item_id: str) -> Optional[Any]:
+        """The item as of the snapshot; callers hold its stripe."""
+        frozen = self._items.get(item_id)
+        if frozen is not None:
+            return frozen
+        return self.directory._items.get(item_id)
+
+    def container(self, cid: Any) -> Optional[Any]:
+        """The container as of the snapshot; callers hold its stripe."""
+        frozen = self._containers.get(cid)
+        if frozen is not None:
+            return frozen
+        return self.containers.get(cid)
+
+    def page_items(self, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
+        """``CargoDirectory.page()`` over the snapshot's items."""
+        return _page(self.item_ids, after, limit)
+
+    def page_containers(self, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
+        return _page(self.cids, after, limit)
+
+    def close(self) -> None:
+        global _open
+        with _open_lock:
+            _open = tuple(snapshot for snapshot in _open if snapshot is not self)
+        self._items.clear()
+        self._containers.clear()
+
+
+def open_snapshot(directory: Any, containers: Mapping[str, Any]) -> Snapshot:
+    """Open a snapshot of ``directory`` and ``containers``; close it when done."""
+    global _open
+    snapshot = Snapshot(directory, containers)
+    with _open_lock:
+        _open = _open + (snapshot,)
+    return snapshot
+
+
+def preserve_item(item: Any) -> None:
+    """Called under the item's stripe before it is changed or removed."""
+    for snapshot in _open:
+        item_id = item.trackingId()
+        if item_id not in snapshot._items and snapshot.directory._items.get(item_id) is not None:
+            snapshot._items[item_id] = item._freeze()
+
+
+def preserve_container(container: Any) -> None:
+    """Called under the container's stripe before it is changed."""
+    for snapshot in _open:
+        if container.cid not in snapshot._containers and snapshot.containers.get(container.cid) is container:
+            snapshot._containers[container.cid] = container._freeze()
+
+
+def _page(order: List[str], after: Optional[str], limit: int) -> Tuple[List[str], Optional[str]]:
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    start = 0 if after is None else bisect_right(order, after)
+    ids = order[start:start + limit]
+    more = start + limit < len(order)
+    return ids, (ids[-1] if more and ids else None)
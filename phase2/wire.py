@@ -0,0 +1,172 @@
+"""Length-prefixed binary framing, negotiated with ``PROTO BIN``.
+
+The text protocol splits requests on whitespace and answers with free-form
+``OK ...`` lines.  After ``PROTO BIN`` (answered ``OK BIN`` in text) both
+directions use frames instead::
+
+    <payload length: 4 bytes, big-endian> <payload: UTF-8 JSON array>
+
+A request payload is ``[id, command, arg, ...]``.  ``id`` is any JSON value
+(``null`` for none) and is echoed in the answer.  ``command`` is a name or
+its index in ``COMMANDS``.  Arguments are typed: strings may contain
+spaces, numbers need no formatting, and a list argument is spread into
+several arguments (``[1, "LOAD_MANY", "C1", ["CI1", "CI2"]]``).
+
+An answer or event payload is ``[id, status, body]``, one frame per line
+of the text answer.  ``status`` is ``OK``, ``ERR``, ``EVENT`` or the label
+of a listing chunk (``ITEMS``, ``CONTAINERS``).  ``body`` is the JSON value
+for JSON answers and the rest of the text line otherwise.  The server
+already builds JSON answers as text and marks them as ``JsonLine``, so they
+are framed without being decoded again; any other body, even one that
+starts with ``[`` or ``{``, is sent as a string.  ``PROTO TEXT`` switches
+back.
+"""
+
+from __future__ import annotations
+
+import json
+import struct
+from json.encoder import encode_basestring_ascii
+from typing import Any, Iterable, List, Optional, Tuple
+
+HEADER = struct.Struct(">I")
+
+# command codes are positions in this tuple; append only
+COMMANDS = (
+    "HELP", "USER", "CREATE_ITEM", "CREATE_CONTAINER", "LIST_ITEMS",
+    "LIST_CONTAINERS", "FIND_ITEMS", "WATCH", "WATCH_CONTAINER", "LOAD",
+    "UNLOAD", "LOAD_MANY", "UNLOAD_MANY", "MOVE", "COMPLETE", "SETLOC",
+    "SETVIEW", "CONTAINERS_IN_VIEW", "STATUS", "WAIT_EVENTS", "SINCE",
+    "TOKEN", "RESUME", "EVENT_STATS", "SAVE", "QUIT", "PROTO", "SAVE_STATS",
+)
+
+# (request id, command name, arguments); the name is None for a malformed frame
+Request = Tuple[Any, Optional[str], List[str]]
+
+
+def split_frames(buffer: bytearray, limit: int, stop: str = "PROTO") -> List[Request]:
+    """Remove the complete frames from ``buffer`` and decode them.
+
+    The payloads of one read are decoded with a single ``json.loads`` of
+    their concatenation; a batch with a malformed frame is decoded frame
+    by frame instead.  Decoding stops after a ``stop`` request, since what
+    follows it may be in the other framing.  Raises ``ValueError`` for a
+    frame longer than ``limit`` bytes.
+    """
+    payloads = []
+    ends = []
+    too_long = False
+    pos, available = 0, len(buffer)
+    with memoryview(buffer) as view:
+        while available - pos >= HEADER.size:
+            (size,) = HEADER.unpack_from(buffer, pos)
+            if size > limit:
+                # unless it follows a stop request, checked below
+                too_long = True
+                break
+            end = pos + HEADER.size + size
+            if end > available:
+                break
+            payloads.append(view[pos + HEADER.size:end].tobytes())
+            ends.append(end)
+            pos = end
+    if not payloads:
+        if too_long:
+            raise ValueError("Request frame too long")
+        return []
+    try:
+        decoded = json.loads(b"[" + b",".join(payloads) + b"]")
+    except ValueError:
+        decoded = [_loads(payload) for payload in payloads]
+    else:
+        if len(decoded) != len(payloads):
+            # e.g. a payload "1, 2" spanning two elements
+            decoded = [_loads(payload) for payload in payloads]
+    requests: List[Request] = []
+    for request in decoded:
+        requests.append(_request(request))
+        if requests[-1][1] == stop:
+            break
+    else:
+        if too_long:
+            raise ValueError("Request frame too long")
+    del buffer[:ends[len(requests) - 1]]
+    return requests
+
+
+def decode_request(payload: bytes) -> Request:
+    return _request(_loads(payload))
+
+
+def _loads(payload: bytes) -> Any:
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _request(request: Any) -> Request:
+    if not isinstance(request, list) or len(request) < 2:
+        return None, None, []
+    tag, command = request[0], request[1]
+    if isinstance(command, int) and 0 <= command < len(COMMANDS):
+        command = COMMANDS[command]
+    elif isinstance(command, str):
+        command = command.upper()
+    else:
+        return tag, None, []
+    args = request[2:]
+    if not all(type(arg) is str for arg in args):
+        args = []
+        for arg in request[2:]:
+            if isinstance(arg, list):
+                args.extend(_text(value) for value in arg)
+            else:
+                args.append(_text(arg))
+    return tag, command, args
+
+
+def _text(value: Any) -> str:
+    # command handlers parse their arguments from strings
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+class JsonLine(str):
+    """An answer line ``<status> <JSON>`` whose body is framed as JSON."""
+
+    __slots__ = ()
+
+
+def response_payload(tag: Any, line: str) -> str:
+    """Turn one line of a text answer into a frame payload."""
+    status, _, body = line.partition(" ")
+    if not (status.isalpha() and status.isupper()):
+        # e.g. the HELP text
+        status, body = "OK", line
+    if not isinstance(line, JsonLine) or not body:
+        body = encode_basestring_ascii(body) if body else "null"
+    return f'[{_json_tag(tag)},"{status}",{body}]'
+
+
+def _json_tag(tag: Any) -> str:
+    # json.dumps costs more than the rest of a short answer
+    if tag is None:
+        return "null"
+    if type(tag) is int:
+        return str(tag)
+    if type(tag) is str:
+        return encode_basestring_ascii(tag)
+    return json.dumps(tag)
+
+
+def event_payload(event: Any) -> str:
+    return '[null,"EVENT",' + json.dumps(event) + "]"
+
+
+def encode_frames(payloads: Iterable[str]) -> bytes:
+    parts = []
+    for payload in payloads:
+        data = payload.encode("utf-8")
+        parts.append(HEADER.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)